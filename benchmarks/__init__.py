@@ -0,0 +1,4 @@
+"""
+Offline benchmarks and comparison harnesses, run them from the root of the
+repository with python -m benchmarks.<name>
+"""
@@ -0,0 +1,72 @@
+"""
+Parity and latency of the exported inference backends against eager pytorch
+for the embedder and the QA model, on the fixed questions of
+benchmarks/questions.py. Results are printed as json and the exit code is 1
+if a backend differs from eager pytorch by more than the tolerance.
+
+python -m benchmarks.backends [--backends torchscript onnx] [--atol 1e-3]
+"""
+import argparse
+import json
+import sys
+from typing import Any, Dict
+
+from config import SPACY_MODEL_NAMES
+from embedders.answerer import Answerer
+from embedders.backends import EagerBackend, create_backend, max_difference
+from embedders.config import MODEL_NAMES
+from embedders.embedders import Embedder
+from indexer.indexer import load_processor
+
+from .questions import QUESTIONS
+from .quantization import latency
+
+
+def compare_backends(model: Any, tokenizer: Any, model_name: str,
+                     nb_outputs: int, backends: Any, repeat: int
+                     ) -> Dict[str, Any]:
+    texts = [text for pair in QUESTIONS for text in pair]
+    tokens = tokenizer(texts, padding=True, return_tensors='pt')
+    eager = EagerBackend(model, nb_outputs)
+
+    results: Dict[str, Any] = {'eager': {'latency_s': latency(
+        lambda: eager(tokens['input_ids'], tokens['attention_mask']),
+        repeat)}}
+    for kind in backends:
+        backend = create_backend(kind, model, model_name, nb_outputs)
+        results[kind] = {
+            'used': backend.name,
+            'max_abs_diff': max_difference(backend, eager, tokenizer, texts),
+            'latency_s': latency(
+                lambda: backend(tokens['input_ids'], tokens['attention_mask']),
+                repeat)}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backends', nargs='+',
+                        default=['torchscript', 'onnx'])
+    parser.add_argument('--atol', type=float, default=1e-3)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    embedder = Embedder(load_processor(SPACY_MODEL_NAMES['fr']), 'fr',
+                        use_cache=False, quantize=False)
+    answerer = Answerer('qa_fr', quantize=False)
+
+    report = {
+        'embedder': compare_backends(embedder.model, embedder.tokenizer,
+                                     MODEL_NAMES['fr'], 1, args.backends,
+                                     args.repeat),
+        'answerer': compare_backends(answerer.model, answerer.tokenizer,
+                                     MODEL_NAMES['qa_fr'], 2, args.backends,
+                                     args.repeat)}
+    print(json.dumps(report, indent=2))
+
+    failed = [f"{model} {kind}" for model, results in report.items()
+              for kind, result in results.items()
+              if result.get('max_abs_diff', 0.0) > args.atol]
+    if failed:
+        print(f"Outputs differ from eager pytorch for : {', '.join(failed)}")
+        sys.exit(1)
@@ -0,0 +1,106 @@
+"""
+Recall against size of the compressed embeddings : for each projected
+dimension and storage type, the fraction of the exact top k chunks (cosine
+with the full float32 content embeddings of the index) still found with the
+compressed ones. Queries are the fixed questions of benchmarks/questions.py
+and titles of chunks. Results are printed as json.
+
+python -m benchmarks.compression --db_name all_all [--dims 384 256 128]
+    [--backend elasticsearch]
+"""
+import argparse
+import json
+from typing import Any, Dict, List
+
+import numpy as np
+
+from config import SPACY_MODEL_NAMES, STORAGE_BACKEND
+from embedders.embedders import Embedder
+from indexer.ann import normalize
+from indexer.compression import Projection
+from indexer.indexer import load_processor
+from indexer.sidecar import dequantize, quantize
+from indexer.storage import create_store
+
+from .questions import QUESTIONS
+
+
+def top_k(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """Indexes of the k closest vectors (cosine) of each query"""
+    scores = normalize(queries) @ normalize(vectors).T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def recall(exact: np.ndarray, approx: np.ndarray) -> float:
+    found = sum(len(set(e) & set(a)) for e, a in zip(exact, approx))
+    return found / exact.size
+
+
+def compare_compressions(vectors: np.ndarray, queries: np.ndarray,
+                         dims: List[int], dtypes: List[str], k: int
+                         ) -> List[Dict[str, Any]]:
+    exact = top_k(vectors, queries, k)
+
+    results: List[Dict[str, Any]] = []
+    for dim in [vectors.shape[1]] + [d for d in dims if d < vectors.shape[1]]:
+        if dim < vectors.shape[1]:
+            projection = Projection.fit(vectors, dim)
+            projected = (vectors - projection.mean) @ projection.components
+            projected_queries = ((queries - projection.mean)
+                                 @ projection.components)
+        else:
+            projected, projected_queries = vectors, queries
+
+        for dtype in dtypes:
+            codes, scales = quantize(projected, dtype)
+            approx = top_k(dequantize(codes, scales), projected_queries, k)
+            results.append({
+                'dim': dim, 'dtype': dtype,
+                # int8 rows also store their scale
+                'bytes_per_vector': codes.itemsize * dim
+                + (4 if dtype == 'int8' else 0),
+                f'recall@{k}': recall(exact, approx)})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--db_name', default='all_all')
+    parser.add_argument('--dims', nargs='+', type=int,
+                        default=[384, 256, 128, 64])
+    parser.add_argument('--dtypes', nargs='+',
+                        default=['float32', 'float16', 'int8'])
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nb_titles', type=int, default=200)
+    parser.add_argument('--backend', default=STORAGE_BACKEND,
+                        choices=['elasticsearch', 'local'])
+    args = parser.parse_args()
+
+    ids: List[str] = []
+    contents: List[List[float]] = []
+    titles: List[List[float]] = []
+    for doc_id, source in create_store(args.backend).scan(
+            args.db_name, relation="chunk",
+            fields=['content_embedding', 'title_embedding']):
+        ids.append(doc_id)
+        contents.append(source['content_embedding'])
+        titles.append(source['title_embedding'])
+
+    vectors = np.asarray(contents, dtype=np.float32)
+    rng = np.random.default_rng(0)
+    sampled = rng.choice(len(titles), min(args.nb_titles, len(titles)),
+                         replace=False)
+    queries = [titles[idx] for idx in sampled]
+
+    # Questions can only be compared to an index of the model dimension
+    embedder = Embedder(load_processor(SPACY_MODEL_NAMES['fr']), 'fr')
+    if embedder.model.config.hidden_size == vectors.shape[1]:
+        queries += embedder.embed_batch(
+            [question for question, _ in QUESTIONS], 'all')
+
+    report = {'db_name': args.db_name, 'nb_chunks': len(ids),
+              'nb_queries': len(queries),
+              'results': compare_compressions(
+                  vectors, np.asarray(queries, dtype=np.float32),
+                  args.dims, args.dtypes, args.k)}
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,124 @@
+"""
+Compare the int8 quantized models with the fp32 ones on the fixed questions
+of benchmarks/questions.py : latency, size of the weights and agreement of
+the outputs. Results are printed as json.
+
+python -m benchmarks.quantization [--summarizer] [--repeat 3]
+"""
+import argparse
+import io
+import json
+import time
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import torch
+
+from config import SPACY_MODEL_NAMES
+from datatypes import Chunk
+from embedders.answerer import Answerer
+from embedders.embedders import Embedder
+from embedders.summarizer import Summarizer
+from indexer.indexer import load_processor
+
+from .questions import QUESTIONS
+
+
+def weights_size(model: torch.nn.Module) -> int:
+    """Size in bytes of the serialized weights"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def latency(function: Callable[[], Any], repeat: int) -> float:
+    """Mean duration in seconds of a call (after a warmup call)"""
+    function()
+    start = time.time()
+    for _ in range(repeat):
+        function()
+    return (time.time() - start) / repeat
+
+
+def as_chunk(context: str) -> Chunk:
+    return {'content': context, 'title': '', 'links': [],  # type: ignore
+            'first_seen_date': None}
+
+
+def compare_embedders(repeat: int) -> Dict[str, Any]:
+    processor = load_processor(SPACY_MODEL_NAMES['fr'])
+    texts = [text for pair in QUESTIONS for text in pair]
+
+    results: Dict[str, Any] = {}
+    embeddings: Dict[str, np.ndarray] = {}
+    for name, quantize in (('fp32', False), ('int8', True)):
+        embedder = Embedder(processor, 'fr', use_cache=False,
+                            quantize=quantize)
+        embeddings[name] = np.asarray(embedder.compute(texts, 'all'))
+        results[name] = {
+            'latency_s': latency(lambda: embedder.compute(texts, 'all'),
+                                 repeat),
+            'weights_bytes': weights_size(embedder.model)}
+
+    cosines = np.sum(embeddings['fp32'] * embeddings['int8'], axis=1) / (
+        np.linalg.norm(embeddings['fp32'], axis=1) *
+        np.linalg.norm(embeddings['int8'], axis=1))
+    results['mean_cosine_fp32_int8'] = float(cosines.mean())
+    results['min_cosine_fp32_int8'] = float(cosines.min())
+    return results
+
+
+def compare_answerers(repeat: int) -> Dict[str, Any]:
+    questions = [question for question, _ in QUESTIONS]
+    contexts = [context for _, context in QUESTIONS]
+
+    results: Dict[str, Any] = {}
+    answers: Dict[str, List[Any]] = {}
+    for name, quantize in (('fp32', False), ('int8', True)):
+        answerer = Answerer('qa_fr', quantize=quantize)
+        answers[name] = answerer.spans(questions, contexts)
+        results[name] = {
+            'latency_s': latency(lambda: answerer.spans(questions, contexts),
+                                 repeat),
+            'weights_bytes': weights_size(answerer.model)}
+
+    pairs = list(zip(answers['fp32'], answers['int8']))
+    results['same_span_rate'] = sum(
+        a['start'] == b['start'] and a['end'] == b['end'] for a, b in pairs
+    ) / len(pairs)
+    results['mean_score_diff'] = float(np.mean(
+        [abs(a['score'] - b['score']) for a, b in pairs]))
+    return results
+
+
+def compare_summarizers(repeat: int) -> Dict[str, Any]:
+    supports = [as_chunk(context) for _, context in QUESTIONS]
+
+    results: Dict[str, Any] = {}
+    summaries: Dict[str, Any] = {}
+    for name, quantize in (('fp32', False), ('int8', True)):
+        summarizer = Summarizer('sum_fr', quantize=quantize)
+        summaries[name] = summarizer.summarize(supports)['answer']
+        results[name] = {
+            'latency_s': latency(lambda: summarizer.summarize(supports),
+                                 repeat),
+            'weights_bytes': weights_size(summarizer.summarizer.model),
+            'summary': summaries[name]}
+
+    results['same_summary'] = summaries['fp32'] == summaries['int8']
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--summarizer', action='store_true',
+                        help="Also compare the summarizers (slow)")
+    args = parser.parse_args()
+
+    report = {'embedder': compare_embedders(args.repeat),
+              'answerer': compare_answerers(args.repeat)}
+    if args.summarizer:
+        report['summarizer'] = compare_summarizers(args.repeat)
+
+    print(json.dumps(report, indent=2, default=str))
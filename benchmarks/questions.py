@@ -0,0 +1,33 @@
+"""
+Fixed set of questions (most of them from meeting.md) with a paragraph
+answering them, used to compare models variants
+"""
+from typing import List, Tuple
+
+QUESTIONS: List[Tuple[str, str]] = [
+    ("Existe-t-il un vaccin contre la COVID-19 ?",
+     "Plusieurs vaccins contre la COVID-19 sont en cours de développement."
+     " Aucun vaccin n'est encore disponible au Québec. Lorsqu'un vaccin sera "
+     "homologué, la vaccination sera offerte en priorité aux personnes les "
+     "plus vulnérables."),
+    ("Existe-t-il un traitement contre la COVID-19 ?",
+     "Il n'existe pas de traitement spécifique contre la COVID-19. La "
+     "plupart des personnes se rétablissent par elles-mêmes. Les traitements "
+     "soulagent les symptômes comme la fièvre et la toux."),
+    ("Les femmes enceintes sont-elles plus a risque ?",
+     "Les femmes enceintes ne semblent pas plus à risque de complications "
+     "que la population générale. Par prudence, elles doivent toutefois "
+     "respecter les consignes sanitaires et consulter en cas de symptômes."),
+    ("Comment soulager les maux de gorge ?",
+     "Pour soulager le mal de gorge, vous pouvez sucer des pastilles, boire "
+     "des liquides chauds et vous gargariser avec de l'eau salée. "
+     "Consultez un médecin si la douleur persiste plus de quelques jours."),
+    ("Quels sont les symptômes de la COVID-19 ?",
+     "Les principaux symptômes sont la fièvre, l'apparition ou "
+     "l'aggravation d'une toux, la difficulté à respirer et la perte "
+     "soudaine de l'odorat sans congestion nasale."),
+    ("Combien de temps dure l'isolement ?",
+     "Les personnes atteintes de la COVID-19 doivent s'isoler à la maison "
+     "pendant au moins 10 jours après le début des symptômes. L'isolement "
+     "prend fin si elles n'ont plus de fièvre depuis 48 heures."),
+]
@@ -0,0 +1,229 @@
+"""
+Throughput and latency of each stage of the indexing and of the answering :
+cleaning (sanitize_text / remove_links), chunker, create_metadata, indexing,
+ANN and BM25 builds, retrieve_docs (for each retrieve mode),
+answer_question_by_chunks and answer_question_by_summary, one after the
+other and at the same time (answer_question of qa.orchestrator).
+
+By default it runs offline with the stub models and the local elasticsearch
+of benchmarks/stubs.py on a synthetic dataset, so it can run in CI (--store
+local uses the embedded store of indexer.storage instead). Results
+are printed as json (and written to --output), with --baseline the mean
+latency of each stage is compared to a previous run and the exit code is 1
+if a stage is slower by more than the tolerance.
+
+python -m benchmarks.stages [--real_models] [--store stub] [--dataset all]
+    [--output stages.json] [--baseline previous.json] [--tolerance 0.2]
+"""
+import argparse
+import asyncio
+import copy
+import json
+import sys
+import time
+from typing import Any, Callable, Dict, List, TypeVar
+
+import numpy as np
+
+from datatypes import Indexes, Models, RawEntry, RetrieveOptions
+from indexer.chunker import chunker
+from indexer.indexer import (add_entries, build_ann, build_sparse,
+                             clean_entry, create_indexes, create_models,
+                             iter_entries)
+from indexer.metabuilder import create_metadata
+from indexer.sidecar import SentenceStore, remove_sidecars
+from indexer.storage import ElasticStore
+from indexer.stream import dataset_path, load_tree
+from qa.orchestrator import answer_question
+from qa.refinder import (SUMMARY_CACHE, answer_question_by_chunks,
+                         answer_question_by_summary)
+from qa.retriever import retrieve_docs
+
+from .questions import QUESTIONS
+from .stubs import LocalElasticsearch, stub_models, synthetic_tree
+
+DB_NAME = "benchmark_all"
+OPTIONS: RetrieveOptions = {
+    'retrieve_nb': 10,
+    'retrieve_mode': 'dense',
+    'rescore_window': 100,
+    'boost_lem': 1.0,
+    'boost_page_lem': 1.0,
+    'boost_ner': 1.0,
+    'boost_date': 0.1,
+    'boost_title': 1.0,
+    'boost_content': 1.0,
+    'boost_page': 1.0,
+    'boost_parent_title': 1.0,
+    'boost_parent_content': 1.0,
+    'boost_title_embedding': 1.0,
+    'boost_parent_embedding': 1.0,
+    'boost_content_embedding': 1.0,
+    'embedding_mode': 'all',
+}
+
+T = TypeVar('T')
+
+
+class StageTimer:
+    """Durations of the calls of each stage, with the number of items
+    (entries, chunks, documents...) processed by each call"""
+
+    def __init__(self) -> None:
+        self.durations: Dict[str, List[float]] = {}
+        self.items: Dict[str, int] = {}
+
+    def measure(self, stage: str, function: Callable[[], T],
+                items: int = 1) -> T:
+        start = time.perf_counter()
+        result = function()
+        self.durations.setdefault(stage, []).append(
+            time.perf_counter() - start)
+        self.items[stage] = self.items.get(stage, 0) + items
+        return result
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        report: Dict[str, Dict[str, float]] = {}
+        for stage, durations in self.durations.items():
+            milliseconds = np.asarray(durations) * 1000
+            total = float(np.sum(durations))
+            report[stage] = {
+                'calls': len(durations),
+                'items': self.items[stage],
+                'total_s': total,
+                'mean_ms': float(milliseconds.mean()),
+                'p50_ms': float(np.percentile(milliseconds, 50)),
+                'p95_ms': float(np.percentile(milliseconds, 95)),
+                'items_per_s': self.items[stage] / max(total, 1e-9)}
+        return report
+
+
+def benchmark_indexing(timer: StageTimer, tree: RawEntry, models: Models,
+                       indexes: Indexes) -> None:
+    # Stages one by one on each entry of the tree
+    stack = [copy.deepcopy(tree)]
+    while stack:
+        entry = stack.pop()
+        stack.extend(entry.get('children') or [])
+
+        links = timer.measure('clean', lambda: clean_entry(entry))
+        chunks = timer.measure('chunker', lambda: chunker(entry, models))
+        timer.measure('create_metadata', lambda: create_metadata(
+            chunks, links, models, 'all'), items=len(chunks))
+
+    # Indexing alone, from already computed chunks
+    entries = list(iter_entries(DB_NAME, copy.deepcopy(tree), 0, models, []))
+    nb_docs = sum(1 + len(chunks) for _, chunks in entries)
+    timer.measure('index', lambda: add_entries(DB_NAME, indexes, entries),
+                  items=nb_docs)
+    timer.measure('build_ann', lambda: build_ann(DB_NAME, indexes),
+                  items=len(entries))
+    timer.measure('build_sparse', lambda: build_sparse(DB_NAME, indexes),
+                  items=len(entries))
+
+
+def benchmark_answering(timer: StageTimer, models: Models,
+                        indexes: Indexes) -> None:
+    for question, _ in QUESTIONS:
+        retrieved = {}
+        for mode in ('sparse', 'dense', 'hybrid', 'ann', 'bm25', 'rescore',
+                     'rrf'):
+            options: RetrieveOptions = {**OPTIONS,  # type: ignore
+                                        'retrieve_mode': mode}
+            retrieved[mode] = timer.measure(
+                f'retrieve_docs_{mode}', lambda: retrieve_docs(
+                    DB_NAME, indexes, models, question, options, cache=None))
+
+        question_embed, supports, _, _ = retrieved['dense']
+
+        timer.measure('answer_question_by_chunks',
+                      lambda: answer_question_by_chunks(
+                          question_embed, question, supports, models,
+                          indexes['sentences']), items=len(supports))
+        timer.measure('answer_question_by_summary',
+                      lambda: answer_question_by_summary(supports, models,
+                                                         cache=None),
+                      items=len(supports))
+        # Summaries are not taken from the cache for the timings
+        SUMMARY_CACHE.clear()
+        timer.measure('answer_question_async',
+                      lambda: asyncio.run(answer_question(
+                          question_embed, question, supports, models,
+                          indexes['sentences'])), items=len(supports))
+
+
+def compare(report: Dict[str, Dict[str, float]],
+            baseline: Dict[str, Dict[str, float]], tolerance: float
+            ) -> List[Dict[str, Any]]:
+    """Stages whose mean latency increased by more than the tolerance"""
+    regressions: List[Dict[str, Any]] = []
+    for stage, stats in report.items():
+        if stage not in baseline:
+            continue
+        ratio = stats['mean_ms'] / max(baseline[stage]['mean_ms'], 1e-9)
+        if ratio > 1 + tolerance:
+            regressions.append({'stage': stage, 'ratio': ratio,
+                                'mean_ms': stats['mean_ms'],
+                                'baseline_mean_ms':
+                                    baseline[stage]['mean_ms']})
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--real_models', action='store_true')
+    parser.add_argument('--store', default='stub',
+                        choices=['stub', 'elasticsearch', 'local'],
+                        help="Stand-in of elasticsearch, local cluster or "
+                        "embedded store")
+    parser.add_argument('--dataset', default=None,
+                        help="Dataset of datasets/gouv, synthetic if not set")
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    timer = StageTimer()
+    tree: RawEntry = (load_tree(dataset_path(args.dataset)) if args.dataset
+                      else synthetic_tree())  # type: ignore
+
+    if args.real_models:
+        # Models are loaded on first use, see stage times
+        models = create_models(['fr'])
+    else:
+        models = stub_models()
+
+    remove_sidecars(DB_NAME)
+    if args.store == 'stub':
+        indexes = {"db": ElasticStore(LocalElasticsearch()),  # type: ignore
+                   "sentences": SentenceStore(DB_NAME),
+                   "ann": None, "sparse": None, "projection": None}
+        indexes['db'].create(DB_NAME, {})
+    else:
+        indexes, _ = create_indexes(DB_NAME, models, args.store)
+
+    try:
+        benchmark_indexing(timer, tree, models, indexes)
+        benchmark_answering(timer, models, indexes)
+    finally:
+        indexes['db'].delete(DB_NAME)
+        remove_sidecars(DB_NAME)
+
+    report: Dict[str, Any] = {
+        'config': {'real_models': args.real_models, 'store': args.store,
+                   'dataset': args.dataset or 'synthetic'},
+        'stages': timer.report()}
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)['stages']
+        report['regressions'] = compare(report['stages'], baseline,
+                                        args.tolerance)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if report.get('regressions'):
+        sys.exit(1)
@@ -0,0 +1,355 @@
+"""
+Stand-ins to run the pipeline offline : stub models with the interfaces of
+the real ones (fast and deterministic, not meaningful answers) and a local
+in memory elasticsearch client implementing the calls the code makes.
+
+Timings with them measure the code around the models and the database,
+use the real ones for end to end numbers.
+"""
+import hashlib
+import re
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional, Tuple, cast
+
+import numpy as np
+import spacy
+import torch
+from spacy.language import Language
+from spacy.tokens import Doc
+from elasticsearch.serializer import JSONSerializer
+
+from config import LANGUAGES
+from datatypes import Models
+from embedders.answerer import Answerer, Res
+from embedders.config import SUMMARY_INPUT_TOKENS
+from embedders.embedders import Embedder
+from embedders.summarizer import Summarizer
+
+STUB_DIM = 64
+SHARDS = {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0}
+WORD = re.compile(r"\w+")
+
+
+class StubEmbedder(Embedder):
+    """Hashed bag of words vectors, texts sharing words are close"""
+
+    def __init__(self, processor: Any, dim: int = STUB_DIM) -> None:
+        self.device = torch.device("cpu")
+        self.processor = processor
+        self.model = SimpleNamespace(config=SimpleNamespace(hidden_size=dim))
+        self.caches = {}
+
+    def embed_cls(self, texts: List[str]) -> torch.Tensor:
+        dim = self.model.config.hidden_size
+        embeded = torch.zeros(len(texts), dim)
+        for row, text in enumerate(texts):
+            for word in WORD.findall(text.lower()):
+                digest = hashlib.md5(word.encode()).digest()
+                embeded[row, int.from_bytes(digest[:4], 'little') % dim] += 1
+        return embeded + 1e-3
+
+
+class StubAnswerer(Answerer):
+    """The first sentence of the context sharing the most words with the
+    question"""
+
+    def __init__(self) -> None:
+        pass
+
+    def spans(self, questions: List[str], contexts: List[str]) -> List[Res]:
+        results: List[Res] = []
+        for question, context in zip(questions, contexts):
+            words = set(WORD.findall(question.lower()))
+            best: Res = {'answer': '', 'score': 0.0, 'start': 0, 'end': 0}
+            start = 0
+            for sentence in re.split(r'(?<=\.) ', context):
+                common = len(words & set(WORD.findall(sentence.lower())))
+                score = common / max(1, len(words))
+                if score > best['score']:
+                    best = {'answer': sentence, 'score': score,
+                            'start': start, 'end': start + len(sentence)}
+                start += len(sentence) + 1
+            results.append(best)
+        return results
+
+
+class StubSummarizer(Summarizer):
+    """The first sentences of the texts, tokens are words"""
+
+    def __init__(self) -> None:
+        pass
+
+    def generate(self, texts: List[str], max_length: int) -> List[str]:
+        return [" ".join(" ".join(text.split(". ")[:3]).split()[:max_length])
+                for text in texts]
+
+    def nb_tokens(self, text: str) -> int:
+        return len(text.split())
+
+    def truncate(self, text: str,
+                 max_tokens: int = SUMMARY_INPUT_TOKENS) -> str:
+        return " ".join(text.split()[:max_tokens])
+
+
+@Language.component("lower_lemmas")
+def lower_lemmas(doc: Doc) -> Doc:
+    for token in doc:
+        token.lemma_ = token.lower_
+    return doc
+
+
+def stub_processor() -> Any:
+    """Blank french spacy pipeline, the lemmas are the lowercased words"""
+    nlp = spacy.blank("fr")
+    nlp.add_pipe("sentencizer")
+    nlp.add_pipe("lower_lemmas")
+    return nlp
+
+
+def stub_models() -> Models:
+    processor = stub_processor()
+    langs = cast(List[LANGUAGES], ['fr'])
+    return cast(Models, {
+        "processor": {lang: processor for lang in langs},
+        "embedder": {lang: StubEmbedder(processor) for lang in langs},
+        "answerer": {lang: StubAnswerer() for lang in langs},
+        "summarizer": {lang: StubSummarizer() for lang in langs}})
+
+
+class LocalIndices:
+    def __init__(self, client: 'LocalElasticsearch') -> None:
+        self.client = client
+
+    def exists(self, index: str, **kwargs: Any) -> bool:
+        return index in self.client.docs
+
+    def create(self, index: str, body: Any = None, **kwargs: Any) -> None:
+        self.client.docs.setdefault(index, {})
+        self.client.settings.setdefault(index, {})
+
+    def delete(self, index: str, **kwargs: Any) -> None:
+        self.client.docs.pop(index, None)
+        self.client.settings.pop(index, None)
+
+    def get(self, index: str, **kwargs: Any) -> Dict[str, Any]:
+        return {name: {} for name in self.client.docs}
+
+    def get_settings(self, index: str, **kwargs: Any) -> Dict[str, Any]:
+        return {index: {'settings': {
+            'index': dict(self.client.settings.get(index, {}))}}}
+
+    def put_settings(self, index: str, body: Dict[str, Any],
+                     **kwargs: Any) -> None:
+        settings = self.client.settings.setdefault(index, {})
+        for key, value in body['index'].items():
+            if value is None:
+                settings.pop(key, None)
+            else:
+                settings[key] = value
+
+    def refresh(self, index: str, **kwargs: Any) -> None:
+        pass
+
+
+class LocalElasticsearch:
+    """
+    In memory stand-in of the elasticsearch client for the calls made by the
+    indexer and the retriever (index, bulk, mget, search, scan).
+
+    Queries are evaluated naively on every document : word overlap for the
+    text queries, and for a script_score the shifted cosines of the question
+    with the title, content and parent title embeddings (the painless source
+    is not interpreted).
+    """
+
+    def __init__(self) -> None:
+        self.docs: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self.settings: Dict[str, Dict[str, Any]] = {}
+        self.indices = LocalIndices(self)
+        self.serializer = JSONSerializer()
+        self.transport = SimpleNamespace(serializer=self.serializer)
+
+    def index(self, index: str, id: str, body: Dict[str, Any],
+              **kwargs: Any) -> Dict[str, Any]:
+        self.indices.create(index)
+        self.docs[index][id] = self.serializer.loads(
+            self.serializer.dumps(body))
+        return {'_id': id, 'result': 'created'}
+
+    def bulk(self, body: str, index: Optional[str] = None, **kwargs: Any
+             ) -> Dict[str, Any]:
+        lines = iter(line for line in body.split("\n") if line)
+        items: List[Dict[str, Any]] = []
+        for line in lines:
+            op_type, meta = next(iter(self.serializer.loads(line).items()))
+            db_name = meta.get('_index', index)
+            docs = self.docs.setdefault(db_name, {})
+            doc_id = meta['_id']
+
+            if op_type == 'delete':
+                status = 200 if docs.pop(doc_id, None) is not None else 404
+            elif op_type == 'update':
+                update = self.serializer.loads(next(lines))
+                status = 200 if doc_id in docs else 404
+                if status == 200:
+                    docs[doc_id].update(update['doc'])
+            else:
+                docs[doc_id] = self.serializer.loads(next(lines))
+                status = 201
+            items.append({op_type: {'_id': doc_id, 'status': status}})
+
+        return {'errors': False, 'items': items}
+
+    def mget(self, index: str, body: Dict[str, Any],
+             _source: Optional[List[str]] = None, **kwargs: Any
+             ) -> Dict[str, Any]:
+        docs = self.docs.get(index, {})
+        return {'docs': [
+            {'_id': doc_id, 'found': True,
+             '_source': select(docs[doc_id], _source)}
+            if doc_id in docs else {'_id': doc_id, 'found': False}
+            for doc_id in body['ids']]}
+
+    def search(self, index: str, body: Dict[str, Any],
+               scroll: Optional[str] = None, size: Optional[int] = None,
+               **kwargs: Any) -> Dict[str, Any]:
+        docs = self.docs.get(index, {})
+        query = body.get('query', {'match_all': {}})
+
+        hits: List[Tuple[float, str]] = []
+        for doc_id, source in docs.items():
+            score = self.score(query, source, docs)
+            if score is not None:
+                hits.append((score, doc_id))
+
+        min_score = float(body.get('min_score', '-inf'))
+        hits = [(score, doc_id) for score, doc_id in hits
+                if score >= min_score]
+        if scroll is None:
+            hits.sort(key=lambda hit: -hit[0])
+            hits = hits[:body.get('size', size or 10)]
+
+        return {
+            '_scroll_id': 'local', '_shards': SHARDS,
+            'hits': {
+                'total': {'value': len(hits), 'relation': 'eq'},
+                'max_score': max((score for score, _ in hits), default=None),
+                'hits': [{'_id': doc_id, '_score': score,
+                          '_source': select(docs[doc_id],
+                                            body.get('_source'))}
+                         for score, doc_id in hits]}}
+
+    def scroll(self, **kwargs: Any) -> Dict[str, Any]:
+        # Everything was returned by the first search
+        return {'_scroll_id': 'local', '_shards': SHARDS,
+                'hits': {'hits': []}}
+
+    def clear_scroll(self, **kwargs: Any) -> None:
+        pass
+
+    def score(self, query: Dict[str, Any], source: Dict[str, Any],
+              docs: Dict[str, Dict[str, Any]]) -> Optional[float]:
+        """Score of the document for the query, None if it does not match"""
+        kind, params = next(iter(query.items()))
+
+        if kind == 'match_all':
+            return 1.0
+
+        if kind == 'term':
+            field, value = next(iter(params.items()))
+            stored = source.get(field)
+            if isinstance(stored, dict):  # join field
+                stored = stored.get('name')
+            return 0.0 if stored == value else None
+
+        if kind == 'constant_score':
+            matched = self.score(params['filter'], source, docs)
+            return None if matched is None else params.get('boost', 1.0)
+
+        if kind == 'multi_match':
+            words = set(WORD.findall(params['query'].lower()))
+            score = 0.0
+            for field in params['fields']:
+                name, _, boost = field.partition('^')
+                text = str(source.get(name, '')).lower()
+                common = len(words & set(WORD.findall(text)))
+                score = max(score, float(boost or 1.0) * common)
+            return score or None
+
+        if kind == 'has_parent':
+            relation = source.get('relation')
+            parent = (docs.get(relation['parent'])
+                      if isinstance(relation, dict) else None)
+            if parent is None:
+                return None
+            score = self.score(params['query'], parent, docs)
+            return score if params.get('score') else (
+                None if score is None else 0.0)
+
+        if kind == 'bool':
+            for clause in params.get('filter', []) + params.get('must', []):
+                if self.score(clause, source, docs) is None:
+                    return None
+            should = [self.score(clause, source, docs)
+                      for clause in params.get('should', [])]
+            matched = [score for score in should if score is not None]
+            if len(matched) < params.get('minimum_should_match', 0):
+                return None
+            return sum(matched)
+
+        if kind == 'script_score':
+            score = self.score(params['query'], source, docs)
+            if score is None:
+                return None
+            question = params['script']['params']['question_embed']
+            for field in ('content_embedding', 'title_embedding',
+                          'parent_title_embedding'):
+                score += 1.0 + cosine(question, source[field])
+            return score
+
+        raise NotImplementedError(f"Query {kind} is not supported locally")
+
+
+def cosine(a: List[float], b: List[float]) -> float:
+    a_array, b_array = np.asarray(a), np.asarray(b)
+    norm = np.linalg.norm(a_array) * np.linalg.norm(b_array)
+    return float(a_array @ b_array / norm) if norm > 0 else 0.0
+
+
+def select(source: Dict[str, Any], fields: Optional[List[str]]
+           ) -> Dict[str, Any]:
+    if fields is None:
+        return source
+    return {k: v for k, v in source.items() if k in fields}
+
+
+def synthetic_tree(nb_pages: int = 20, nb_sections: int = 3
+                   ) -> Dict[str, Any]:
+    """A dataset of pages with sections, made of the paragraphs of
+    benchmarks/questions.py"""
+    from .questions import QUESTIONS
+
+    paragraphs = [paragraph for _, paragraph in QUESTIONS]
+    date = datetime(2020, 10, 1).strftime("%m/%d/%Y")
+
+    def entry(path: str, title: str, content: str,
+              children: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return {'type': 'page', 'path': path, 'title': title,
+                'content': content, 'language': 'fr',
+                'first_seen_date': date, 'children': children}
+
+    def iter_pages() -> Iterator[Dict[str, Any]]:
+        for page in range(nb_pages):
+            sections = [
+                entry(f"/page{page}/section{section}",
+                      f"Section {section} de la page {page}",
+                      " ".join(paragraphs[(page + section + offset)
+                                          % len(paragraphs)]
+                               for offset in range(3)), [])
+                for section in range(nb_sections)]
+            yield entry(f"/page{page}", f"Page {page}",
+                        paragraphs[page % len(paragraphs)], sections)
+
+    return entry("/", "Accueil", paragraphs[0], list(iter_pages()))
+
@@ -1,4 +1,4 @@
-from typing import Literal, Dict
+from typing import Literal, Dict, Optional
 
 
 LANGUAGES = Literal['en', 'fr', 'multi',
@@ -8,9 +8,58 @@ LANG_TO_CODE = {v: k for k, v in CODE_TO_LANG.items()}
 
 CHUNK_SIZE = 1000  # number of word per paragraph
 NB_KEYWORDS = 6  # number of keywords to keep per chunk
-EMBED_DIM = 768
 
 
 SPACY_MODEL_NAMES: Dict[LANGUAGES, str] = {"multi": "xx_ent_wiki_sm",
                                            "en": "en_core_web_sm",
                                            "fr": "fr_core_news_sm"}
+
+BULK_CHUNK_SIZE = 100  # number of chunks per elasticsearch bulk request
+BULK_THREAD_COUNT = 4  # number of bulk requests in flight at the same time
+BUILD_WORKERS = 1  # processes computing the chunks of a new index (1 = none)
+BUILD_READ_AHEAD = 4  # entries read ahead of the processes, per process
+CHUNK_SUMMARIES = True  # summarize each chunk when it is indexed
+
+STORAGE_BACKEND = "elasticsearch"  # or local, see indexer.storage
+LOCAL_STORE_DIR = "local_store"  # indexes of the local storage backend
+
+SIDECAR_DIR = "indexes"  # files stored next to each elasticsearch index
+ANN_NPROBE = 8  # number of clusters scanned by an approximate search
+ANN_KMEANS_ITERATIONS = 10
+BM25_K1 = 1.2  # term frequency saturation of the in process sparse index
+BM25_B = 0.75  # length normalization of the in process sparse index
+SPARSE_BLOCK_SIZE = 128  # number of documents per block of postings
+
+# Dimension of the indexed embeddings (None to keep the one of the model)
+EMBED_PROJECTION_DIM: Optional[int] = None
+PROJECTION_FIT_SIZE = 2000  # number of chunks the projection is fitted on
+VECTOR_DTYPE = "float32"  # storage of the sidecar vectors (float16, int8)
+
+RETRIEVE_CACHE_SIZE = 1024  # number of retrieval results kept in memory
+RETRIEVE_CACHE_TTL = 3600  # seconds before a cached retrieval expires
+SUMMARY_CACHE_SIZE = 256  # number of summaries kept in memory
+SUMMARY_CACHE_TTL = 3600  # seconds before a cached summary expires
+RESCORE_WINDOW = 100  # candidates of each leg of the rescore and rrf modes
+RRF_K = 60  # rank offset of the reciprocal rank fusion
+
+# Latency budget of an answer, from the request (None for no deadline)
+ANSWER_BUDGET_MS: Optional[float] = None
+ANSWER_BATCH_SIZE = 4  # supports answered at once before checking early exit
+SUMMARY_SUPPORTS = 5  # supports of a summary
+SUMMARY_MAX_LENGTH = 500  # tokens of a summary
+SHORT_SUMMARY_SUPPORTS = 2  # supports of a summary shortened by the budget
+SHORT_SUMMARY_MAX_LENGTH = 150  # tokens of a summary shortened by the budget
+# Expected seconds of the stages which can be skipped, before they are
+# measured (then a moving average of their durations, see qa.budget)
+STAGE_COST_ESTIMATES: Dict[str, float] = {'qa_batch': 0.2,
+                                          'sentence_fallback': 0.05,
+                                          'summarize': 3.0,
+                                          'summarize_short': 1.0}
+STAGE_COST_SMOOTHING = 0.2  # weight of the last duration in the average
+MODEL_WORKERS = 4  # threads running the model stages of qa.orchestrator
+
+SERVICE_PORT = 8000
+SERVICE_BATCH_WAIT_MS = 10  # time a request waits for others to batch with
+SERVICE_MAX_BATCH = 16  # maximum number of requests batched together
+
+TRACE_LOG: Optional[str] = None  # json lines file of the requests traces
@@ -3,14 +3,18 @@ This file is made to have configuration variables at the same place
 as well with the types
 """
 from datetime import datetime
-from typing import Any, Dict, List, Literal, Optional, TypedDict
-
-from elasticsearch import Elasticsearch
+from typing import Any, Dict, List, Literal, Optional, Tuple, TypedDict
 
 from config import LANGUAGES
+from indexer.ann import AnnIndex
+from indexer.compression import Projection
+from indexer.sidecar import SentenceStore
+from indexer.sparse import SparseIndex
+from indexer.storage import Store
 
 EmbeddingMode = Literal["all", "sentence"]
-RetrieveMode = Literal['dense', 'hybrid', 'sparse']
+RetrieveMode = Literal['dense', 'hybrid', 'sparse', 'ann', 'bm25',
+                       'rescore', 'rrf']
 
 
 class RawEntry(TypedDict):
@@ -23,6 +27,13 @@ class RawEntry(TypedDict):
     children: Optional[List['RawEntry']]
 
 
+class FlatEntry(RawEntry):
+    """An entry of a jsonl dataset, its children are the following lines
+    whose parent is its id"""
+    id: str
+    parent: Optional[str]
+
+
 class Link(TypedDict):
     path: str
     start: int
@@ -34,24 +45,49 @@ class MetaData(TypedDict, total=False):
     keywords: List[str]
     title_embedding: List[float]
     content_embedding: List[float]
+    summary: str
 
 
 class Chunk(RawEntry, MetaData):
+    node_id: str
     chunk_hash: str
     original_hash: str
     chunk_start: int
+    sentence_spans: List[Tuple[int, int]]
     page_content: str
+    lemma_title: str
     lemma_content: str
-    lemma_page_content: str
+    lemma_sentences: List[str]
+    lemma_links: List[str]
+    relation: Dict[str, str]
     first_seen_date: datetime
     parent_content_embedding: List[float]
     parent_title_embedding: List[float]
+
+
+class Node(TypedDict, total=False):
+    """Fields shared by all the chunks of an entry, stored once"""
+    node_id: str
+    relation: str
+    original_hash: str
+    page_content: str
+    lemma_page_content: str
     parent_content: str
     parent_title: str
+    lemma_parent_title: str
+
+
+class StoredNode(TypedDict):
+    original_hash: str
+    ids: List[str]
 
 
 class Indexes(TypedDict):
-    db: Elasticsearch
+    db: Store
+    sentences: SentenceStore
+    ann: Optional[AnnIndex]
+    sparse: Optional[SparseIndex]
+    projection: Optional[Projection]
 
 
 class Answer(TypedDict):
@@ -76,6 +112,7 @@ class Models(TypedDict, total=False):
 class RetrieveOptions(TypedDict):
     retrieve_nb: int
     retrieve_mode: RetrieveMode
+    rescore_window: int
     boost_lem: float
     boost_page_lem: float
     boost_ner: float
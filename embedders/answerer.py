@@ -1,12 +1,16 @@
-from typing import TypedDict
+from typing import Any, List, TypedDict
 
 import torch
 from config import LANGUAGES
-from .config import MODEL_NAMES
+from .backends import create_backend
+from .config import (INFERENCE_BACKEND, MAX_TOKENS, MODEL_NAMES,
+                     QA_MAX_ANSWER_LEN, QA_TOKEN_BUDGET, QUANTIZE)
+from .quantization import load_model
 from datatypes import Answer, Chunk
+from metrics import count, stage
 from transformers import AutoModelForQuestionAnswering as AutoModelQA
 from transformers import AutoTokenizer
-from transformers.pipelines import pipeline
+from utils import pack_batches
 
 
 class Res(TypedDict):
@@ -27,36 +31,56 @@ class Answerer:
     It is used in :func:`~qa.refinder.answer_question`
     """
 
-    def __init__(self, lang: LANGUAGES = 'multi', prefer_gpu: bool = False
+    def __init__(self, lang: LANGUAGES = 'multi', prefer_gpu: bool = False,
+                 quantize: bool = QUANTIZE, backend: str = INFERENCE_BACKEND
                  ) -> None:
 
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAMES[lang])
-        model = AutoModelQA.from_pretrained(MODEL_NAMES[lang])
+        self.device = torch.device("cuda") if (
+            torch.cuda.is_available() and prefer_gpu) else torch.device("cpu")
+        # Quantized kernels only run on cpu
+        quantize = quantize and self.device.type == "cpu"
 
-        DEVICE = 0 if (torch.cuda.is_available() and prefer_gpu) else -1
+        # Fast tokenizer to get the characters offsets of the tokens
+        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAMES[lang],
+                                                       use_fast=True)
+        self.model = load_model(AutoModelQA, MODEL_NAMES[lang], quantize)
+        self.model = self.model.to(self.device).eval()
+        # Start and end logits
+        self.backend = create_backend(backend, self.model, MODEL_NAMES[lang],
+                                      nb_outputs=2)
 
-        self.nlp = pipeline(
-            "question-answering",
-            model=model,
-            tokenizer=tokenizer,
-            framework='pt',
-            device=DEVICE
-        )
-
-        print(f"Answerer will compute on {'cpu' if DEVICE < 0 else 'gpu'}")
+        print(f"Answerer will compute on {self.device}"
+              f"{' (int8)' if quantize else ''}")
 
     def answer(self, question: str, chunk: Chunk) -> Answer:
-        """Give the best sentence in the context answering the question
+        """Give the best span in the chunk answering the question,
+        see :meth:`answer_batch`"""
+        return self.answer_batch(question, [chunk])[0]
+
+    def answer_batch(self, question: str, chunks: List[Chunk]
+                     ) -> List[Answer]:
+        """Give the best span in each chunk answering the question
             Used in :func:`~qa.refinder.answer_question`
         Args:
             question (str)
-            context (str): A paragraph ~1000 characters
+            chunks (List[Chunk]): Chunks with a paragraph ~1000 characters
 
         Returns:
-            Answer
+            List[Answer]: One answer per chunk, in the same order
         """
-        with torch.no_grad():
-            res: Res = self.nlp(question=question, context=chunk['content'])
+        return self.answer_pairs([question] * len(chunks), chunks)
+
+    def answer_pairs(self, questions: List[str], chunks: List[Chunk]
+                     ) -> List[Answer]:
+        """Give the best span in each chunk answering its own question, so
+        several questions can share the same batches"""
+        count('qa_pairs', len(chunks))
+        with stage('qa_spans'):
+            results = self.spans(questions,
+                                 [chunk['content'] for chunk in chunks])
+
+        answers: List[Answer] = []
+        for chunk, res in zip(chunks, results):
             answer: Answer = {
                 'score': res['score'],
                 'content': chunk['content'],
@@ -68,29 +92,89 @@ class Answerer:
                 'elected': 'qa',
                 'link': [li['path'] for li in chunk['links']]
             }
+            answers.append(answer)
             # TODO Move the logic of finding the full sentence here
-        return answer
-
-        # OR to to it by hand and have more control
-
-        # inputs = self.tokenizer(question, context, add_special_tokens=True,
-        #                         return_tensors="pt")
-        # input_ids = inputs["input_ids"].tolist()[0]
+        return answers
 
-        # text_tokens = self.tokenizer.convert_ids_to_tokens(input_ids)
-        # answer_start_scores, answer_end_scores = self.model(**inputs)
+    def spans(self, questions: List[str], contexts: List[str]) -> List[Res]:
+        """Find the best span of each context for its question.
 
-        # answer_start = torch.argmax(answer_start_scores)
-        # answer_end = torch.argmax(answer_end_scores) + 1
-
-        # answer = self.tokenizer.convert_tokens_to_string(
-        #     self.tokenizer.convert_ids_to_tokens(
-        #         input_ids[answer_start:answer_end]
-        #     )
-        # )
-
-        # score = torch.max(answer_end_scores)+torch.max(answer_end_scores) / 2
-        # return {'score': score.item(),
-        #         'start': answer_start,
-        #         'end': answer_end,
-        #         'answer': answer}
+        Pairs are sorted by length and run as padded batches of at most
+        QA_TOKEN_BUDGET tokens. Scoring is the one of the transformers
+        question-answering pipeline : softmax of start and end logits over
+        the context tokens and best start * end with start <= end and at
+        most QA_MAX_ANSWER_LEN tokens. Contexts are truncated to the model
+        size instead of being split in overlapping windows.
+        """
+        if not contexts:
+            return []
+
+        encoded_contexts = self.tokenizer(contexts, add_special_tokens=False,
+                                          return_offsets_mapping=True)
+        question_ids = {question: self.tokenizer.encode(
+            question, add_special_tokens=False) for question in set(questions)}
+
+        input_ids: List[List[int]] = []
+        context_starts: List[int] = []
+        context_lens: List[int] = []
+        for question, context_ids in zip(questions,
+                                         encoded_contexts['input_ids']):
+            # [CLS] question [SEP] (context) [SEP] for bert like models
+            # <s> question </s></s> (context) </s> for roberta like models
+            prefix_len = len(self.tokenizer.build_inputs_with_special_tokens(
+                question_ids[question], [])) - 1
+            context_ids = context_ids[:MAX_TOKENS - prefix_len - 1]
+
+            input_ids.append(self.tokenizer.build_inputs_with_special_tokens(
+                question_ids[question], context_ids))
+            context_starts.append(prefix_len)
+            context_lens.append(len(context_ids))
+
+        results: List[Res] = [None] * len(contexts)  # type: ignore
+        with torch.no_grad():
+            for batch in pack_batches([len(ids) for ids in input_ids],
+                                      QA_TOKEN_BUDGET):
+                tokens = self.tokenizer.pad(
+                    {'input_ids': [input_ids[idx] for idx in batch]},
+                    return_tensors='pt').to(self.device)
+                outputs = self.backend(tokens['input_ids'],
+                                       tokens['attention_mask'])
+                start_logits, end_logits = outputs[0].cpu(), outputs[1].cpu()
+
+                for row, idx in enumerate(batch):
+                    results[idx] = self.decode(
+                        start_logits[row], end_logits[row],
+                        context_starts[idx], context_lens[idx],
+                        encoded_contexts['offset_mapping'][idx],
+                        contexts[idx])
+
+        return results
+
+    @staticmethod
+    def decode(start_logits: torch.Tensor, end_logits: torch.Tensor,
+               context_start: int, context_len: int, offsets: List[Any],
+               context: str) -> Res:
+        """Get the best span from the logits of one question/context pair"""
+        context_end = context_start + context_len
+
+        # Only the CLS and context tokens can contribute to the softmax
+        mask = torch.full_like(start_logits, -10000.0)
+        mask[0] = 0.0
+        mask[context_start:context_end] = 0.0
+        start = (start_logits + mask).softmax(-1)[context_start:context_end]
+        end = (end_logits + mask).softmax(-1)[context_start:context_end]
+
+        if not context_len:
+            return {'answer': '', 'score': 0.0, 'start': 0, 'end': 0}
+
+        candidates = torch.tril(torch.triu(start[:, None] * end[None, :]),
+                                QA_MAX_ANSWER_LEN - 1)
+        best = int(candidates.argmax())
+        span_start, span_end = divmod(best, context_len)
+
+        char_start = offsets[span_start][0]
+        char_end = offsets[span_end][1]
+        return {'answer': context[char_start:char_end],
+                'score': candidates[span_start, span_end].item(),
+                'start': char_start,
+                'end': char_end}
@@ -0,0 +1,166 @@
+"""
+Inference backends of the transformers models : the eager pytorch model or
+a graph exported once (TorchScript trace or ONNX) and cached on disk.
+
+All backends are called with (input_ids, attention_mask) tensors and give
+back the first outputs of the model as a tuple of tensors.
+"""
+import os
+import re
+from typing import Any, List, Tuple
+
+import torch
+
+from .config import BACKEND_CACHE_DIR
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class EagerBackend:
+    """Run the pytorch model as is"""
+
+    name = 'eager'
+
+    def __init__(self, model: torch.nn.Module, nb_outputs: int) -> None:
+        self.model = model
+        self.nb_outputs = nb_outputs
+
+    def __call__(self, input_ids: torch.Tensor, attention_mask: torch.Tensor
+                 ) -> Tuple[torch.Tensor, ...]:
+        outputs = self.model(input_ids=input_ids,
+                             attention_mask=attention_mask)
+        return tuple(outputs[:self.nb_outputs])
+
+
+class FirstOutputs(torch.nn.Module):
+    """Model giving only its first outputs as a tuple, to be exported"""
+
+    def __init__(self, model: torch.nn.Module, nb_outputs: int) -> None:
+        super().__init__()
+        self.model = model
+        self.nb_outputs = nb_outputs
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor
+                ) -> Tuple[torch.Tensor, ...]:
+        outputs = self.model(input_ids=input_ids,
+                             attention_mask=attention_mask)
+        return tuple(outputs[:self.nb_outputs])
+
+
+class TorchScriptBackend:
+    """Run a TorchScript trace of the model, traced once and cached"""
+
+    name = 'torchscript'
+
+    def __init__(self, model: torch.nn.Module, nb_outputs: int, path: str
+                 ) -> None:
+        device = next(model.parameters()).device
+        if os.path.exists(path):
+            self.module = torch.jit.load(path, map_location=device)
+        else:
+            input_ids, attention_mask = example_inputs(device)
+            with torch.no_grad():
+                self.module = torch.jit.trace(
+                    FirstOutputs(model, nb_outputs),
+                    (input_ids, attention_mask), check_trace=False)
+            torch.jit.save(self.module, path)
+        self.module.eval()
+
+    def __call__(self, input_ids: torch.Tensor, attention_mask: torch.Tensor
+                 ) -> Tuple[torch.Tensor, ...]:
+        return tuple(self.module(input_ids, attention_mask))
+
+
+class OnnxBackend:
+    """Run the model exported to ONNX with onnxruntime (cpu), exported once
+    and cached"""
+
+    name = 'onnx'
+
+    def __init__(self, model: torch.nn.Module, nb_outputs: int, path: str
+                 ) -> None:
+        if onnxruntime is None:
+            raise RuntimeError("onnxruntime is not installed")
+
+        self.output_names = [f"output_{i}" for i in range(nb_outputs)]
+        if not os.path.exists(path):
+            axes = {0: 'batch', 1: 'sequence'}
+            torch.onnx.export(
+                FirstOutputs(model, nb_outputs).cpu(), example_inputs(),
+                path, input_names=['input_ids', 'attention_mask'],
+                output_names=self.output_names, opset_version=11,
+                dynamic_axes={name: axes for name in
+                              ['input_ids', 'attention_mask'] +
+                              self.output_names})
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = \
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options)
+
+    def __call__(self, input_ids: torch.Tensor, attention_mask: torch.Tensor
+                 ) -> Tuple[torch.Tensor, ...]:
+        outputs = self.session.run(self.output_names, {
+            'input_ids': input_ids.cpu().numpy(),
+            'attention_mask': attention_mask.cpu().numpy()})
+        return tuple(torch.from_numpy(output).to(input_ids.device)
+                     for output in outputs)
+
+
+def example_inputs(device: Any = 'cpu') -> Tuple[torch.Tensor, torch.Tensor]:
+    input_ids = torch.randint(5, 100, (2, 16), device=device)
+    attention_mask = torch.ones_like(input_ids)
+    return input_ids, attention_mask
+
+
+def create_backend(kind: str, model: torch.nn.Module, model_name: str,
+                   nb_outputs: int, cache_dir: str = BACKEND_CACHE_DIR
+                   ) -> Any:
+    """Backend of the given kind (eager | torchscript | onnx) for the model,
+    falling back to eager pytorch if the export is not possible (like an
+    onnx export of a quantized model)
+
+    Args:
+        kind (str)
+        model (torch.nn.Module): Eager model, in eval mode
+        model_name (str): Name of the pretrained model, for the cache
+        nb_outputs (int): Number of outputs of the model to give back
+    """
+    if kind == 'eager':
+        return EagerBackend(model, nb_outputs)
+
+    # Quantized and fp32 models, on cpu or gpu, give different graphs
+    device = next(model.parameters()).device.type
+    quantized = any(isinstance(module, torch.nn.quantized.dynamic.Linear)
+                    for module in model.modules())
+    variant = re.sub(r'[^\w.-]', '_', f"{model_name}_{type(model).__name__}"
+                     f"_{device}{'_int8' if quantized else ''}")
+    extension = {'torchscript': 'pt', 'onnx': 'onnx'}[kind]
+    path = os.path.join(cache_dir, f"{variant}.{extension}")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    try:
+        if kind == 'torchscript':
+            return TorchScriptBackend(model, nb_outputs, path)
+        return OnnxBackend(model, nb_outputs, path)
+    except Exception as error:  # noqa: B902
+        print(f"Could not use the {kind} backend for {model_name}, "
+              f"falling back to eager pytorch : {error}")
+        return EagerBackend(model, nb_outputs)
+
+
+def max_difference(backend: Any, reference: Any, tokenizer: Any,
+                   texts: List[str], device: Any = 'cpu') -> float:
+    """Maximum absolute difference between the outputs of a backend and of a
+    reference (eager) backend on padded batches of texts"""
+    tokens = tokenizer(texts, padding=True, return_tensors='pt').to(device)
+    with torch.no_grad():
+        outputs = backend(tokens['input_ids'], tokens['attention_mask'])
+        expected = reference(tokens['input_ids'], tokens['attention_mask'])
+
+    mask = tokens['attention_mask'].bool()
+    return max(float((output - target)[mask].abs().max())
+               for output, target in zip(outputs, expected))
@@ -0,0 +1,129 @@
+import fcntl
+import os
+import re
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+from datatypes import EmbeddingMode
+
+from .config import EMBED_CACHE_DIR, EMBED_CACHE_SIZE_MB
+
+KEY_SIZE = 16  # md5 digest of the text, see utils.hash_text
+
+
+class EmbeddingCache:
+    """
+    On disk cache of embeddings, addressed by the hash of the embedded text.
+
+    There is one store per (model, variant, embedding mode), the variant
+    being the precision and inference backend of the model (their vectors
+    differ slightly), made of memory mapped files shared by all the
+    processes using the same model :
+    - ``vectors.f32`` : (capacity, dim) float32 embeddings
+    - ``keys.bin`` : (capacity, 16) md5 digest of the text of each row
+    - ``meta.i64`` : total number of rows ever written
+
+    Rows are written as a ring, so once the store holds ``max_size_mb`` the
+    oldest embeddings are evicted first. Writes are serialized with a lock.
+
+    It is instanciated in :class:`~embedders.embedders.Embedder`
+    """
+
+    def __init__(self, model_name: str, method: EmbeddingMode, dim: int,
+                 variant: str = 'fp32-eager',
+                 max_size_mb: int = EMBED_CACHE_SIZE_MB,
+                 cache_dir: str = EMBED_CACHE_DIR) -> None:
+        self.dim = dim
+        self.path = os.path.join(cache_dir,
+                                 re.sub(r'[^\w.-]', '_', model_name),
+                                 re.sub(r'[^\w.-]', '_', variant), method)
+        os.makedirs(self.path, exist_ok=True)
+
+        capacity = max(1, max_size_mb * 2**20 // (dim * 4 + KEY_SIZE))
+
+        with self.lock():
+            keys_path = os.path.join(self.path, 'keys.bin')
+            if os.path.exists(keys_path):
+                # Keep the capacity of the store if it was already created
+                capacity = os.path.getsize(keys_path) // KEY_SIZE
+                mode = 'r+'
+            else:
+                mode = 'w+'
+
+            self.keys = np.memmap(keys_path, dtype=np.uint8, mode=mode,
+                                  shape=(capacity, KEY_SIZE))
+            self.vectors = np.memmap(os.path.join(self.path, 'vectors.f32'),
+                                     dtype=np.float32, mode=mode,
+                                     shape=(capacity, dim))
+            self.meta = np.memmap(os.path.join(self.path, 'meta.i64'),
+                                  dtype=np.int64, mode=mode, shape=(1,))
+
+        self.capacity = capacity
+        self.slots: Dict[bytes, int] = {}
+        self.seen = 0  # number of written rows already in self.slots
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        with open(os.path.join(self.path, 'lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def refresh(self) -> None:
+        """Update the key -> row mapping with rows written by any process
+        since the last refresh"""
+        written = int(self.meta[0])
+        if written - self.seen >= self.capacity:
+            self.slots = {}
+            self.seen = written - self.capacity
+
+        for position in range(self.seen, written):
+            slot = position % self.capacity
+            self.slots[self.keys[slot].tobytes()] = slot
+        self.seen = written
+
+    def get(self, text_hashes: List[str]) -> Dict[str, List[float]]:
+        """Give the cached embeddings among the requested ones"""
+        self.refresh()
+
+        found: Dict[str, List[float]] = {}
+        for text_hash in text_hashes:
+            key = bytes.fromhex(text_hash)
+            slot = self.slots.get(key)
+            if slot is None:
+                continue
+
+            vector = self.vectors[slot].tolist()
+            # The row may have been evicted by another process meanwhile
+            if self.keys[slot].tobytes() == key:
+                found[text_hash] = vector
+
+        self.hits += len(found)
+        self.misses += len(text_hashes) - len(found)
+        return found
+
+    def put(self, embeddings: Dict[str, List[float]]) -> None:
+        if not embeddings:
+            return
+
+        with self.lock():
+            written = int(self.meta[0])
+            for text_hash, vector in embeddings.items():
+                slot = written % self.capacity
+                # Invalidate the row before overwriting it
+                self.keys[slot] = 0
+                self.vectors[slot] = vector
+                self.keys[slot] = np.frombuffer(bytes.fromhex(text_hash),
+                                                dtype=np.uint8)
+                written += 1
+
+            self.meta[0] = written
+            self.vectors.flush()
+            self.keys.flush()
+            self.meta.flush()
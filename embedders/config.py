@@ -9,3 +9,24 @@ MODEL_NAMES: Dict[LANGUAGES, str] = {
         "qa_fr": 'etalab-ia/camembert-base-squadFR-fquad-piaf',
         "qa_multi": 'deepset/xlm-roberta-large-squad2',
         'sum_fr': "facebook/bart-large-xsum"}
+
+MAX_TOKENS = 512  # maximum number of tokens the transformers can take
+EMBED_TOKEN_BUDGET = 8192  # padded tokens (batch size * length) per batch
+
+EMBED_CACHE_DIR = ".cache/embeddings"  # on disk embedding cache, see cache.py
+EMBED_CACHE_SIZE_MB = 1024  # size per (model, embedding mode) store
+
+QA_TOKEN_BUDGET = 4096  # padded tokens (batch size * length) per qa batch
+QA_MAX_ANSWER_LEN = 15  # maximum number of tokens of an answer span
+
+SUMMARY_INPUT_TOKENS = 1024  # tokens the summarizer takes at once
+SUMMARY_MIN_LENGTH = 50  # minimum number of tokens of a summary
+CHUNK_SUMMARY_MAX_LENGTH = 128  # tokens of the summary of a chunk
+CHUNK_SUMMARY_MIN_WORDS = 60  # shorter chunks are their own summary
+
+QUANTIZE = False  # int8 dynamic quantization of the linear layers (cpu only)
+QUANTIZED_CACHE_DIR = ".cache/quantized"  # see quantization.py
+
+# eager | torchscript | onnx, see backends.py
+INFERENCE_BACKEND = 'eager'
+BACKEND_CACHE_DIR = ".cache/backends"  # exported graphs
@@ -1,11 +1,18 @@
-from typing import List, Literal
+from typing import Dict, List
 
 import torch
 from transformers import AutoModel, AutoTokenizer
 
 from config import LANGUAGES
+from datatypes import EmbeddingMode
+from metrics import count, stage
+from utils import hash_text, pack_batches
 
-from .config import MODEL_NAMES
+from .backends import create_backend
+from .cache import EmbeddingCache
+from .config import (EMBED_TOKEN_BUDGET, INFERENCE_BACKEND, MAX_TOKENS,
+                     MODEL_NAMES, QUANTIZE)
+from .quantization import load_model
 
 
 class Embedder:
@@ -15,28 +22,80 @@ class Embedder:
     It is instanciated in :func:`~indexer.indexer.create_models`
     which is called by :func:`~indexer.indexer.process`
 
-    It is used in :func:`~indexer.metabuilder.embed_chunk`
+    It is used in :func:`~indexer.metabuilder.embed_chunks`
     It is used in :func:`~qa.retriever.retrieve_docs`
+    It is used in :func:`~qa.refinder.answer_question_by_chunks`
     """
 
     def __init__(self, processor, lang: LANGUAGES = 'multi',
-                 prefer_gpu: bool = False) -> None:
+                 prefer_gpu: bool = False, use_cache: bool = True,
+                 quantize: bool = QUANTIZE, backend: str = INFERENCE_BACKEND
+                 ) -> None:
 
         self.device = torch.device("cuda") if (
             torch.cuda.is_available() and prefer_gpu) else torch.device("cpu")
+        # Quantized kernels only run on cpu
+        quantize = quantize and self.device.type == "cpu"
 
-        print(f"Embedder will compute on {self.device}")
+        print(f"Embedder will compute on {self.device}"
+              f"{' (int8)' if quantize else ''}")
         self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAMES[lang])
-        self.model = AutoModel.from_pretrained(MODEL_NAMES[lang])
+        self.model = load_model(AutoModel, MODEL_NAMES[lang], quantize)
         self.model = self.model.to(self.device).eval()
+        self.backend = create_backend(backend, self.model, MODEL_NAMES[lang],
+                                      nb_outputs=1)
         self.processor = processor
 
-    def embed(self, text: str, method: Literal['all', 'sentence']
-              ) -> List[float]:
-        """Embed any text to a vector
+        self.caches: Dict[EmbeddingMode, EmbeddingCache] = {}
+        if use_cache:
+            # int8 and fp32 (or other backends) vectors are not mixed
+            variant = f"{'int8' if quantize else 'fp32'}-{self.backend.name}"
+            self.caches = {
+                method: EmbeddingCache(MODEL_NAMES[lang], method,
+                                       self.model.config.hidden_size,
+                                       variant)
+                for method in ('all', 'sentence')}
+
+    def embed(self, text: str, method: EmbeddingMode) -> List[float]:
+        """Embed any text to a vector, see :meth:`embed_batch`"""
+        return self.embed_batch([text], method)[0]
+
+    def embed_batch(self, texts: List[str], method: EmbeddingMode
+                    ) -> List[List[float]]:
+        """Embed a list of texts to vectors, in the same order as the texts.
+        Each distinct text is embedded once and looked up in the on disk
+        cache first, see :class:`~embedders.cache.EmbeddingCache`
 
         Args:
-            text (str)
+            texts (List[str])
+            method (all or sentence): see :meth:`compute`
+        """
+        text_hashes = [hash_text(text) for text in texts]
+
+        cache = self.caches.get(method)
+        embeddings = cache.get(list(set(text_hashes))) if cache else {}
+        count('embedding_cache_hits', len(embeddings))
+
+        to_compute = {text_hash: text
+                      for text_hash, text in zip(text_hashes, texts)
+                      if text_hash not in embeddings}
+        count('texts_embedded', len(to_compute))
+        with stage(f'embed_{method}'):
+            computed = dict(zip(to_compute.keys(), self.compute(
+                list(to_compute.values()), method)))
+
+        if cache:
+            cache.put(computed)
+        embeddings.update(computed)
+
+        return [embeddings[text_hash] for text_hash in text_hashes]
+
+    def compute(self, texts: List[str], method: EmbeddingMode
+                ) -> List[List[float]]:
+        """Embed a list of texts to vectors, in the same order as the texts
+
+        Args:
+            texts (List[str])
             method (all or sentence): embed all the paragraph
                             or compute the mean of all sentence embeddings
 
@@ -46,40 +105,72 @@ class Embedder:
 
             AssertionError: Check that the method is all or sentence.
         """
-        with torch.no_grad():
-
-            if method == 'all':
-                # Compute all the paragraph at once
-                tokens = self.tokenizer(text, return_tensors='pt',
-                                        add_special_tokens=True)
-                tokens = tokens.to(self.device)
-
-                embeded = self.model(**tokens)[0][0]
-
-                return embeded[0].tolist()
+        if not texts:
+            return []
+
+        if method == 'all':
+            # Compute all the paragraph at once
+            return self.embed_cls(texts).cpu().tolist()
+
+        elif method == 'sentence':
+            # Compute embedding for each sentence and return the mean
+            sentences: List[str] = []
+            owners: List[int] = []
+            for idx, (text, doc) in enumerate(zip(texts,
+                                                  self.processor.pipe(texts))):
+                text_sentences = [sent.text for sent in doc.sents] or [text]
+                sentences.extend(text_sentences)
+                owners.extend([idx] * len(text_sentences))
+
+            sentences_embeded = self.embed_cls(sentences)
+
+            owner_ids = torch.tensor(owners, device=sentences_embeded.device)
+            summed = torch.zeros(len(texts), sentences_embeded.size(1),
+                                 device=sentences_embeded.device)
+            summed.index_add_(0, owner_ids, sentences_embeded)
+            counts = torch.bincount(owner_ids, minlength=len(texts))
+
+            return (summed / counts.unsqueeze(1)).cpu().tolist()
+
+        else:
+            raise AssertionError(
+                "[method] parameter should be all or sentence"
+            )
+
+    def embed_cls(self, texts: List[str]) -> torch.Tensor:
+        """Compute the CLS token of each text.
+
+        Texts are sorted by token length and packed in padded batches holding
+        at most EMBED_TOKEN_BUDGET tokens (padding included), so short texts
+        are not padded to the length of the longest one.
+
+        Returns:
+            torch.Tensor: (len(texts), hidden_size), in the order of texts
+        """
+        input_ids: List[List[int]] = self.tokenizer(
+            texts, add_special_tokens=True)['input_ids']
 
-            elif method == 'sentence':
-                # Compute embedding for each sentence and return the mean
-                sentences = [sent.text for sent in self.processor(text).sents]
-                if not sentences:
-                    sentences = [text]
+        for text, ids in zip(texts, input_ids):
+            if len(ids) > MAX_TOKENS:
+                raise RuntimeError(
+                    f"There is more than {MAX_TOKENS} tokens in the text : "
+                    f"{text}")
 
-                tokens = self.tokenizer(sentences, return_tensors='pt',
-                                        padding=True, add_special_tokens=True)
+        batches = pack_batches([len(ids) for ids in input_ids],
+                               EMBED_TOKEN_BUDGET)
 
+        embeded = torch.empty(len(texts), self.model.config.hidden_size,
+                              device=self.device)
+        with torch.no_grad():
+            for batch in batches:
+                tokens = self.tokenizer.pad(
+                    {'input_ids': [input_ids[idx] for idx in batch]},
+                    return_tensors='pt')
                 tokens = tokens.to(self.device)
 
-                if tokens['input_ids'].size()[1] > 512:
-                    raise RuntimeError(
-                        f"There is more than 512 tokens in the text : {text}"
-                    )
-
-                # Take all the CLS tokens for each sentence
-                sentences_embeded = self.model(**tokens)[0][:, 0, :]
+                # Take all the CLS tokens of the batch
+                embeded[batch] = self.backend(
+                    tokens['input_ids'], tokens['attention_mask']
+                )[0][:, 0, :]
 
-                embeded = torch.mean(sentences_embeded, dim=0).cpu().tolist()
-                return embeded
-            else:
-                raise AssertionError(
-                    "[method] parameter should be all or sentence"
-                )
+        return embeded
@@ -0,0 +1,48 @@
+import os
+import re
+from typing import Any
+
+import torch
+from transformers import AutoConfig
+
+from .config import QUANTIZED_CACHE_DIR
+
+
+def load_model(auto_model: Any, model_name: str, quantize: bool,
+               cache_dir: str = QUANTIZED_CACHE_DIR) -> torch.nn.Module:
+    """Load a pretrained model, with int8 dynamic quantization of its linear
+    layers if asked.
+
+    The quantized weights are saved the first time, later loads only build
+    the quantized architecture and load them (no fp32 weights loading nor
+    conversion).
+
+    Args:
+        auto_model (Any): transformers AutoModel class (AutoModel,
+                          AutoModelForQuestionAnswering...)
+        model_name (str)
+        quantize (bool)
+        cache_dir (str): Where quantized weights are saved
+    """
+    if not quantize:
+        return auto_model.from_pretrained(model_name)
+
+    file_name = re.sub(r'[^\w.-]', '_', f"{model_name}_{auto_model.__name__}")
+    path = os.path.join(cache_dir, f"{file_name}.pt")
+
+    if os.path.exists(path):
+        model = quantize_model(auto_model.from_config(
+            AutoConfig.from_pretrained(model_name)))
+        model.load_state_dict(torch.load(path))
+        return model
+
+    model = quantize_model(auto_model.from_pretrained(model_name))
+    os.makedirs(cache_dir, exist_ok=True)
+    torch.save(model.state_dict(), path)
+    return model
+
+
+def quantize_model(model: torch.nn.Module) -> torch.nn.Module:
+    return torch.quantization.quantize_dynamic(model.eval(),
+                                               {torch.nn.Linear},
+                                               dtype=torch.qint8)
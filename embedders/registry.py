@@ -0,0 +1,76 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Mapping, Optional, Sequence
+
+from config import LANGUAGES
+from metrics import MODEL_LOAD_SECONDS
+
+
+class LazyModels(Mapping):
+    """
+    Models of one role (embedder, answerer...) by language, each one is only
+    loaded the first time it is accessed, from any thread.
+
+    It is instanciated in :func:`~indexer.indexer.create_models`
+    """
+
+    def __init__(self, role: str,
+                 loaders: Dict[LANGUAGES, Callable[[], Any]]) -> None:
+        self.role = role
+        self.loaders = loaders
+        self.models: Dict[LANGUAGES, Any] = {}
+        self.load_times: Dict[LANGUAGES, float] = {}
+        self.locks = {lang: threading.Lock() for lang in loaders}
+
+    def __getitem__(self, lang: LANGUAGES) -> Any:
+        if lang in self.models:
+            return self.models[lang]
+        if lang not in self.loaders:
+            raise KeyError(lang)
+
+        with self.locks[lang]:
+            # May have been loaded by another thread while waiting
+            if lang not in self.models:
+                start = time.time()
+                self.models[lang] = self.loaders[lang]()
+                self.load_times[lang] = time.time() - start
+                MODEL_LOAD_SECONDS.labels(self.role, lang).set(
+                    self.load_times[lang])
+                print(f"{self.role} [{lang}] loaded in "
+                      f"{self.load_times[lang]}s")
+
+        return self.models[lang]
+
+    def __iter__(self) -> Iterator[LANGUAGES]:
+        return iter(self.loaders)
+
+    def __len__(self) -> int:
+        return len(self.loaders)
+
+    def is_loaded(self, lang: LANGUAGES) -> bool:
+        return lang in self.models
+
+
+def prewarm(models: Mapping[str, LazyModels], roles: Sequence[str],
+            background: bool = True) -> Optional[threading.Thread]:
+    """Load all the languages of the given roles, in a background thread
+    unless asked otherwise"""
+    def load() -> None:
+        for role in roles:
+            for lang in models[role]:
+                models[role][lang]
+
+    if not background:
+        load()
+        return None
+
+    thread = threading.Thread(target=load, name="prewarm", daemon=True)
+    thread.start()
+    return thread
+
+
+def load_times(models: Mapping[str, LazyModels]) -> Dict[str, float]:
+    """Loading time in seconds of each model loaded so far"""
+    return {f"{role}_{lang}": duration
+            for role, lazy_models in models.items()
+            for lang, duration in lazy_models.load_times.items()}
@@ -2,9 +2,13 @@ from datetime import datetime
 from typing import List
 
 import torch
-from config import LANGUAGES
-from .config import MODEL_NAMES
+from config import LANGUAGES, SUMMARY_MAX_LENGTH, SUMMARY_SUPPORTS
+from .config import (CHUNK_SUMMARY_MAX_LENGTH, CHUNK_SUMMARY_MIN_WORDS,
+                     MODEL_NAMES, QUANTIZE, SUMMARY_INPUT_TOKENS,
+                     SUMMARY_MIN_LENGTH)
+from .quantization import load_model
 from datatypes import Answer, Chunk
+from metrics import count, stage
 from transformers import AutoModelForSeq2SeqLM as AutoModelSum
 from transformers import AutoTokenizer
 from transformers.pipelines import pipeline
@@ -21,13 +25,15 @@ class Summarizer:
     It is used in :func:`~qa.refinder.answer_question`
     """
 
-    def __init__(self, lang: LANGUAGES = 'multi', prefer_gpu: bool = False
-                 ) -> None:
-
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAMES[lang])
-        model = AutoModelSum.from_pretrained(MODEL_NAMES[lang])
+    def __init__(self, lang: LANGUAGES = 'multi', prefer_gpu: bool = False,
+                 quantize: bool = QUANTIZE) -> None:
 
         DEVICE = 0 if (torch.cuda.is_available() and prefer_gpu) else -1
+        # Quantized kernels only run on cpu
+        quantize = quantize and DEVICE < 0
+
+        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAMES[lang])
+        model = load_model(AutoModelSum, MODEL_NAMES[lang], quantize)
 
         self.summarizer = pipeline(
             "summarization",
@@ -37,10 +43,87 @@ class Summarizer:
             device=DEVICE
         )
 
-        print(f"Summary will be computed on {'cpu' if DEVICE < 0 else 'gpu'}")
+        print(f"Summary will be computed on {'cpu' if DEVICE < 0 else 'gpu'}"
+              f"{' (int8)' if quantize else ''}")
+
+    def generate(self, texts: List[str], max_length: int) -> List[str]:
+        """Summary of each text, generated in one padded batch"""
+        if not texts:
+            return []
+        count('summaries_generated', len(texts))
+        # The pipeline does not truncate, a longer input overflows the
+        # positions of the model
+        texts = [self.truncate(text) for text in texts]
+        with torch.no_grad(), stage('summary_generation'):
+            outputs = self.summarizer(texts,
+                                      min_length=min(SUMMARY_MIN_LENGTH,
+                                                     max_length // 2),
+                                      max_length=max_length)
+        if isinstance(outputs, dict):
+            outputs = [outputs]
+        return [output['summary_text'] for output in outputs]
+
+    def nb_tokens(self, text: str) -> int:
+        return len(self.summarizer.tokenizer(text)['input_ids'])
+
+    def truncate(self, text: str,
+                 max_tokens: int = SUMMARY_INPUT_TOKENS) -> str:
+        """The text cut to its first max_tokens tokens (special tokens
+        included)"""
+        if self.nb_tokens(text) <= max_tokens:
+            return text
+        tokenizer = self.summarizer.tokenizer
+        ids = tokenizer(text, add_special_tokens=False)['input_ids']
+        size = max_tokens - tokenizer.num_special_tokens_to_add()
+        while True:
+            text = tokenizer.decode(ids[:size], skip_special_tokens=True,
+                                    clean_up_tokenization_spaces=False)
+            # Decoding can merge tokens which are split again once encoded
+            if self.nb_tokens(text) <= max_tokens:
+                return text
+            size -= 1
+
+    def summarize_chunks(self, contents: List[str]) -> List[str]:
+        """Summary of the content of each chunk, the short ones are kept
+        as is"""
+        summaries = list(contents)
+        long_ones = [idx for idx, content in enumerate(contents)
+                     if len(content.split()) > CHUNK_SUMMARY_MIN_WORDS]
+        generated = self.generate([contents[idx] for idx in long_ones],
+                                  CHUNK_SUMMARY_MAX_LENGTH)
+        for idx, summary in zip(long_ones, generated):
+            summaries[idx] = summary
+        return summaries
+
+    def group(self, texts: List[str]) -> List[str]:
+        """Join the consecutive texts in groups of at most
+        SUMMARY_INPUT_TOKENS tokens (a longer text is alone in its group)"""
+        groups: List[str] = []
+        size = 0
+        for text in texts:
+            nb_tokens = self.nb_tokens(text)
+            if groups and size + nb_tokens <= SUMMARY_INPUT_TOKENS:
+                groups[-1] += " " + text
+                size += nb_tokens
+            else:
+                groups.append(text)
+                size = nb_tokens
+        return groups
+
+    def summarize(self, supports: List[Chunk],
+                  nb_supports: int = SUMMARY_SUPPORTS,
+                  max_length: int = SUMMARY_MAX_LENGTH) -> Answer:
+        """Map reduce summary of the supports.
 
-    def summarize(self, supports: List[Chunk]) -> Answer:
-        all_text = " ".join([chunk['content'] for chunk in supports[:5]])
+        Map : the summaries of the chunks are the ones stored at index time
+        (see :func:`~indexer.metabuilder.create_metadata`), the missing
+        ones are generated in one batch.
+        Reduce : the summaries are grouped in texts the model can take at
+        once (see :meth:`group`) which are summarized in one batch, until
+        a single text is left to summarize.
+        """
+        supports = supports[:nb_supports]
+        all_text = " ".join([chunk['content'] for chunk in supports])
         if not all_text:
             answer: Answer = {
                 'score': 0.0,
@@ -54,18 +137,37 @@ class Summarizer:
                 'link': ['']
             }
             return answer
-        with torch.no_grad():
-            summary = self.summarizer(all_text, min_length=50, max_length=500)
-            answer: Answer = {
-                'score': 1.0,
-                'content': all_text,
-                'answer': summary,
-                'title': " / ".join([chunk['title'] for chunk in supports[:5]]),
-                'date': datetime.now(),
-                'start': 0,
-                'end': len(summary),
-                'elected': 'n/a',
-                'link': ['']
-            }
+
+        missing = [idx for idx, chunk in enumerate(supports)
+                   if not chunk.get('summary')]
+        count('chunk_summaries_missing', len(missing))
+        computed = dict(zip(missing, self.summarize_chunks(
+            [supports[idx]['content'] for idx in missing])))
+        summaries = [computed[idx] if idx in computed else chunk['summary']
+                     for idx, chunk in enumerate(supports)]
+
+        groups = self.group(summaries)
+        while len(groups) > 1:
+            if len(groups) == len(summaries):
+                # Nothing to merge, the joined text is truncated to
+                # what the model can take (see :meth:`generate`)
+                groups = [" ".join(summaries)]
+                break
+            summaries = self.generate(groups, CHUNK_SUMMARY_MAX_LENGTH)
+            groups = self.group(summaries)
+
+        summary = (summaries[0] if len(summaries) == 1
+                   else self.generate(groups, max_length)[0])
+        answer: Answer = {
+            'score': 1.0,
+            'content': all_text,
+            'answer': summary,
+            'title': " / ".join([chunk['title'] for chunk in supports]),
+            'date': datetime.now(),
+            'start': 0,
+            'end': len(summary),
+            'elected': 'n/a',
+            'link': ['']
+        }
 
         return answer
@@ -0,0 +1,212 @@
+import json
+import os
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+
+from config import ANN_KMEANS_ITERATIONS, ANN_NPROBE, VECTOR_DTYPE
+
+from .sidecar import dequantize, quantize, sidecar_path
+
+EMBEDDING_FIELDS = ['content_embedding', 'title_embedding',
+                    'parent_title_embedding']
+
+# decayDateGauss parameters of the elasticsearch dense retrieval script
+DATE_SCALE = 30 * 24 * 3600.0
+DATE_DECAY = 0.5
+
+
+class AnnIndex:
+    """
+    In process approximate nearest neighbours index (IVF) over the
+    content, title and parent title embeddings of the chunks.
+
+    Each chunk is the concatenation of its three normalized embeddings, so
+    the weighted sum of cosine similarities of the dense retrieval is a
+    single inner product with the concatenation of the weighted normalized
+    question. Chunks are clustered with k-means and stored contiguously by
+    cluster, a search only scans the ANN_NPROBE clusters whose centroids are
+    the closest to the question (exact=True scans all the chunks).
+    Vectors are stored as VECTOR_DTYPE, see :func:`~indexer.sidecar.quantize`
+
+    It is built in :func:`~indexer.indexer.preprocess` and saved next to the
+    index, it is used in :func:`~qa.retriever.retrieve_ann`
+    """
+
+    def __init__(self, ids: List[str], vectors: np.ndarray,
+                 dates: np.ndarray, centroids: np.ndarray,
+                 offsets: np.ndarray, scales: Optional[np.ndarray] = None
+                 ) -> None:
+        self.ids = ids
+        self.vectors = vectors  # (nb chunks, 3 * dim) sorted by cluster
+        # (nb chunks,) scale of the quantized vectors
+        self.scales = (scales if scales is not None
+                       else np.ones(len(ids), np.float32))
+        self.dates = dates  # (nb chunks,) first_seen_date timestamps
+        self.centroids = centroids  # (nb clusters, 3 * dim)
+        self.offsets = offsets  # (nb clusters + 1,) start of each cluster
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, store: Any, db_name: str,
+              nb_clusters: Optional[int] = None, dtype: str = VECTOR_DTYPE
+              ) -> 'AnnIndex':
+        """Read the embeddings of all the chunks of the index and cluster
+        them (by default in 4 * sqrt(nb chunks) clusters)"""
+        ids: List[str] = []
+        vectors: List[np.ndarray] = []
+        dates: List[float] = []
+        for doc_id, source in store.scan(
+                db_name, relation="chunk",
+                fields=EMBEDDING_FIELDS + ['first_seen_date']):
+            ids.append(doc_id)
+            vectors.append(np.concatenate([
+                normalize(np.asarray(source[field], np.float32))
+                for field in EMBEDDING_FIELDS]))
+            dates.append(datetime.fromisoformat(
+                source['first_seen_date']).timestamp())
+
+        if not ids:
+            return cls([], np.zeros((0, 0), np.float32), np.zeros(0),
+                       np.zeros((0, 0), np.float32), np.zeros(1, np.int64))
+
+        matrix = np.stack(vectors)
+        if nb_clusters is None:
+            nb_clusters = int(4 * np.sqrt(len(ids)))
+        centroids, assignments = kmeans(matrix, max(1, nb_clusters))
+
+        order = np.argsort(assignments, kind='stable')
+        offsets = np.searchsorted(assignments[order],
+                                  np.arange(len(centroids) + 1))
+
+        codes, scales = quantize(matrix[order], dtype)
+        return cls([ids[idx] for idx in order], codes,
+                   np.asarray(dates)[order], centroids, offsets, scales)
+
+    def save(self, db_name: str) -> None:
+        path = os.path.join(sidecar_path(db_name), 'ann')
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'vectors.npy'), self.vectors)
+        np.save(os.path.join(path, 'dates.npy'), self.dates)
+        np.save(os.path.join(path, 'centroids.npy'), self.centroids)
+        np.save(os.path.join(path, 'offsets.npy'), self.offsets)
+        np.save(os.path.join(path, 'scales.npy'), self.scales)
+        with open(os.path.join(path, 'ids.json'), 'w') as file:
+            json.dump(self.ids, file)
+
+    @classmethod
+    def load(cls, db_name: str) -> Optional['AnnIndex']:
+        path = os.path.join(sidecar_path(db_name), 'ann')
+        if not os.path.exists(os.path.join(path, 'ids.json')):
+            return None
+
+        with open(os.path.join(path, 'ids.json'), 'r') as file:
+            ids = json.load(file)
+        # Indexes saved before the quantization have no scales
+        scales_path = os.path.join(path, 'scales.npy')
+        return cls(ids,
+                   np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r'),
+                   np.load(os.path.join(path, 'dates.npy')),
+                   np.load(os.path.join(path, 'centroids.npy')),
+                   np.load(os.path.join(path, 'offsets.npy')),
+                   np.load(scales_path) if os.path.exists(scales_path)
+                   else None)
+
+    def search(self, question_embed: List[float], weights: Tuple[float, ...],
+               boost_date: float, k: int, nprobe: int = ANN_NPROBE,
+               exact: bool = False) -> List[Tuple[str, float]]:
+        """Top k chunks for the dense retrieval score :
+            sum of weights[i] * cosine(question, EMBEDDING_FIELDS[i])
+            + boost_date * gaussian decay of the chunk date
+
+        Args:
+            question_embed (List[float])
+            weights (Tuple[float, ...]): one weight per EMBEDDING_FIELDS
+            boost_date (float)
+            k (int): number of chunks to return
+            nprobe (int): number of clusters scanned
+            exact (bool): Scan all the chunks (brute force)
+
+        Returns:
+            List[Tuple[str, float]]: chunks ids and scores, best first
+        """
+        if not self.ids:
+            return []
+
+        question = normalize(np.asarray(question_embed, np.float32))
+        query = np.concatenate([weight * question for weight in weights])
+
+        if exact:
+            candidates = np.arange(len(self.ids))
+        else:
+            clusters = np.argsort(-(self.centroids @ query))[:nprobe]
+            candidates = np.concatenate([
+                np.arange(self.offsets[c], self.offsets[c + 1])
+                for c in clusters])
+
+        scores = dequantize(self.vectors[candidates],
+                            self.scales[candidates]) @ query
+        scores += boost_date * date_decay(self.dates[candidates])
+
+        best = np.argsort(-scores)[:k]
+        return [(self.ids[candidates[idx]], float(scores[idx]))
+                for idx in best]
+
+    def recall(self, question_embeds: List[List[float]],
+               weights: Tuple[float, ...], boost_date: float, k: int,
+               nprobe: int = ANN_NPROBE) -> float:
+        """Fraction of the exact top k found by the approximate search"""
+        found = 0
+        for question_embed in question_embeds:
+            exact = {doc_id for doc_id, _ in self.search(
+                question_embed, weights, boost_date, k, exact=True)}
+            approx = {doc_id for doc_id, _ in self.search(
+                question_embed, weights, boost_date, k, nprobe)}
+            found += len(exact & approx)
+        return found / max(1, k * len(question_embeds))
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def date_decay(timestamps: np.ndarray) -> np.ndarray:
+    """Same as the decayDateGauss of elasticsearch with an origin now and no
+    offset"""
+    sigma_square = -DATE_SCALE ** 2 / (2 * np.log(DATE_DECAY))
+    distance = np.abs(timestamps - datetime.now().timestamp())
+    return np.exp(-distance ** 2 / (2 * sigma_square))
+
+
+def kmeans(vectors: np.ndarray, nb_clusters: int,
+           iterations: int = ANN_KMEANS_ITERATIONS
+           ) -> Tuple[np.ndarray, np.ndarray]:
+    """Spherical k-means (inner product assignment)
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: centroids and cluster of each vector
+    """
+    nb_clusters = min(nb_clusters, len(vectors))
+    rng = np.random.default_rng(0)
+    centroids = vectors[rng.choice(len(vectors), nb_clusters, replace=False)]
+
+    for _ in range(iterations):
+        assignments = assign(vectors, centroids)
+        for cluster in range(nb_clusters):
+            members = vectors[assignments == cluster]
+            if len(members):
+                centroids[cluster] = normalize(members.mean(axis=0))
+
+    return centroids, assign(vectors, centroids)
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray, block: int = 4096
+           ) -> np.ndarray:
+    """Closest centroid of each vector, computed by blocks of vectors"""
+    return np.concatenate([
+        np.argmax(vectors[start:start + block] @ centroids.T, axis=1)
+        for start in range(0, len(vectors), block)])
@@ -0,0 +1,65 @@
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, Iterable, Iterator
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import parallel_bulk
+
+from config import BULK_CHUNK_SIZE, BULK_THREAD_COUNT
+from metrics import STAGE_SECONDS, count
+
+
+@contextmanager
+def relaxed_settings(es: Elasticsearch, db_name: str) -> Iterator[None]:
+    """Disable refresh and replicas while building the index and restore the
+    previous settings afterwards (null restores the elasticsearch default)
+    """
+    settings = es.indices.get_settings(index=db_name)[db_name]['settings']
+    previous = {
+        "refresh_interval": settings['index'].get('refresh_interval'),
+        "number_of_replicas": settings['index'].get('number_of_replicas')
+    }
+
+    es.indices.put_settings(index=db_name, body={
+        "index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+    try:
+        yield
+    finally:
+        es.indices.put_settings(index=db_name, body={"index": previous})
+        es.indices.refresh(index=db_name)
+
+
+def bulk_index(es: Elasticsearch, db_name: str,
+               actions: Iterable[Dict[str, Any]],
+               chunk_size: int = BULK_CHUNK_SIZE,
+               thread_count: int = BULK_THREAD_COUNT,
+               relaxed: bool = False) -> int:
+    """Stream the actions to the bulk api with several requests in flight.
+    Actions are produced lazily so computing the next chunks overlaps with
+    the indexing of the previous ones.
+    With relaxed, refresh and replicas are disabled meanwhile (see
+    :func:`relaxed_settings`), only for an index which is not served yet.
+
+    Returns:
+        int: Number of documents indexed
+    """
+    start = time.time()
+    nb_docs = 0
+
+    with (relaxed_settings(es, db_name) if relaxed else nullcontext()):
+        for ok, info in parallel_bulk(es, actions, index=db_name,
+                                      chunk_size=chunk_size,
+                                      thread_count=thread_count,
+                                      queue_size=thread_count,
+                                      raise_on_error=False):
+            if not ok:
+                count('index_failures')
+                print(f"Failed to index a document : {info}")
+            nb_docs += 1
+
+    duration = time.time() - start
+    count('docs_indexed', nb_docs)
+    STAGE_SECONDS.labels('bulk_index').observe(duration)
+    print(f"{nb_docs} documents indexed in {duration}s "
+          f"({nb_docs / max(duration, 1e-9):.1f} docs/s)")
+    return nb_docs
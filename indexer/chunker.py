@@ -28,28 +28,37 @@ def chunker(entry: RawEntry, models: Models) -> List[Chunk]:
             chunk_len += paragraph_len
 
         else:
-            chunks.append(create_chunk(entry, "".join(chunk_content),
-                                       chunk_offset))
+            chunks.append(create_chunk(entry, chunk_content, chunk_offset))
 
             chunk_content = [paragraph]
             chunk_offset += chunk_len
             chunk_len = paragraph_len
 
     if chunk_content:
-        chunks.append(create_chunk(entry, "".join(chunk_content),
-                                   chunk_offset))
+        chunks.append(create_chunk(entry, chunk_content, chunk_offset))
 
     if len(chunks) < 1:
-        chunks.append(create_chunk(entry, "".join(entry['content']), 0))
+        chunks.append(create_chunk(entry, [entry['content']], 0))
 
     return chunks
 
 
-def create_chunk(entry: RawEntry, content: str, chunk_len: int) -> Chunk:
+def create_chunk(entry: RawEntry, sentences: List[str], chunk_len: int
+                 ) -> Chunk:
     """Add content and it's informations to the chunk"""
     # Copy an entry which is not of type chunk but then add all the fields
     chunk: Chunk = deepcopy(entry)  # type: ignore
+    content = "".join(sentences)
     chunk['content'] = content
+
+    # Keep the sentences boundaries to not split the content again later
+    chunk['sentence_spans'] = []
+    sentence_start = 0
+    for sentence in sentences:
+        chunk['sentence_spans'].append(
+            (sentence_start, sentence_start + len(sentence)))
+        sentence_start += len(sentence)
+
     chunk['chunk_hash'] = hash_text(content)
     chunk['original_hash'] = hash_text(entry['content'])
     chunk['chunk_start'] = chunk_len
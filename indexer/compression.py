@@ -0,0 +1,88 @@
+"""
+Projection (PCA) of the chunks embeddings indexed in elasticsearch to a
+lower dimension, fitted on the first chunks of the index.
+The vectors of the sidecar files are quantized, see
+:func:`~indexer.sidecar.quantize`
+"""
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .sidecar import sidecar_path
+
+# Embeddings of a chunk indexed as elasticsearch dense vectors
+VECTOR_FIELDS = ['title_embedding', 'content_embedding',
+                 'parent_title_embedding', 'parent_content_embedding']
+
+
+class Projection:
+    """
+    Linear projection of the embeddings on their main components (PCA).
+
+    It is fitted while a new index is built (see :func:`fit_projection`)
+    and saved next to it. Chunks embeddings are projected before being
+    indexed and questions embeddings before querying the index, so
+    elasticsearch stores and scores smaller vectors.
+
+    It is loaded in :func:`~indexer.indexer.create_indexes`
+    It is used in :func:`~indexer.indexer.index_action`
+    It is used in :func:`~qa.retriever.retrieve_docs`
+    """
+
+    def __init__(self, mean: np.ndarray, components: np.ndarray) -> None:
+        self.mean = mean  # (dim,)
+        self.components = components  # (dim, projected dim)
+
+    @property
+    def dim(self) -> int:
+        return self.components.shape[1]
+
+    @classmethod
+    def fit(cls, vectors: np.ndarray, dim: int) -> 'Projection':
+        mean = vectors.mean(axis=0)
+        # Right singular vectors are the principal components
+        _, _, components = np.linalg.svd(vectors - mean, full_matrices=False)
+        components = components[:dim].T
+        # Less vectors than dimensions, the missing components are null
+        components = np.pad(components,
+                            ((0, 0), (0, dim - components.shape[1])))
+        return cls(mean.astype(np.float32), components.astype(np.float32))
+
+    def __call__(self, vector: List[float]) -> List[float]:
+        return ((np.asarray(vector, np.float32) - self.mean)
+                @ self.components).tolist()
+
+    def save(self, db_name: str) -> None:
+        np.savez(os.path.join(sidecar_path(db_name), 'projection.npz'),
+                 mean=self.mean, components=self.components)
+
+    @classmethod
+    def load(cls, db_name: str) -> Optional['Projection']:
+        path = os.path.join(sidecar_path(db_name), 'projection.npz')
+        if not os.path.exists(path):
+            return None
+        stored = np.load(path)
+        return cls(stored['mean'], stored['components'])
+
+
+def fit_projection(chunks_sources: List[Dict[str, Any]], dim: int
+                   ) -> Optional[Projection]:
+    """Projection fitted on the title and content embeddings of the chunks,
+    None if there are none or they are already small enough"""
+    vectors = np.asarray([source[field] for source in chunks_sources
+                          for field in ('title_embedding',
+                                        'content_embedding')],
+                         dtype=np.float32)
+    if not len(vectors) or vectors.shape[1] <= dim:
+        return None
+    return Projection.fit(vectors, dim)
+
+
+def project_fields(fields: Dict[str, Any], projection: Optional[Projection]
+                   ) -> Dict[str, Any]:
+    """Copy of the fields with their embeddings projected"""
+    if projection is None:
+        return fields
+    return {k: projection(v) if k in VECTOR_FIELDS else v
+            for k, v in fields.items()}
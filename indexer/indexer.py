@@ -1,117 +1,452 @@
 
 import time
 from datetime import datetime
-from typing import Any, Dict, List, Tuple, cast
+from itertools import chain
+from functools import partial
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Sequence,
+                    Set, Tuple, Union, cast)
 
-import elasticsearch
 import numpy as np
 import spacy
-from config import EMBED_DIM, LANGUAGES, SPACY_MODEL_NAMES
-from datatypes import Chunk, Indexes, Models, RawEntry
+from config import (BUILD_WORKERS, CHUNK_SUMMARIES, EMBED_PROJECTION_DIM,
+                    LANGUAGES, PROJECTION_FIT_SIZE, SPACY_MODEL_NAMES,
+                    STORAGE_BACKEND)
+from datatypes import (Chunk, FlatEntry, Indexes, Link, Models, Node,
+                       RawEntry, StoredNode)
 from embedders.answerer import Answerer
+from embedders.config import MODEL_NAMES
 from embedders.embedders import Embedder
+from embedders.registry import LazyModels, prewarm
 from embedders.summarizer import Summarizer
-from utils import remove_links, sanitize_text, get_keylemmas
+from metrics import count, stage
+from transformers import AutoConfig
+from utils import get_keylemmas, hash_text, remove_links, sanitize_text
 
 
+from .ann import AnnIndex
 from .chunker import chunker
+from .compression import Projection, fit_projection, project_fields
 from .metabuilder import create_metadata
+from .parallel import iter_entries_parallel
+from .sidecar import SentenceStore, bump_generation
+from .sparse import SparseIndex
+from .storage import Store, create_store
+from .stream import flatten, iter_entries_stream, unflatten
 
 
 def recurse_add(db_name: str, raw_entry: RawEntry, level: int,
                 indexes: Indexes, models: Models,
                 parents: List[Chunk] = []) -> None:
-    # Clean entry
+    """Index the entry and its children one document at a time"""
+    entries = iter_entries(db_name, raw_entry, level, models, parents)
+    for node, chunks in prefit_projection(db_name, indexes, entries):
+        for action in entry_actions(node, chunks, indexes):
+            indexes['db'].index(db_name, action['_id'], action['_source'],
+                                routing=action.get('_routing'))
+    indexes['sentences'].flush()
+    bump_generation(db_name)
+
+
+def bulk_add(db_name: str, raw_entry: RawEntry, indexes: Indexes,
+             models: Models) -> int:
+    """Index the entry and its children with the bulk api of the store,
+    see :meth:`~indexer.storage.Store.bulk`"""
+    return add_entries(db_name, indexes,
+                       iter_entries(db_name, raw_entry, 0, models, []))
+
+
+def parallel_add(db_name: str, entries: Iterable[FlatEntry],
+                 indexes: Indexes, workers: int) -> int:
+    """Same as :func:`stream_add` with the chunks computed by a pool of
+    processes, see :func:`~indexer.parallel.iter_entries_parallel`"""
+    return add_entries(db_name, indexes,
+                       iter_entries_parallel(db_name, entries, workers))
+
+
+def stream_add(db_name: str, entries: Iterable[FlatEntry], indexes: Indexes,
+               models: Models) -> int:
+    """Same as :func:`bulk_add` from a stream of entries, see
+    :func:`~indexer.stream.iter_entries_stream`"""
+    return add_entries(db_name, indexes,
+                       iter_entries_stream(db_name, entries, models))
+
+
+def add_entries(db_name: str, indexes: Indexes,
+                entries: Iterable[Tuple[Node, List[Chunk]]]) -> int:
+    actions = (action for node, chunks in prefit_projection(
+                   db_name, indexes, entries)
+               for action in entry_actions(node, chunks, indexes))
+    # A new index is not served yet, see indexer.bulk.relaxed_settings
+    nb_docs = indexes['db'].bulk(db_name, actions, relaxed=True)
+    indexes['sentences'].flush()
+    bump_generation(db_name)
+    return nb_docs
+
+
+def prefit_projection(db_name: str, indexes: Indexes,
+                      entries: Iterable[Tuple[Node, List[Chunk]]]
+                      ) -> Iterator[Tuple[Node, List[Chunk]]]:
+    """Fit the projection of a new index on its first PROJECTION_FIT_SIZE
+    chunks (held back until then), see :class:`~indexer.compression.Projection`
+    """
+    entries = iter(entries)
+    if EMBED_PROJECTION_DIM is None or indexes['projection'] is not None:
+        return entries
+
+    first: List[Tuple[Node, List[Chunk]]] = []
+    nb_chunks = 0
+    for node, chunks in entries:
+        first.append((node, chunks))
+        nb_chunks += len(chunks)
+        if nb_chunks >= PROJECTION_FIT_SIZE:
+            break
+
+    projection = fit_projection(
+        [chunk for _, chunks in first for chunk in chunks],  # type: ignore
+        EMBED_PROJECTION_DIM)
+    if projection is not None:
+        projection.save(db_name)
+    indexes['projection'] = projection
+
+    return chain(first, entries)
+
+
+def entry_actions(node: Node, chunks: List[Chunk], indexes: Indexes
+                  ) -> Iterator[Dict[str, Any]]:
+    """Bulk actions indexing the node of an entry and its chunks (the ones
+    which are not only the title)"""
+    yield node_action(node)
+    for chunk in chunks:
+        if chunk['content'] != chunk['title']:
+            yield index_action(chunk, indexes)
+
+
+def node_action(node: Node) -> Dict[str, Any]:
+    return {"_id": node_doc_id(node['node_id']), "_source": node}
+
+
+def index_action(chunk: Chunk, indexes: Indexes) -> Dict[str, Any]:
+    """Bulk action indexing the chunk, the embeddings of its sentences are
+    not indexed but written to the sentences sidecar store.
+    Chunks are children of their node so they are routed to its shard"""
+    source = project_fields(
+        {k: v for k, v in chunk.items() if k != 'sentence_embeddings'},
+        indexes['projection'])
+    indexes['sentences'].add(chunk['chunk_hash'],
+                             chunk['sentence_embeddings'])
+    return {"_id": chunk['chunk_hash'], "_source": source,
+            "_routing": node_doc_id(chunk['node_id'])}
+
+
+def iter_entries(db_name: str, raw_entry: RawEntry, level: int,
+                 models: Models, parents: List[Chunk]
+                 ) -> Iterator[Tuple[Node, List[Chunk]]]:
+    """Clean, chunk and compute the metadatas of the entry and then of its
+    children (depth first) yielding the node and the chunks of each entry"""
+    links = clean_entry(raw_entry)
+    current_parents = build_chunks(db_name, raw_entry, links, models, parents)
+    yield build_node(raw_entry, parents, models), current_parents
+
+    for child in raw_entry.get('children', []):
+        yield from iter_entries(db_name, child, parents=current_parents,
+                                models=models, level=level+1)
+
+
+def clean_entry(raw_entry: RawEntry) -> List[Link]:
+    """Sanitize the entry title and content in place and return the links
+    removed from the content"""
     raw_entry['content'], links = remove_links(raw_entry['content'])
     raw_entry['title'] = sanitize_text(raw_entry['title'])
     raw_entry['content'] = sanitize_text(raw_entry['content'])
+    return links
+
+
+def build_chunks(db_name: str, raw_entry: RawEntry, links: List[Link],
+                 models: Models, parents: List[Chunk],
+                 summarize: bool = CHUNK_SUMMARIES) -> List[Chunk]:
+    """Chunk an already cleaned entry and compute the metadatas of all its
+    chunks (even the ones not indexed as they are only the title).
+    Chunks only needed as parents are built with summarize=False"""
     first_seen_date = datetime.strptime(raw_entry['first_seen_date'],
                                         "%m/%d/%Y")
 
     # Chunk entry content
-    current_parents: List[Chunk] = []
-    for chunk in chunker(raw_entry, models):
+    with stage('chunker'):
+        chunks = chunker(raw_entry, models)
+    count('chunks_built', len(chunks))
+    with stage('create_metadata'):
+        all_metadatas = create_metadata(chunks, links, models,
+                                        db_name.split('_')[1], summarize)
+
+    processor = models["processor"]["fr"]
+    lemma_title = " ".join(get_keylemmas(raw_entry['title'], processor))
+    # Same for all the chunks of the entry
+    current_node_id = node_id(raw_entry)
+    relation = {"name": "chunk", "parent": node_doc_id(current_node_id)}
+    fields = parent_fields(parents,
+                           len(all_metadatas[0]['content_embedding']))
+
+    # Embed all the sentences of the entry at once for the refinder
+    embedder = models['embedder'].get(raw_entry['language'],
+                                      models['embedder']['fr'])
+    sentences_embeddings = iter(embedder.embed_batch(
+        [chunk['content'][start:end]
+         for chunk in chunks for start, end in chunk['sentence_spans']],
+        "sentence"))
+
+    for chunk, metadatas in zip(chunks, all_metadatas):
         chunk.pop('children', None)
+        chunk['node_id'] = current_node_id
+        chunk['relation'] = relation
         chunk['first_seen_date'] = first_seen_date
-        chunk['page_content'] = raw_entry['content']
+        chunk['lemma_title'] = lemma_title
         chunk['lemma_content'] = " ".join(get_keylemmas(
-            chunk['content'], models["processor"]["fr"]))
-        chunk['lemma_page_content'] = " ".join(
-            get_keylemmas(chunk['page_content'], models["processor"]["fr"]))
+            chunk['content'], processor))
 
-        metadatas = create_metadata(chunk, links, models,
-                                    db_name.split('_')[1])
+        # Precompute what the refinder needs from the document
+        chunk['lemma_sentences'] = [
+            " ".join(get_keylemmas(chunk['content'][start:end], processor))
+            for start, end in chunk['sentence_spans']]
 
         chunk.update(metadatas)  # type: ignore
-
-        if parents:
-            chunk['parent_content_embedding'] = np.sum(
+        chunk['lemma_links'] = [
+            " ".join(get_keylemmas(link['name'], processor))
+            for link in chunk['links']]
+
+        chunk.update(fields)  # type: ignore
+
+        # Not indexed, see index_action
+        chunk['sentence_embeddings'] = [next(sentences_embeddings)
+                                        for _ in chunk['sentence_spans']]
+
+    return chunks
+
+
+def build_node(raw_entry: RawEntry, parents: List[Chunk], models: Models
+               ) -> Node:
+    """The fields shared by all the chunks of an entry, indexed once as the
+    parent document of its chunks (see the relation join field)"""
+    processor = models["processor"]["fr"]
+    node: Node = {
+        'node_id': node_id(raw_entry),
+        'relation': "node",
+        'original_hash': hash_text(raw_entry['content']),
+        'page_content': raw_entry['content'],
+        'lemma_page_content': " ".join(get_keylemmas(raw_entry['content'],
+                                                     processor)),
+    }
+    node.update(node_parent_fields(parents))  # type: ignore
+    return node
+
+
+def node_parent_fields(parents: List[Chunk]) -> Dict[str, Any]:
+    """Fields of a node derived from the chunks of its parent entry"""
+    if not parents:
+        return {}
+    return {'parent_content': " ".join([p['content'] for p in parents]),
+            'parent_title': parents[0]['title'],
+            'lemma_parent_title': parents[0]['lemma_title']}
+
+
+def parent_fields(parents: List[Chunk], dim: int) -> Dict[str, Any]:
+    """Fields of a chunk derived from the chunks of its parent entry"""
+    if parents:
+        return {
+            'parent_content_embedding': np.sum(
                 np.array([p['content_embedding'] for p in parents]), axis=0
-            ).tolist()
-
-            chunk['parent_title_embedding'] = np.sum(
+            ).tolist(),
+            'parent_title_embedding': np.sum(
                 np.array([p['title_embedding'] for p in parents]), axis=0
-            ).tolist()
-
-            chunk['parent_content'] = " ".join([p['content'] for p in parents])
-            chunk['parent_title'] = parents[0]['title']
+            ).tolist(),
+        }
 
-        else:
-            chunk['parent_content_embedding'] = np.full(EMBED_DIM,
-                                                        np.finfo(float).eps
-                                                        ).tolist()
-            chunk['parent_title_embedding'] = np.full(EMBED_DIM,
-                                                      np.finfo(float).eps
-                                                      ).tolist()
+    return {
+        'parent_content_embedding': np.full(dim,
+                                            np.finfo(float).eps).tolist(),
+        'parent_title_embedding': np.full(dim,
+                                          np.finfo(float).eps).tolist()
+    }
+
+
+def node_id(raw_entry: RawEntry) -> str:
+    """Identify an entry of the tree across updates of its content"""
+    return hash_text(raw_entry['path'] + raw_entry['title'])
+
+
+def node_doc_id(node_id: str) -> str:
+    """Id of the document of the node, parent of the chunks of the entry"""
+    return f"node_{node_id}"
+
+
+def update_add(db_name: str, raw_entry: RawEntry, indexes: Indexes,
+               models: Models) -> int:
+    """Update the index with a new version of the entries tree, only
+    recomputing what changed, see :func:`iter_updates`"""
+    stored = stored_nodes(indexes['db'], db_name)
+    seen: Set[str] = set()
+
+    def iter_removed() -> Iterator[Dict[str, Any]]:
+        # Only known once the whole tree has been walked
+        for removed_id in stored.keys() - seen:
+            routing = node_doc_id(removed_id)
+            for chunk_id in stored[removed_id]['ids']:
+                indexes['sentences'].remove(chunk_id)
+                yield {"_op_type": "delete", "_id": chunk_id,
+                       "_routing": routing}
+            yield {"_op_type": "delete", "_id": routing}
+
+    actions = iter_updates(db_name, raw_entry, 0, models, stored, seen,
+                           indexes, get_parents=lambda: [],
+                           parent_changed=False)
+
+    nb_docs = indexes['db'].bulk(db_name, chain(actions, iter_removed()))
+    indexes['sentences'].flush()
+    bump_generation(db_name)
+    return nb_docs
+
+
+def stored_nodes(store: Store, db_name: str) -> Dict[str, StoredNode]:
+    """Hash of the content and chunks ids of each entry already indexed"""
+    stored: Dict[str, StoredNode] = {}
+    for doc_id, source in store.scan(db_name, fields=[
+            'node_id', 'path', 'title', 'original_hash', 'relation']):
+        # Chunks indexed before the node_id field existed
+        stored_id = source.get('node_id') or node_id(source)
+        node = stored.setdefault(stored_id, {
+            'original_hash': source['original_hash'], 'ids': []})
+        if source.get('relation') != "node":
+            node['ids'].append(doc_id)
+
+    return stored
+
+
+def iter_updates(db_name: str, raw_entry: RawEntry, level: int,
+                 models: Models, stored: Dict[str, StoredNode],
+                 seen: Set[str], indexes: Indexes,
+                 get_parents: Callable[[], List[Chunk]],
+                 parent_changed: bool) -> Iterator[Dict[str, Any]]:
+    """Walk the entries tree (depth first) yielding bulk actions for :
+    - entries which are new or whose content changed : re-chunk, re-embed,
+      upsert the node and the chunks and delete the chunks that disappeared
+    - entries whose parent changed : update the parent fields of the node
+      and of the chunks
+    - entries which did not change : nothing
+
+    Chunks of unchanged entries are only computed when needed as parents of
+    a changed child (embeddings then come from the embedding cache).
+    """
+    links = clean_entry(raw_entry)
+    current_id = node_id(raw_entry)
+    seen.add(current_id)
+
+    stored_node = stored.get(current_id)
+    changed = (stored_node is None or stored_node['original_hash']
+               != hash_text(raw_entry['content']))
 
-        current_parents.append(chunk)
+    current_parents: List[Chunk] = []
 
-        if chunk['content'] != chunk['title']:
-            indexes['db'].index(index=db_name,
-                                id=chunk['chunk_hash'],
-                                body=chunk)
+    def get_current_parents() -> List[Chunk]:
+        # Chunks of an unchanged entry are not indexed, only the parent
+        # fields of its children need them, so they are not summarized
+        if not current_parents:
+            current_parents.extend(build_chunks(
+                db_name, raw_entry, links, models, get_parents(),
+                summarize=changed and CHUNK_SUMMARIES))
+        return current_parents
+
+    routing = node_doc_id(current_id)
+
+    if changed:
+        new_ids = set()
+        for action in entry_actions(
+                build_node(raw_entry, get_parents(), models),
+                get_current_parents(), indexes):
+            new_ids.add(action['_id'])
+            yield action
+
+        for chunk_id in (stored_node['ids'] if stored_node else []):
+            if chunk_id not in new_ids:
+                indexes['sentences'].remove(chunk_id)
+                yield {"_op_type": "delete", "_id": chunk_id,
+                       "_routing": routing}
+
+    elif parent_changed and stored_node:
+        parents = get_parents()
+        yield {"_op_type": "update", "_id": routing,
+               "doc": node_parent_fields(parents)}
+
+        fields = project_fields(
+            parent_fields(parents, len(parents[0]['content_embedding'])),
+            indexes['projection'])
+        for chunk_id in stored_node['ids']:
+            yield {"_op_type": "update", "_id": chunk_id,
+                   "_routing": routing, "doc": fields}
 
     for child in raw_entry.get('children', []):
-        recurse_add(db_name, child, parents=current_parents,
-                    indexes=indexes, models=models, level=level+1)
-
-
-def create_models(langs: List[LANGUAGES]) -> Models:
-    processor: Dict[LANGUAGES, Any] = {}
-
-    for lang, model in SPACY_MODEL_NAMES.items():
-        if lang in langs:
-            nlp = spacy.load(model)
-            nlp.add_pipe("sentencizer", first=True)
+        yield from iter_updates(db_name, child, level + 1, models, stored,
+                                seen, indexes,
+                                get_parents=get_current_parents,
+                                parent_changed=changed)
+
+
+def create_models(langs: List[LANGUAGES], prewarm_roles: Sequence[str] = ()
+                  ) -> Models:
+    """Models are only loaded when first used, see
+    :class:`~embedders.registry.LazyModels`. The ones of prewarm_roles are
+    loaded in a background thread right away."""
+    processor = LazyModels("processor", {
+        lang: partial(load_processor, model)
+        for lang, model in SPACY_MODEL_NAMES.items() if lang in langs})
+
+    embedder = LazyModels("embedder", {
+        lang: partial(lambda lang: Embedder(processor[lang], lang, True),
+                      lang)
+        for lang in langs})
+    answerer = LazyModels("answerer", {
+        lang: partial(Answerer, cast(LANGUAGES, f'qa_{lang}'))
+        for lang in langs})
+    summarizer = LazyModels("summarizer", {
+        lang: partial(Summarizer, cast(LANGUAGES, f'sum_{lang}'), True)
+        for lang in langs})
+
+    models: Models = cast(Models, {
+        "embedder": embedder, "answerer": answerer,
+        "processor": processor, "summarizer": summarizer})
+
+    if prewarm_roles:
+        prewarm(cast(Dict[str, LazyModels], models), prewarm_roles)
 
-            processor.update(cast(Dict[LANGUAGES, Any], {lang: nlp}))
-
-    embedder: Dict[LANGUAGES, Embedder] = {}
-    answerer: Dict[LANGUAGES, Answerer] = {}
-    summarizer: Dict[LANGUAGES, Summarizer] = {}
-
-    for lang in langs:
-        embedder.update({lang: Embedder(processor[lang], lang, True)})
-        answerer.update({lang: Answerer(cast(LANGUAGES, f'qa_{lang}'))})
-        summarizer.update(
-            {lang: Summarizer(cast(LANGUAGES, f'sum_{lang}'), True)})
+    return models
 
-    models: Models = {"embedder": embedder, "answerer": answerer,
-                      "processor": processor, "summarizer": summarizer}
 
-    return models
+def load_processor(model: str) -> Any:
+    nlp = spacy.load(model)
+    nlp.add_pipe("sentencizer", first=True)
+    return nlp
 
 
-def create_indexes(db_name: str) -> Tuple[Indexes, bool]:
+def create_indexes(db_name: str, models: Models,
+                   backend: str = STORAGE_BACKEND) -> Tuple[Indexes, bool]:
+    """Open the indexes of db_name in the storage backend (elasticsearch or
+    local, see :func:`~indexer.storage.create_store`), creating it if needed
+    """
     need_creation = False
 
-    es = elasticsearch.Elasticsearch()
+    store = create_store(backend)
 
-    indexes: Indexes = {"db": es}
+    indexes: Indexes = {"db": store, "sentences": SentenceStore(db_name),
+                        "ann": AnnIndex.load(db_name),
+                        "sparse": SparseIndex.load(db_name),
+                        "projection": Projection.load(db_name)}
 
-    if not es.indices.exists(index=db_name):
+    if not store.exists(db_name):
+        embed_dim = vector_dim(models)
         index_body = {
             "settings": {
+                # Chunks are routed to the shard of their node, but the ANN
+                # and BM25 sidecars fetch them by id only (mget without
+                # routing), which finds them only with a single shard
+                "number_of_shards": 1,
                 "analysis": {
                     "analyzer": {
                         "default": {
@@ -128,51 +463,133 @@ def create_indexes(db_name: str) -> Tuple[Indexes, bool]:
                 "properties": {
                     "title_embedding": {
                         "type": "dense_vector",
-                        "dims": EMBED_DIM
+                        "dims": embed_dim
                     },
                     "content_embedding": {
                         "type": "dense_vector",
-                        "dims": EMBED_DIM
+                        "dims": embed_dim
                     },
                     "parent_content_embedding": {
                         "type": "dense_vector",
-                        "dims": EMBED_DIM
+                        "dims": embed_dim
                     },
                     "parent_title_embedding": {
                         "type": "dense_vector",
-                        "dims": EMBED_DIM
+                        "dims": embed_dim
                     },
                     "keywords": {"type": "keyword"},
+                    "node_id": {"type": "keyword"},
+                    "sentence_spans": {"type": "integer", "index": False},
+                    "lemma_title": {"type": "text"},
+                    "lemma_sentences": {"type": "text", "index": False},
+                    "lemma_links": {"type": "text", "index": False},
+                    "summary": {"type": "text", "index": False},
                     "title": {"type": "text"},
                     "content": {"type": "text"},
+                    # Chunks are children of the node of their entry
+                    "relation": {"type": "join",
+                                 "relations": {"node": "chunk"}},
+                    # Fields of the nodes, see build_node
+                    "page_content": {"type": "text"},
+                    "lemma_page_content": {"type": "text"},
                     "parent_content": {"type": "text"},
                     "parent_title": {"type": "text"},
+                    "lemma_parent_title": {"type": "text"},
                     "original_content": {"type": "text"},
                     "first_seen_date": {"type": "date"},
                 }
             }
         }
 
-        es.indices.create(index=db_name, ignore=400, body=index_body)
+        store.create(db_name, index_body)
         need_creation = True
 
     return indexes, need_creation
 
 
-def preprocess(db_name: str, raw_entry: RawEntry) -> Tuple[Indexes, Models]:
+def vector_dim(models: Models) -> int:
+    """Dimension of the embeddings indexed in the store, the one of the
+    projection if any (see :func:`prefit_projection`). The dimension of the
+    model is read from its config unless it is already loaded, so the
+    embedder stays lazy"""
+    embedders = models['embedder']
+    if isinstance(embedders, LazyModels) and not embedders.is_loaded('fr'):
+        model_dim = AutoConfig.from_pretrained(MODEL_NAMES['fr']).hidden_size
+    else:
+        model_dim = embedders['fr'].model.config.hidden_size
+    if EMBED_PROJECTION_DIM is None:
+        return model_dim
+    return min(EMBED_PROJECTION_DIM, model_dim)
+
+
+def build_ann(db_name: str, indexes: Indexes) -> None:
+    """(Re)build the ANN index from the chunks of the index and save it"""
+    start = time.time()
+    with stage('build_ann'):
+        indexes['ann'] = AnnIndex.build(indexes['db'], db_name)
+    indexes['ann'].save(db_name)
+    bump_generation(db_name)
+    print(f"ANN index of {len(indexes['ann'])} chunks built in "
+          f"{time.time()-start}s")
+
+
+def build_sparse(db_name: str, indexes: Indexes) -> None:
+    """(Re)build the BM25 index from the lemma fields of the index and save
+    it"""
     start = time.time()
-    models = create_models(['fr'])
+    with stage('build_sparse'):
+        indexes['sparse'] = SparseIndex.build(indexes['db'], db_name)
+    indexes['sparse'].save(db_name)
+    bump_generation(db_name)
+    print(f"BM25 index of {len(indexes['sparse'])} chunks built in "
+          f"{time.time()-start}s")
+
+
+def preprocess(db_name: str, raw_entry: Union[RawEntry, Iterable[FlatEntry]],
+               bulk: bool = True, update: bool = False,
+               prewarm_roles: Sequence[str] = (),
+               workers: int = BUILD_WORKERS) -> Tuple[Indexes, Models]:
+    """Create the models and the indexes, and fill the indexes if they were
+    just created (or update them).
+
+    raw_entry is either the whole tree or a stream of entries, see
+    :func:`~indexer.stream.read_entries`, which is indexed while it is read
+    """
+    start = time.time()
+    models = create_models(['fr'], prewarm_roles)
     print(f"Models created in {time.time()-start}s")
 
     start = time.time()
-    indexes, need_creation = create_indexes(db_name)
+    indexes, need_creation = create_indexes(db_name, models)
     print(f"Indexes created in {time.time()-start}s")
 
     if need_creation:
         print("Doing all : need creation")
         start = time.time()
-        recurse_add(db_name, raw_entry, parents=[], level=0,
-                    indexes=indexes, models=models)
+        if workers > 1:
+            parallel_add(db_name, flatten(raw_entry)
+                         if isinstance(raw_entry, dict) else raw_entry,
+                         indexes=indexes, workers=workers)
+        elif not isinstance(raw_entry, dict):
+            stream_add(db_name, raw_entry, indexes=indexes, models=models)
+        elif bulk:
+            bulk_add(db_name, raw_entry, indexes=indexes, models=models)
+        else:
+            recurse_add(db_name, raw_entry, parents=[], level=0,
+                        indexes=indexes, models=models)
         print(f"Entries added in {time.time()-start}s")
 
+    elif update:
+        print("Updating : index already exists")
+        start = time.time()
+        if not isinstance(raw_entry, dict):
+            raw_entry = unflatten(raw_entry)
+        update_add(db_name, raw_entry, indexes=indexes, models=models)
+        print(f"Entries updated in {time.time()-start}s")
+
+    if need_creation or update or indexes['ann'] is None:
+        build_ann(db_name, indexes)
+    if need_creation or update or indexes['sparse'] is None:
+        build_sparse(db_name, indexes)
+
     return indexes, models
@@ -1,43 +1,72 @@
 from typing import Dict, List, Tuple
 
-from config import LANGUAGES
+from config import CHUNK_SUMMARIES, LANGUAGES
 from datatypes import Chunk, Link, MetaData, Models, EmbeddingMode
 from embedders.embedders import Embedder
+from metrics import stage
 
 
-def create_metadata(chunk: Chunk, links: List[Link], models: Models,
-                    method: EmbeddingMode) -> MetaData:
+def create_metadata(chunks: List[Chunk], links: List[Link], models: Models,
+                    method: EmbeddingMode, summarize: bool = CHUNK_SUMMARIES
+                    ) -> List[MetaData]:
     """
-    Compute all the necessary infos to add to the chunk (like embeddings,
-    keywords, summary etc...)
+    Compute all the necessary infos to add to the chunks of an entry (like
+    embeddings, keywords, summary etc...), the summary only if summarize
     """
 
-    new_metadatas: MetaData = {}
+    embeddings = embed_chunks(chunks, models['embedder'], method)
+    summaries = summarize_chunks(chunks, models) if summarize else {}
 
-    chunk_links = []
-    chunk_start = chunk['chunk_start']
-    chunk_end = chunk_start + len(chunk['content'])
+    all_metadatas: List[MetaData] = []
+    for idx, (chunk, (title_embedding, content_embedding)) in enumerate(
+            zip(chunks, embeddings)):
+        new_metadatas: MetaData = {}
+        if idx in summaries:
+            new_metadatas['summary'] = summaries[idx]
 
-    for link in links:
-        if chunk_start < link['start'] < chunk_end:
-            chunk_links.append(link)
+        chunk_links = []
+        chunk_start = chunk['chunk_start']
+        chunk_end = chunk_start + len(chunk['content'])
 
-    new_metadatas['links'] = chunk_links
+        for link in links:
+            if chunk_start < link['start'] < chunk_end:
+                chunk_links.append(link)
 
-    embeddings = embed_chunk(chunk, models['embedder'], method)
-    new_metadatas['title_embedding'] = embeddings[0]
-    new_metadatas['content_embedding'] = embeddings[1]
+        new_metadatas['links'] = chunk_links
+        new_metadatas['title_embedding'] = title_embedding
+        new_metadatas['content_embedding'] = content_embedding
 
-    return new_metadatas
+        all_metadatas.append(new_metadatas)
 
+    return all_metadatas
 
-def embed_chunk(chunk: Chunk, embedders: Dict[LANGUAGES, Embedder],
-                method: EmbeddingMode) -> Tuple[List[float], List[float]]:
-    """Embed title and content of the chunk"""
 
-    embedder = embedders.get(chunk['language'], embedders['fr'])
+def embed_chunks(chunks: List[Chunk], embedders: Dict[LANGUAGES, Embedder],
+                 method: EmbeddingMode
+                 ) -> List[Tuple[List[float], List[float]]]:
+    """Embed title and content of the chunks in one batched call"""
+    if not chunks:
+        return []
 
-    content_embedding = embedder.embed(chunk['content'], method)
-    title_embedding = embedder.embed(chunk['title'], method)
+    embedder = embedders.get(chunks[0]['language'], embedders['fr'])
 
-    return (title_embedding, content_embedding)
+    texts = [chunk['title'] for chunk in chunks]
+    texts += [chunk['content'] for chunk in chunks]
+    embeddings = embedder.embed_batch(texts, method)
+
+    return list(zip(embeddings[:len(chunks)], embeddings[len(chunks):]))
+
+
+def summarize_chunks(chunks: List[Chunk], models: Models) -> Dict[int, str]:
+    """Summary of the indexed chunks (not the ones which are only the title)
+    in one batched generation, used by the map reduce summary of
+    :meth:`~embedders.summarizer.Summarizer.summarize`"""
+    indexed = [idx for idx, chunk in enumerate(chunks)
+               if chunk['content'] != chunk['title']]
+    if not indexed:
+        return {}
+
+    with stage('summarize_chunks'):
+        summaries = models['summarizer']['fr'].summarize_chunks(
+            [chunks[idx]['content'] for idx in indexed])
+    return dict(zip(indexed, summaries))
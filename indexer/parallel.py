@@ -0,0 +1,141 @@
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor
+from concurrent.futures import wait
+from typing import (Any, Dict, Iterable, Iterator, List, Optional, Set,
+                    Tuple)
+
+import torch
+
+from config import BUILD_READ_AHEAD
+from datatypes import Chunk, FlatEntry, Models, Node, RawEntry
+
+# Set in each worker process by init_worker
+WORKER_MODELS: Optional[Models] = None
+WORKER_DB_NAME = ""
+
+PARENT_KEYS = ('title', 'lemma_title', 'content', 'title_embedding',
+               'content_embedding')
+
+
+def init_worker(db_name: str, threads: int) -> None:
+    """Load the models once per worker (lazily, on the first entry)"""
+    # Imported here as indexer.indexer imports this module
+    from .indexer import create_models
+
+    global WORKER_MODELS, WORKER_DB_NAME
+    torch.set_num_threads(threads)
+    WORKER_DB_NAME = db_name
+    WORKER_MODELS = create_models(['fr'])
+
+
+def process_entry(raw_entry: RawEntry, parents: List[Chunk]
+                  ) -> Tuple[Node, List[Chunk]]:
+    """Clean, chunk and compute the metadatas of a single entry (without its
+    children) in a worker, see :func:`~indexer.indexer.build_chunks`"""
+    from .indexer import build_chunks, build_node, clean_entry
+
+    assert WORKER_MODELS is not None, "Worker was not initialized"
+    links = clean_entry(raw_entry)
+    return (build_node(raw_entry, parents, WORKER_MODELS),
+            build_chunks(WORKER_DB_NAME, raw_entry, links, WORKER_MODELS,
+                         parents))
+
+
+def iter_entries_parallel(db_name: str, entries: Iterable[FlatEntry],
+                          workers: int,
+                          read_ahead: int = BUILD_READ_AHEAD
+                          ) -> Iterator[Tuple[Node, List[Chunk]]]:
+    """Same as :func:`~indexer.stream.iter_entries_stream` but computed by a
+    pool of processes.
+
+    An entry is sent to the pool as soon as its parent is done (its chunks
+    are needed for the parent fields), so independent subtrees are computed
+    at the same time. Entries are yielded in completion order.
+
+    Entries are read from the stream (depth first order, see
+    :func:`~indexer.stream.flatten`) at most read_ahead per worker ahead of
+    the pool, and the chunks of a parent are dropped once the stream left
+    its subtree, so the dataset is never loaded at once.
+
+    Raises:
+        ValueError: If an entry comes before its parent or after a sibling
+        of its parent
+    """
+    # Imported here as indexer.stream imports this module
+    from .stream import entry_only
+
+    cpus = os.cpu_count() or 1
+    workers = max(1, min(workers, cpus))
+    threads = max(1, cpus // workers)
+    max_ahead = workers * read_ahead
+    # Spawn rather than fork, torch and cuda do not survive a fork
+    context = multiprocessing.get_context("spawn")
+
+    with ProcessPoolExecutor(workers, mp_context=context,
+                             initializer=init_worker,
+                             initargs=(db_name, threads)) as pool:
+        pending: Dict[Future, str] = {}
+        # Entries read before their parent was done, by parent id
+        waiting: Dict[str, List[FlatEntry]] = {}
+        nb_waiting = 0
+        # Chunks of the done entries which can still get children
+        done_parents: Dict[str, List[Chunk]] = {}
+        # Ids of the last entry read and of its ancestors
+        path: List[str] = []
+        stream = iter(entries)
+        exhausted = False
+
+        def submit(entry: FlatEntry, parents: List[Chunk]) -> None:
+            pending[pool.submit(process_entry, entry_only(entry),
+                                parents)] = entry['id']
+
+        while True:
+            while not exhausted and len(pending) + nb_waiting < max_ahead:
+                entry = next(stream, None)
+                if entry is None:
+                    exhausted = True
+                    break
+
+                # The stream left the subtrees of the other entries
+                while path and path[-1] != entry['parent']:
+                    done_parents.pop(path.pop(), None)
+                if entry['parent'] is not None and not path:
+                    raise ValueError(
+                        f"Entry {entry['id']} does not follow its parent "
+                        f"{entry['parent']} (depth first order)")
+                path.append(entry['id'])
+
+                if entry['parent'] is None:
+                    submit(entry, [])
+                elif entry['parent'] in done_parents:
+                    submit(entry, done_parents[entry['parent']])
+                else:
+                    waiting.setdefault(entry['parent'], []).append(entry)
+                    nb_waiting += 1
+
+            if not pending:
+                break
+
+            done: Set[Future]
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                entry_id = pending.pop(future)
+                node, chunks = future.result()
+
+                # Only what parent_fields needs is sent to the children
+                parents = [slim_parent(chunk) for chunk in chunks]
+                if entry_id in path:
+                    done_parents[entry_id] = parents
+                for child in waiting.pop(entry_id, []):
+                    nb_waiting -= 1
+                    submit(child, parents)
+
+                yield node, chunks
+
+
+def slim_parent(chunk: Chunk) -> Chunk:
+    slim: Dict[str, Any] = {key: chunk[key]  # type: ignore
+                            for key in PARENT_KEYS}
+    return slim  # type: ignore
+
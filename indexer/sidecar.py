@@ -0,0 +1,158 @@
+"""
+Files stored next to an elasticsearch index, in SIDECAR_DIR/<db_name>
+"""
+import json
+import os
+import shutil
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import SIDECAR_DIR, VECTOR_DTYPE
+
+# Extension of the sidecar vectors files for each storage type
+DTYPE_SUFFIXES = {'float32': 'f32', 'float16': 'f16', 'int8': 'i8'}
+
+
+def sidecar_path(db_name: str, sidecar_dir: str = SIDECAR_DIR) -> str:
+    path = os.path.join(sidecar_dir, db_name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def remove_sidecars(db_name: str, sidecar_dir: str = SIDECAR_DIR) -> None:
+    shutil.rmtree(os.path.join(sidecar_dir, db_name), ignore_errors=True)
+
+
+class SentenceStore:
+    """
+    Embeddings of each sentence of the chunks, keyed by chunk_hash.
+
+    The sentences of a chunk are contiguous rows of a matrix stored as
+    VECTOR_DTYPE (``sentences.f32``, ``.f16`` or ``.i8`` with the scale of
+    each row in ``sentences.scales``, see :func:`quantize`) and
+    ``sentences.json`` gives for each chunk_hash its first row and number of
+    rows. Rows are appended while indexing and the matrix is memory mapped
+    when answering.
+
+    It is instanciated in :func:`~indexer.indexer.create_indexes`
+    It is filled in :func:`~indexer.indexer.index_action`
+    It is used in :func:`~qa.refinder.answer_question_by_chunks`
+    """
+
+    def __init__(self, db_name: str, sidecar_dir: str = SIDECAR_DIR,
+                 dtype: str = VECTOR_DTYPE) -> None:
+        path = sidecar_path(db_name, sidecar_dir)
+        self.index_path = os.path.join(path, 'sentences.json')
+
+        self.dtype = dtype
+        self.dim: Optional[int] = None
+        self.rows: Dict[str, Tuple[int, int]] = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as file:
+                stored = json.load(file)
+            # Stores written before the quantization are float32
+            self.dtype = stored.get('dtype', 'float32')
+            self.dim = stored['dim']
+            self.rows = {k: tuple(v) for k, v in stored['rows'].items()}
+
+        self.vectors_path = os.path.join(
+            path, f'sentences.{DTYPE_SUFFIXES[self.dtype]}')
+        self.scales_path = os.path.join(path, 'sentences.scales')
+        self.vectors: Optional[np.ndarray] = None
+        self.scales: Optional[np.ndarray] = None
+
+    def __contains__(self, chunk_hash: str) -> bool:
+        return chunk_hash in self.rows
+
+    def nb_rows(self) -> int:
+        if self.dim is None or not os.path.exists(self.vectors_path):
+            return 0
+        itemsize = np.dtype(self.dtype).itemsize
+        return os.path.getsize(self.vectors_path) // (itemsize * self.dim)
+
+    def add(self, chunk_hash: str, embeddings: List[List[float]]) -> None:
+        if chunk_hash in self.rows or not embeddings:
+            return
+
+        codes, scales = quantize(np.asarray(embeddings), self.dtype)
+        self.dim = codes.shape[1]
+        self.rows[chunk_hash] = (self.nb_rows(), len(codes))
+
+        with open(self.vectors_path, 'ab') as file:
+            file.write(codes.tobytes())
+        if self.dtype == 'int8':
+            with open(self.scales_path, 'ab') as file:
+                file.write(scales.tobytes())
+
+    def remove(self, chunk_hash: str) -> None:
+        """Forget the chunk, its rows are left unused in the matrix"""
+        self.rows.pop(chunk_hash, None)
+
+    def flush(self) -> None:
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'dim': self.dim, 'dtype': self.dtype,
+                       'rows': self.rows}, file)
+        os.replace(tmp_path, self.index_path)
+        self.vectors = None
+
+    def get(self, chunk_hash: str) -> Optional[np.ndarray]:
+        """(nb sentences, dim) embeddings of the sentences of the chunk"""
+        if chunk_hash not in self.rows:
+            return None
+
+        first, nb_rows = self.rows[chunk_hash]
+        if self.vectors is None or len(self.vectors) < first + nb_rows:
+            self.vectors = np.memmap(self.vectors_path, dtype=self.dtype,
+                                     mode='r').reshape(-1, self.dim)
+            if self.dtype == 'int8':
+                self.scales = np.memmap(self.scales_path, dtype=np.float32,
+                                        mode='r')
+
+        codes = self.vectors[first:first + nb_rows]
+        if self.scales is None:
+            return np.asarray(codes, dtype=np.float32)
+        return dequantize(codes, self.scales[first:first + nb_rows])
+
+
+def bump_generation(db_name: str, sidecar_dir: str = SIDECAR_DIR) -> int:
+    """Mark the index as changed, see :func:`read_generation`"""
+    generation = time.time_ns()
+    path = os.path.join(sidecar_path(db_name, sidecar_dir), 'generation')
+    with open(path + '.tmp', 'w') as file:
+        file.write(str(generation))
+    os.replace(path + '.tmp', path)
+    return generation
+
+
+def read_generation(db_name: str, sidecar_dir: str = SIDECAR_DIR) -> int:
+    """Generation of the index, which changes each time it is modified
+    (a timestamp so it does not repeat when the index is recreated)"""
+    path = os.path.join(sidecar_dir, db_name, 'generation')
+    try:
+        with open(path, 'r') as file:
+            return int(file.read())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def quantize(matrix: np.ndarray, dtype: str = VECTOR_DTYPE
+             ) -> Tuple[np.ndarray, np.ndarray]:
+    """Codes and scale of each row of the matrix, int8 codes are scaled to
+    use the whole int8 range for each row"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if dtype == 'int8':
+        scales = np.abs(matrix).max(axis=1) / 127
+        scales = np.maximum(scales, np.finfo(np.float32).tiny)
+        codes = np.round(matrix / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    return matrix.astype(dtype), np.ones(len(matrix), np.float32)
+
+
+def dequantize(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    matrix = codes.astype(np.float32)
+    if codes.dtype == np.int8:
+        matrix *= np.asarray(scales)[:, None]
+    return matrix
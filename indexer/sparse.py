@@ -0,0 +1,356 @@
+"""
+In process BM25 index of the lemmatized fields of the chunks and of their
+node (the keylemmas of :func:`~utils.get_keylemmas`), so the sparse
+retrieval of short questions needs no elasticsearch round trip.
+"""
+import json
+import os
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import BM25_B, BM25_K1, SPARSE_BLOCK_SIZE
+
+from .sidecar import sidecar_path
+
+# Lemma fields with the option of RetrieveOptions giving their boost, the
+# ones of the chunks and the ones of their node (shared by its chunks)
+CHUNK_LEMMA_FIELDS = {'lemma_title': 'boost_title',
+                      'lemma_content': 'boost_lem'}
+NODE_LEMMA_FIELDS = {'lemma_page_content': 'boost_page_lem',
+                     'lemma_parent_title': 'boost_parent_title'}
+
+IMPACT_LEVELS = 255  # impacts are quantized on a byte
+GAP_TYPES = {1: np.uint8, 2: np.uint16, 4: np.uint32}
+# Arrays of the postings of a field, saved as .npy files
+ARRAYS = ('df', 'max_impact', 'term_blocks', 'block_first', 'block_postings',
+          'block_bytes', 'block_width', 'gaps', 'impacts')
+
+
+class Postings:
+    """
+    Compressed postings lists of one field, by blocks of SPARSE_BLOCK_SIZE
+    documents. A block stores its first document and the gaps between its
+    documents with the smallest integer type holding the largest gap, and
+    the BM25 term frequency part (the impact) of each document quantized on
+    a byte, so a score is idf * boost * impact.
+    """
+
+    def __init__(self, vocabulary: Dict[str, int], nb_docs: int,
+                 arrays: Dict[str, np.ndarray], k1: float = BM25_K1) -> None:
+        self.vocabulary = vocabulary
+        self.nb_docs = nb_docs
+        self.k1 = k1
+        self.df = arrays['df']  # (nb terms,) documents with the term
+        self.max_impact = arrays['max_impact']  # (nb terms,)
+        self.term_blocks = arrays['term_blocks']  # (nb terms + 1,)
+        self.block_first = arrays['block_first']  # (nb blocks,)
+        self.block_postings = arrays['block_postings']  # (nb blocks + 1,)
+        self.block_bytes = arrays['block_bytes']  # (nb blocks + 1,)
+        self.block_width = arrays['block_width']  # (nb blocks,) gaps bytes
+        self.gaps = arrays['gaps']  # uint8 buffer of the gaps
+        self.impacts = arrays['impacts']  # (nb postings,) uint8
+
+    @classmethod
+    def build(cls, docs: List[List[str]], block_size: int = SPARSE_BLOCK_SIZE,
+              k1: float = BM25_K1, b: float = BM25_B) -> 'Postings':
+        """Postings of the lemmas of the field of each document"""
+        lengths = np.asarray([len(lemmas) for lemmas in docs], np.float32)
+        avg_length = max(float(lengths.mean()), 1.0) if len(docs) else 1.0
+
+        lists: Dict[str, List[Tuple[int, int]]] = {}
+        for doc, lemmas in enumerate(docs):
+            for lemma, frequency in Counter(lemmas).items():
+                lists.setdefault(lemma, []).append((doc, frequency))
+        vocabulary = {term: idx for idx, term in enumerate(sorted(lists))}
+
+        df, max_impact, term_blocks = [], [], [0]
+        block_first, block_width = [], []
+        block_postings, block_bytes = [0], [0]
+        gaps: List[bytes] = []
+        impacts: List[np.ndarray] = []
+        for term in vocabulary:
+            doc_ids = np.asarray([doc for doc, _ in lists[term]], np.int64)
+            frequencies = np.asarray([tf for _, tf in lists[term]],
+                                     np.float32)
+            norms = k1 * (1 - b + b * lengths[doc_ids] / avg_length)
+            quantized = np.clip(np.round(
+                frequencies / (frequencies + norms) * IMPACT_LEVELS),
+                1, IMPACT_LEVELS).astype(np.uint8)
+
+            df.append(len(doc_ids))
+            max_impact.append(quantized.max())
+            impacts.append(quantized)
+            for start in range(0, len(doc_ids), block_size):
+                block = doc_ids[start:start + block_size]
+                block_gaps = np.diff(block, prepend=block[0])
+                width = next(width for width, dtype in GAP_TYPES.items()
+                             if block_gaps.max() <= np.iinfo(dtype).max)
+                gaps.append(block_gaps.astype(GAP_TYPES[width]).tobytes())
+                block_first.append(block[0])
+                block_width.append(width)
+                block_postings.append(block_postings[-1] + len(block))
+                block_bytes.append(block_bytes[-1] + len(gaps[-1]))
+            term_blocks.append(len(block_first))
+
+        return cls(vocabulary, len(docs), {
+            'df': np.asarray(df, np.int64),
+            'max_impact': np.asarray(max_impact, np.uint8),
+            'term_blocks': np.asarray(term_blocks, np.int64),
+            'block_first': np.asarray(block_first, np.int64),
+            'block_postings': np.asarray(block_postings, np.int64),
+            'block_bytes': np.asarray(block_bytes, np.int64),
+            'block_width': np.asarray(block_width, np.uint8),
+            'gaps': np.frombuffer(b''.join(gaps) or bytes(1), np.uint8),
+            'impacts': (np.concatenate(impacts) if impacts
+                        else np.zeros(0, np.uint8))}, k1)
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(path, 'vocabulary.json'), 'w') as file:
+            json.dump({'nb_docs': self.nb_docs, 'k1': self.k1,
+                       'terms': self.vocabulary}, file)
+
+    @classmethod
+    def load(cls, path: str) -> 'Postings':
+        with open(os.path.join(path, 'vocabulary.json'), 'r') as file:
+            meta = json.load(file)
+        return cls(meta['terms'], meta['nb_docs'], {
+            name: np.load(os.path.join(path, f'{name}.npy'))
+            for name in ARRAYS}, meta['k1'])
+
+    def weight(self, term: str) -> float:
+        """BM25 idf of the term times the scale of the impacts"""
+        idx = self.vocabulary.get(term)
+        if idx is None:
+            return 0.0
+        df = int(self.df[idx])
+        idf = np.log(1 + (self.nb_docs - df + 0.5) / (df + 0.5))
+        return float(idf) * (self.k1 + 1) / IMPACT_LEVELS
+
+    def decode_block(self, block: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Documents and impacts of a block"""
+        start = self.block_postings[block]
+        end = self.block_postings[block + 1]
+        gaps = np.frombuffer(self.gaps,
+                             GAP_TYPES[int(self.block_width[block])],
+                             count=int(end - start),
+                             offset=int(self.block_bytes[block]))
+        return (self.block_first[block] + np.cumsum(gaps, dtype=np.int64),
+                self.impacts[start:end])
+
+    def decode(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Documents (increasing) and impacts of the postings of the term"""
+        idx = self.vocabulary[term]
+        blocks = [self.decode_block(block) for block in
+                  range(self.term_blocks[idx], self.term_blocks[idx + 1])]
+        return (np.concatenate([docs for docs, _ in blocks]),
+                np.concatenate([impacts for _, impacts in blocks]))
+
+    def lookup(self, term: str, docs: np.ndarray) -> np.ndarray:
+        """Impacts of the term for the documents (sorted), 0 when they do
+        not contain it. Only the blocks which can hold them are decoded"""
+        idx = self.vocabulary[term]
+        first, last = self.term_blocks[idx], self.term_blocks[idx + 1]
+        blocks = first + np.searchsorted(self.block_first[first:last], docs,
+                                         side='right') - 1
+        found = np.zeros(len(docs), np.float32)
+        for block in np.unique(blocks[blocks >= first]):
+            block_docs, impacts = self.decode_block(int(block))
+            wanted = np.flatnonzero(blocks == block)
+            positions = np.searchsorted(block_docs, docs[wanted])
+            positions = np.minimum(positions, len(block_docs) - 1)
+            hit = block_docs[positions] == docs[wanted]
+            found[wanted[hit]] = impacts[positions[hit]]
+        return found
+
+
+class TermLeg:
+    """Scores of the chunks for one term of one chunk field"""
+
+    def __init__(self, postings: Postings, term: str, boost: float) -> None:
+        self.postings = postings
+        self.term = term
+        self.weight = boost * postings.weight(term)
+        self.upper_bound = self.weight * float(
+            postings.max_impact[postings.vocabulary[term]])
+
+    def scores(self) -> Tuple[np.ndarray, np.ndarray]:
+        docs, impacts = self.postings.decode(self.term)
+        return docs, self.weight * impacts
+
+    def scores_of(self, docs: np.ndarray) -> np.ndarray:
+        return self.weight * self.postings.lookup(self.term, docs)
+
+
+class NodeLeg:
+    """Scores of the chunks given by the node fields, the score of their
+    node"""
+
+    def __init__(self, node_scores: np.ndarray, chunk_nodes: np.ndarray,
+                 node_offsets: np.ndarray) -> None:
+        self.node_scores = node_scores
+        self.chunk_nodes = chunk_nodes
+        self.node_offsets = node_offsets
+        self.upper_bound = float(node_scores.max(initial=0.0))
+
+    def scores(self) -> Tuple[np.ndarray, np.ndarray]:
+        nodes = np.flatnonzero(self.node_scores > 0)
+        starts, ends = self.node_offsets[nodes], self.node_offsets[nodes + 1]
+        docs = np.concatenate([np.arange(start, end) for start, end
+                               in zip(starts, ends)] or [np.zeros(0, int)])
+        return docs, np.repeat(self.node_scores[nodes], ends - starts)
+
+    def scores_of(self, docs: np.ndarray) -> np.ndarray:
+        return self.node_scores[self.chunk_nodes[docs]]
+
+
+class SparseIndex:
+    """
+    BM25 over the lemma fields of the chunks (CHUNK_LEMMA_FIELDS) plus the
+    BM25 of their node over its fields (NODE_LEMMA_FIELDS), as the has_parent
+    clause of the elasticsearch sparse query. Each field is boosted by its
+    option of RetrieveOptions, see :class:`Postings`.
+
+    The top k is computed with MaxScore : the scores are added one
+    (term, field) list at a time from the highest upper bound, once the
+    upper bounds of the remaining lists cannot reach the k-th best score
+    only the current candidates are looked up in them.
+
+    Chunks are numbered by node, so the chunks of a node are contiguous.
+
+    It is built in :func:`~indexer.indexer.build_sparse` and saved next to
+    the index, it is used in :func:`~qa.retriever.retrieve_bm25`
+    """
+
+    def __init__(self, ids: List[str], node_offsets: np.ndarray,
+                 fields: Dict[str, Postings]) -> None:
+        self.ids = ids  # store id of each chunk
+        self.node_offsets = node_offsets  # (nb nodes + 1,) first chunks
+        self.chunk_nodes = np.repeat(np.arange(len(node_offsets) - 1),
+                                     np.diff(node_offsets))
+        self.fields = fields
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, store: Any, db_name: str) -> 'SparseIndex':
+        """Read the lemma fields of the nodes and of the chunks of the index
+        """
+        nodes: Dict[str, Dict[str, Any]] = dict(store.scan(
+            db_name, relation="node", fields=list(NODE_LEMMA_FIELDS)))
+        children: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}
+        for doc_id, source in store.scan(
+                db_name, relation="chunk",
+                fields=list(CHUNK_LEMMA_FIELDS) + ['relation']):
+            children.setdefault(source['relation']['parent'], []).append(
+                (doc_id, source))
+
+        ids: List[str] = []
+        node_offsets = [0]
+        chunk_docs: Dict[str, List[List[str]]] = {
+            field: [] for field in CHUNK_LEMMA_FIELDS}
+        node_docs: Dict[str, List[List[str]]] = {
+            field: [] for field in NODE_LEMMA_FIELDS}
+        for node_doc_id in sorted(children):
+            for doc_id, source in children[node_doc_id]:
+                ids.append(doc_id)
+                for field in CHUNK_LEMMA_FIELDS:
+                    chunk_docs[field].append(
+                        str(source.get(field) or '').split())
+            node_offsets.append(len(ids))
+            for field in NODE_LEMMA_FIELDS:
+                node_docs[field].append(str(
+                    nodes.get(node_doc_id, {}).get(field) or '').split())
+
+        fields = {field: Postings.build(docs)
+                  for field, docs in {**chunk_docs, **node_docs}.items()}
+        return cls(ids, np.asarray(node_offsets, np.int64), fields)
+
+    def save(self, db_name: str) -> None:
+        path = os.path.join(sidecar_path(db_name), 'sparse')
+        for field, postings in self.fields.items():
+            postings.save(os.path.join(path, field))
+        np.save(os.path.join(path, 'node_offsets.npy'), self.node_offsets)
+        with open(os.path.join(path, 'ids.json'), 'w') as file:
+            json.dump(self.ids, file)
+
+    @classmethod
+    def load(cls, db_name: str) -> Optional['SparseIndex']:
+        path = os.path.join(sidecar_path(db_name), 'sparse')
+        if not os.path.exists(os.path.join(path, 'ids.json')):
+            return None
+
+        with open(os.path.join(path, 'ids.json'), 'r') as file:
+            ids = json.load(file)
+        return cls(ids, np.load(os.path.join(path, 'node_offsets.npy')),
+                   {field: Postings.load(os.path.join(path, field))
+                    for field in {**CHUNK_LEMMA_FIELDS, **NODE_LEMMA_FIELDS}})
+
+    def search(self, lem_question: str, options: Dict[str, Any], k: int
+               ) -> List[Tuple[str, float]]:
+        """Top k chunks for the lemmas of the question (space separated)
+
+        Returns:
+            List[Tuple[str, float]]: chunks ids and scores, best first
+        """
+        terms = set(lem_question.split())
+        legs: List[Any] = [
+            TermLeg(self.fields[field], term, options[boost])
+            for field, boost in CHUNK_LEMMA_FIELDS.items()
+            for term in terms
+            if term in self.fields[field].vocabulary and options[boost] > 0]
+
+        node_scores = np.zeros(len(self.node_offsets) - 1, np.float32)
+        for field, boost in NODE_LEMMA_FIELDS.items():
+            postings = self.fields[field]
+            for term in terms:
+                if term in postings.vocabulary and options[boost] > 0:
+                    nodes, impacts = postings.decode(term)
+                    node_scores[nodes] += (options[boost]
+                                           * postings.weight(term) * impacts)
+        if node_scores.any():
+            legs.append(NodeLeg(node_scores, self.chunk_nodes,
+                                self.node_offsets))
+
+        docs, scores = max_score(legs, k)
+        return [(self.ids[doc], float(score))
+                for doc, score in zip(docs, scores)]
+
+
+def max_score(legs: List[Any], k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Top k documents of the sum of the scores of the legs (MaxScore)
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: documents and scores, best first
+    """
+    legs = sorted(legs, key=lambda leg: -leg.upper_bound)
+    remaining = sum(leg.upper_bound for leg in legs)
+    candidates = np.zeros(0, np.int64)
+    scores = np.zeros(0, np.float32)
+    threshold = 0.0
+
+    for leg in legs:
+        if len(candidates) < k or remaining >= threshold:
+            # Documents not seen yet can still reach the top k
+            docs, leg_scores = leg.scores()
+            merged = np.union1d(candidates, docs)
+            merged_scores = np.zeros(len(merged), np.float32)
+            merged_scores[np.searchsorted(merged, candidates)] = scores
+            merged_scores[np.searchsorted(merged, docs)] += leg_scores
+            candidates, scores = merged, merged_scores
+        else:
+            scores = scores + leg.scores_of(candidates)
+        remaining -= leg.upper_bound
+
+        if len(candidates) > k:
+            threshold = float(np.partition(scores, -k)[-k])
+            keep = scores + remaining >= threshold
+            candidates, scores = candidates[keep], scores[keep]
+
+    best = np.argsort(-scores, kind='stable')[:k]
+    return candidates[best], scores[best]
@@ -0,0 +1,757 @@
+"""
+Storage backends of the documents of an index (the nodes and their chunks) :
+elasticsearch, or a local embedded store made of memory mapped arrays and
+files, which needs no server so the whole pipeline can run in process.
+
+Both have the interface of :class:`Store`, documents are written with the
+bulk actions of :mod:`indexer.indexer` and searched with the sparse, dense
+and hybrid retrievals of :func:`~qa.retriever.retrieve_docs`
+"""
+import asyncio
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan
+
+try:
+    # Needs aiohttp
+    from elasticsearch import AsyncElasticsearch
+except ImportError:
+    AsyncElasticsearch = None
+
+from config import LOCAL_STORE_DIR, STORAGE_BACKEND
+from metrics import STAGE_SECONDS, count
+
+from .ann import date_decay, normalize
+from .bulk import bulk_index
+
+# Nodes are indexed next to their chunks, see indexer.indexer.build_node
+CHUNK_FILTER = {"term": {"relation": "chunk"}}
+MIN_SCORE = 1.0
+
+# Text fields of the sparse retrieval with the option giving their boost,
+# the ones of the chunk and the ones of its node
+CHUNK_TEXT_FIELDS = {'title': 'boost_title', 'content': 'boost_content',
+                     'lemma_content': 'boost_lem'}
+NODE_TEXT_FIELDS = {'page_content': 'boost_page',
+                    'lemma_page_content': 'boost_page_lem',
+                    'parent_title': 'boost_parent_title',
+                    'parent_content': 'boost_parent_content'}
+# Embeddings of the dense retrieval with the option giving their weight
+DENSE_FIELDS = {'content_embedding': 'boost_content_embedding',
+                'title_embedding': 'boost_title_embedding',
+                'parent_title_embedding': 'boost_parent_embedding'}
+WORD = re.compile(r"\w+")
+
+
+class Store(ABC):
+    """
+    Interface of the storage backends, see :class:`ElasticStore` and
+    :class:`LocalStore`
+
+    It is instanciated in :func:`~indexer.indexer.create_indexes`
+    """
+
+    name = ''
+    # Whether get_async and search_async use an async client
+    supports_async = False
+
+    @abstractmethod
+    def exists(self, db_name: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def create(self, db_name: str, body: Dict[str, Any]) -> None:
+        """Create the index from its elasticsearch settings and mappings"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, db_name: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def names(self) -> List[str]:
+        """Names of all the indexes of the store"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def index(self, db_name: str, doc_id: str, source: Dict[str, Any],
+              routing: Optional[str] = None) -> None:
+        """Index (or replace) a single document"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def bulk(self, db_name: str, actions: Iterable[Dict[str, Any]],
+             relaxed: bool = False) -> int:
+        """Apply the actions of the elasticsearch bulk helpers : index
+        (default _op_type, with a _source), update (with a partial doc) or
+        delete a document by _id. relaxed allows the backend to trade the
+        freshness and the safety of the index for speed (fresh builds only)
+
+        Returns:
+            int: Number of documents written
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def scan(self, db_name: str, relation: Optional[str] = None,
+             fields: Optional[List[str]] = None
+             ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Ids and sources of all the documents (only the nodes or the chunks
+        with relation), with only the given fields if any"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, db_name: str, ids: List[str],
+            fields: Optional[List[str]] = None
+            ) -> List[Optional[Dict[str, Any]]]:
+        """Sources of the documents, None for the ones not found"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def search(self, db_name: str, lem_question: str,
+               question_embed: List[float], options: Dict[str, Any]
+               ) -> Tuple[List[Dict[str, Any]], float, int]:
+        """Best chunks for the retrieve_mode of the options (sparse | dense
+        | hybrid) and the question (lemmas for the sparse part)
+
+        Returns:
+            Tuple[List[Dict[str, Any]], float, int]: sources of the
+                options['retrieve_nb'] best chunks with their score, best
+                score and number of chunks matching
+        """
+        raise NotImplementedError
+
+    async def get_async(self, db_name: str, ids: List[str],
+                        fields: Optional[List[str]] = None
+                        ) -> List[Optional[Dict[str, Any]]]:
+        """Same as :meth:`get`, with an async client if the backend has one
+        (by default get runs in a thread of the loop executor)"""
+        return await asyncio.get_event_loop().run_in_executor(
+            None, self.get, db_name, ids, fields)
+
+    async def search_async(self, db_name: str, lem_question: str,
+                           question_embed: List[float],
+                           options: Dict[str, Any]
+                           ) -> Tuple[List[Dict[str, Any]], float, int]:
+        """Same as :meth:`search`, see :meth:`get_async`"""
+        return await asyncio.get_event_loop().run_in_executor(
+            None, self.search, db_name, lem_question, question_embed,
+            options)
+
+    async def close_async(self) -> None:
+        """Close the async client opened in the running event loop, if any"""
+
+
+class ElasticStore(Store):
+    """Documents in an elasticsearch cluster (localhost by default)"""
+
+    name = 'elasticsearch'
+
+    def __init__(self, client: Optional[Elasticsearch] = None) -> None:
+        self.es = client if client is not None else Elasticsearch()
+        # Async queries go to the same default cluster
+        self.supports_async = client is None and AsyncElasticsearch is not None
+        self.async_es: Optional[AsyncElasticsearch] = None
+        self.async_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def async_client(self) -> 'AsyncElasticsearch':
+        """Async client of the running event loop (its connections belong to
+        the loop they were opened in, so it must be closed with
+        :meth:`close_async` before its loop ends)"""
+        loop = asyncio.get_event_loop()
+        if self.async_es is None or self.async_loop is not loop:
+            self.async_es = AsyncElasticsearch()
+            self.async_loop = loop
+        return self.async_es
+
+    async def close_async(self) -> None:
+        if self.async_es is not None:
+            await self.async_es.close()
+        self.async_es = None
+        self.async_loop = None
+
+    def exists(self, db_name: str) -> bool:
+        return bool(self.es.indices.exists(index=db_name))
+
+    def create(self, db_name: str, body: Dict[str, Any]) -> None:
+        self.es.indices.create(index=db_name, ignore=400, body=body)
+
+    def delete(self, db_name: str) -> None:
+        self.es.indices.delete(index=db_name, ignore=[400, 404])
+
+    def names(self) -> List[str]:
+        return list(self.es.indices.get('*'))
+
+    def index(self, db_name: str, doc_id: str, source: Dict[str, Any],
+              routing: Optional[str] = None) -> None:
+        self.es.index(index=db_name, id=doc_id, routing=routing, body=source)
+
+    def bulk(self, db_name: str, actions: Iterable[Dict[str, Any]],
+             relaxed: bool = False) -> int:
+        return bulk_index(self.es, db_name, actions, relaxed=relaxed)
+
+    def scan(self, db_name: str, relation: Optional[str] = None,
+             fields: Optional[List[str]] = None
+             ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        query: Dict[str, Any] = {}
+        if relation is not None:
+            query["query"] = {"term": {"relation": relation}}
+        if fields is not None:
+            query["_source"] = fields
+        for doc in scan(self.es, index=db_name, query=query):
+            yield doc['_id'], doc['_source']
+
+    def get(self, db_name: str, ids: List[str],
+            fields: Optional[List[str]] = None
+            ) -> List[Optional[Dict[str, Any]]]:
+        if not ids:
+            return []
+        res = self.es.mget(index=db_name, body={'ids': ids}, _source=fields)
+        return found_sources(res)
+
+    def search(self, db_name: str, lem_question: str,
+               question_embed: List[float], options: Dict[str, Any]
+               ) -> Tuple[List[Dict[str, Any]], float, int]:
+        res = self.es.search(index=db_name, body=search_body(
+            lem_question, question_embed, options))
+        return search_results(res)
+
+    async def get_async(self, db_name: str, ids: List[str],
+                        fields: Optional[List[str]] = None
+                        ) -> List[Optional[Dict[str, Any]]]:
+        if not ids:
+            return []
+        res = await self.async_client().mget(index=db_name,
+                                             body={'ids': ids},
+                                             _source=fields)
+        return found_sources(res)
+
+    async def search_async(self, db_name: str, lem_question: str,
+                           question_embed: List[float],
+                           options: Dict[str, Any]
+                           ) -> Tuple[List[Dict[str, Any]], float, int]:
+        body = search_body(lem_question, question_embed, options)
+        res = await self.async_client().search(index=db_name, body=body)
+        return search_results(res)
+
+
+def found_sources(res: Dict[str, Any]) -> List[Optional[Dict[str, Any]]]:
+    """Sources of a mget response, None for the documents not found"""
+    return [doc['_source'] if doc.get('found') else None
+            for doc in res['docs']]
+
+
+def search_results(res: Dict[str, Any]
+                   ) -> Tuple[List[Dict[str, Any]], float, int]:
+    """Sources with their score, best score and number of hits of a search
+    response"""
+    total = res['hits']['total']
+    supports = [{'score': doc['_score'], **doc["_source"]}
+                for doc in res['hits']['hits']]
+    return (supports, res['hits']['max_score'],
+            total['value'] if isinstance(total, dict) else total)
+
+
+def search_body(lem_question: str, question_embed: List[float],
+                options: Dict[str, Any]) -> Dict[str, Any]:
+    """Elasticsearch query of the retrieve_mode of the options"""
+    # Page and parent fields are stored once in the node of the chunks
+    query = {"bool": {
+        "filter": [CHUNK_FILTER],
+        "should": [
+            {'multi_match': {
+                'query':  lem_question, 'fuzziness': "AUTO",
+                # cross_fields, most_fields, best_fields
+                "type": "best_fields",
+                'fields': [f"{field}^{options[boost]}"
+                           for field, boost in CHUNK_TEXT_FIELDS.items()]}},
+            {"has_parent": {
+                "parent_type": "node", "score": True,
+                "query": {'multi_match': {
+                    'query':  lem_question, 'fuzziness': "AUTO",
+                    "type": "best_fields",
+                    'fields': [f"{field}^{options[boost]}"
+                               for field, boost in NODE_TEXT_FIELDS.items()]
+                    }}}}
+        ],
+        "minimum_should_match": 1}}
+
+    dense_script = {
+            "source": f"""
+            double content = {options['boost_content_embedding']} * cosineSimilarity(params.question_embed, 'content_embedding');
+            double title = {options['boost_title_embedding']} * cosineSimilarity(params.question_embed, 'title_embedding');
+            double parent = {options['boost_parent_embedding']} * cosineSimilarity(params.question_embed, 'parent_title_embedding');
+            double embed_score = content + title + parent + {options['boost_parent_embedding'] + options['boost_title_embedding'] + options['boost_content_embedding']};
+            double date_score =  {options['boost_date']} * decayDateGauss(params.origin, params.scale, params.offset, params.decay, doc['first_seen_date'].value);
+            return _score + embed_score + date_score;
+            """,  # noqa E501
+            "params": {
+                "origin": datetime.now(),
+                "scale": "30d",
+                "offset": "0",
+                "decay": 0.5,
+                "question_embed": question_embed,
+                }}
+
+    if options["retrieve_mode"] == "sparse":
+        return {
+            "size": options['retrieve_nb'],
+            "min_score": str(MIN_SCORE),
+            "query":  query,
+        }
+
+    elif options["retrieve_mode"] == "dense":
+        return {
+            "size": options['retrieve_nb'],
+            "min_score": str(MIN_SCORE),
+            # Score of 1 for all the chunks, as a match_all
+            "query": {"script_score": {
+                "query": {"constant_score": {"filter": CHUNK_FILTER}},
+                "script": dense_script}}
+        }
+
+    elif options["retrieve_mode"] == "hybrid":
+        return {
+            "size": options['retrieve_nb'],
+            "min_score": str(MIN_SCORE),
+            "query": {"script_score": {"query": query,
+                                       "script": dense_script}}
+        }
+
+    raise RuntimeError(
+        "Retrieval mode can be only [sparse | dense | hybrid | ann]")
+
+
+class LocalStore(Store):
+    """
+    Embedded store, each index is a directory of LOCAL_STORE_DIR with :
+    - ``mapping.json`` : the dense_vector fields and their dimension
+    - ``docs.jsonl`` : log of the writes (index, update, delete) of the
+      documents without their embeddings, replayed when the index is opened
+    - ``vectors.f32`` : (rows, nb vector fields, dim) float32 embeddings,
+      appended and memory mapped, one row per written version of a document
+
+    The log and the vectors are rewritten with only the live documents once
+    most of the rows are stale, see :meth:`LocalIndex.compact`.
+
+    Searches are exhaustive : the scores are the ones of the elasticsearch
+    queries (:func:`search_body`) except for the text fields, which score
+    the number of words of the question they contain (no analyzer and no
+    fuzziness) instead of BM25.
+    """
+
+    name = 'local'
+
+    def __init__(self, store_dir: str = LOCAL_STORE_DIR) -> None:
+        self.store_dir = store_dir
+        self.opened: Dict[str, LocalIndex] = {}
+        self.lock = threading.Lock()
+
+    def path(self, db_name: str) -> str:
+        return os.path.join(self.store_dir, db_name)
+
+    def table(self, db_name: str) -> 'LocalIndex':
+        with self.lock:
+            if db_name not in self.opened:
+                if not self.exists(db_name):
+                    raise KeyError(f"There is no local index {db_name}")
+                self.opened[db_name] = LocalIndex(self.path(db_name))
+            return self.opened[db_name]
+
+    def exists(self, db_name: str) -> bool:
+        return os.path.exists(os.path.join(self.path(db_name),
+                                           'mapping.json'))
+
+    def create(self, db_name: str, body: Dict[str, Any]) -> None:
+        if self.exists(db_name):
+            return
+
+        properties = body.get('mappings', {}).get('properties', {})
+        dims = {field: spec['dims'] for field, spec in properties.items()
+                if spec.get('type') == 'dense_vector'}
+        if len(set(dims.values())) > 1:
+            raise ValueError("All the dense vectors of a local index must "
+                             f"have the same dimension : {dims}")
+
+        os.makedirs(self.path(db_name), exist_ok=True)
+        with open(os.path.join(self.path(db_name), 'mapping.json'),
+                  'w') as file:
+            json.dump({'vector_fields': list(dims),
+                       'dim': next(iter(dims.values()), 0)}, file)
+
+    def delete(self, db_name: str) -> None:
+        with self.lock:
+            table = self.opened.pop(db_name, None)
+        if table is not None:
+            table.close()
+        shutil.rmtree(self.path(db_name), ignore_errors=True)
+
+    def names(self) -> List[str]:
+        if not os.path.isdir(self.store_dir):
+            return []
+        return [name for name in os.listdir(self.store_dir)
+                if self.exists(name)]
+
+    def index(self, db_name: str, doc_id: str, source: Dict[str, Any],
+              routing: Optional[str] = None) -> None:
+        table = self.table(db_name)
+        with table.lock:
+            table.write('index', doc_id, source)
+            table.flush()
+
+    def bulk(self, db_name: str, actions: Iterable[Dict[str, Any]],
+             relaxed: bool = False) -> int:
+        start = time.time()
+        table = self.table(db_name)
+        nb_docs = 0
+        for action in actions:
+            op_type = action.get('_op_type', 'index')
+            with table.lock:
+                written = table.write(
+                    op_type, action['_id'],
+                    action.get('_source', action.get('doc', {})))
+            if not written:
+                count('index_failures')
+                print(f"Failed to {op_type} the document {action['_id']} "
+                      "which does not exist")
+            nb_docs += 1
+
+        with table.lock:
+            table.flush()
+            if table.nb_rows > 2 * len(table.rows) + 1000:
+                table.compact()
+
+        duration = time.time() - start
+        count('docs_indexed', nb_docs)
+        STAGE_SECONDS.labels('bulk_index').observe(duration)
+        print(f"{nb_docs} documents indexed in {duration}s "
+              f"({nb_docs / max(duration, 1e-9):.1f} docs/s)")
+        return nb_docs
+
+    def scan(self, db_name: str, relation: Optional[str] = None,
+             fields: Optional[List[str]] = None
+             ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        table = self.table(db_name)
+        with table.lock:
+            doc_ids = [doc_id for doc_id, source in table.docs.items()
+                       if relation is None
+                       or relation_name(source) == relation]
+        for doc_id in doc_ids:
+            source = table.source(doc_id, fields)
+            if source is not None:
+                yield doc_id, source
+
+    def get(self, db_name: str, ids: List[str],
+            fields: Optional[List[str]] = None
+            ) -> List[Optional[Dict[str, Any]]]:
+        table = self.table(db_name)
+        return [table.source(doc_id, fields) for doc_id in ids]
+
+    def search(self, db_name: str, lem_question: str,
+               question_embed: List[float], options: Dict[str, Any]
+               ) -> Tuple[List[Dict[str, Any]], float, int]:
+        table = self.table(db_name)
+        mode = options["retrieve_mode"]
+        if mode not in ('sparse', 'dense', 'hybrid'):
+            raise RuntimeError(
+                "Retrieval mode can be only [sparse | dense | hybrid | ann]")
+
+        ids, rows, dates, parents = table.chunk_arrays()
+        if not ids:
+            return [], 0.0, 0
+
+        if mode == 'dense':
+            # constant_score of the chunks
+            scores = np.ones(len(ids))
+            matched = np.ones(len(ids), bool)
+        else:
+            scores = table.sparse_scores(ids, parents, lem_question, options)
+            matched = scores > 0
+
+        if mode != 'sparse':
+            scores = (scores + table.dense_scores(rows, question_embed,
+                                                  options)
+                      + options['boost_date'] * date_decay(dates))
+
+        candidates = np.flatnonzero(matched & (scores >= MIN_SCORE))
+        best = candidates[np.argsort(-scores[candidates], kind='stable')]
+        supports: List[Dict[str, Any]] = []
+        for idx in best[:options['retrieve_nb']]:
+            source = table.source(ids[idx])
+            if source is not None:
+                supports.append({'score': float(scores[idx]), **source})
+
+        max_score = supports[0]['score'] if supports else 0.0
+        return supports, max_score, len(candidates)
+
+
+class LocalIndex:
+    """Documents and embeddings of one index of the :class:`LocalStore`.
+    Writes are serialized by the caller with the lock"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(os.path.join(path, 'mapping.json'), 'r') as file:
+            mapping = json.load(file)
+        self.vector_fields: List[str] = mapping['vector_fields']
+        self.dim: int = mapping['dim']
+        self.lock = threading.RLock()
+
+        self.docs: Dict[str, Dict[str, Any]] = {}
+        self.rows: Dict[str, int] = {}  # row of the embeddings of each doc
+        self.vectors_of: Dict[str, List[str]] = {}  # vector fields of a doc
+        self.terms: Dict[str, Dict[str, Set[str]]] = {}  # words of a field
+        self.version = 0
+        self.cached: Optional[Tuple[int, Tuple[Any, ...]]] = None
+
+        self.docs_path = os.path.join(path, 'docs.jsonl')
+        self.vectors_path = os.path.join(path, 'vectors.f32')
+        self.row_size = len(self.vector_fields) * self.dim
+        self.open()
+
+    def open(self) -> None:
+        self.nb_rows = (os.path.getsize(self.vectors_path) // 4
+                        // max(1, self.row_size)
+                        if os.path.exists(self.vectors_path) else 0)
+        self.mapped: np.ndarray = np.zeros(
+            (0, len(self.vector_fields), self.dim), np.float32)
+
+        if os.path.exists(self.docs_path):
+            with open(self.docs_path, 'r') as file:
+                for line in file:
+                    self.apply(json.loads(line))
+
+        self.log = open(self.docs_path, 'a')
+        self.vectors_file = open(self.vectors_path, 'ab')
+
+    def close(self) -> None:
+        self.log.close()
+        self.vectors_file.close()
+
+    def flush(self) -> None:
+        self.log.flush()
+        self.vectors_file.flush()
+
+    def write(self, op_type: str, doc_id: str, source: Dict[str, Any]
+              ) -> bool:
+        """Apply the write and append it to the log, False if the document
+        to update or delete does not exist"""
+        if op_type != 'index' and doc_id not in self.docs:
+            return False
+
+        if op_type == 'delete':
+            entry: Dict[str, Any] = {'op': op_type, 'id': doc_id}
+        else:
+            vectors = {field: value for field, value in source.items()
+                       if field in self.vector_fields}
+            row = self.rows.get(doc_id) if op_type == 'update' else None
+            if vectors:
+                row = self.append_vectors(vectors, row)
+            entry = {'op': op_type, 'id': doc_id, 'row': row,
+                     'vectors': list(vectors),
+                     'source': {field: value
+                                for field, value in source.items()
+                                if field not in self.vector_fields}}
+
+        # Kept as read back from the log, dates as iso strings
+        line = json.dumps(entry, default=json_default)
+        self.apply(json.loads(line))
+        self.log.write(line + '\n')
+        return True
+
+    def apply(self, entry: Dict[str, Any]) -> None:
+        doc_id = entry['id']
+        self.version += 1
+
+        if entry['op'] == 'delete':
+            self.docs.pop(doc_id, None)
+            self.rows.pop(doc_id, None)
+            self.vectors_of.pop(doc_id, None)
+            self.terms.pop(doc_id, None)
+            return
+
+        if entry['op'] == 'update':
+            source = {**self.docs.get(doc_id, {}), **entry['source']}
+            vectors = set(self.vectors_of.get(doc_id, [])) | set(
+                entry['vectors'])
+        else:
+            source = entry['source']
+            vectors = set(entry['vectors'])
+
+        self.docs[doc_id] = source
+        self.vectors_of[doc_id] = sorted(vectors)
+        if entry['row'] is None:
+            self.rows.pop(doc_id, None)
+        else:
+            self.rows[doc_id] = entry['row']
+        self.terms[doc_id] = {
+            field: words(str(source[field]))
+            for field in list(CHUNK_TEXT_FIELDS) + list(NODE_TEXT_FIELDS)
+            if source.get(field)}
+
+    def append_vectors(self, vectors: Dict[str, Any],
+                       previous: Optional[int]) -> int:
+        """Write a new row of embeddings, completed with the previous row of
+        the document if any, and give its index"""
+        row = (np.array(self.matrix()[previous]) if previous is not None
+               else np.zeros((len(self.vector_fields), self.dim),
+                             np.float32))
+        for field, vector in vectors.items():
+            row[self.vector_fields.index(field)] = vector
+
+        self.vectors_file.write(row.astype(np.float32).tobytes())
+        self.nb_rows += 1
+        return self.nb_rows - 1
+
+    def matrix(self) -> np.ndarray:
+        """(rows, nb vector fields, dim) memory mapped embeddings"""
+        if len(self.mapped) < self.nb_rows:
+            self.vectors_file.flush()
+            self.mapped = np.memmap(
+                self.vectors_path, dtype=np.float32, mode='r',
+                shape=(self.nb_rows, len(self.vector_fields), self.dim))
+        return self.mapped
+
+    def source(self, doc_id: str, fields: Optional[List[str]] = None
+               ) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            stored = self.docs.get(doc_id)
+            if stored is None:
+                return None
+            source = {field: value for field, value in stored.items()
+                      if fields is None or field in fields}
+
+            row = self.rows.get(doc_id)
+            for field in self.vectors_of.get(doc_id, []):
+                if row is not None and (fields is None or field in fields):
+                    source[field] = self.matrix()[
+                        row, self.vector_fields.index(field)].tolist()
+            return source
+
+    def chunk_arrays(self) -> Tuple[Any, ...]:
+        """Ids, rows of the embeddings, dates and node ids of the chunks,
+        recomputed after writes"""
+        with self.lock:
+            if self.cached is None or self.cached[0] != self.version:
+                ids = [doc_id for doc_id, source in self.docs.items()
+                       if relation_name(source) == "chunk"]
+                rows = np.asarray([self.rows.get(doc_id, -1)
+                                   for doc_id in ids], np.int64)
+                dates = np.asarray([timestamp(self.docs[doc_id].get(
+                    'first_seen_date')) for doc_id in ids])
+                parents = [self.docs[doc_id]['relation'].get('parent')
+                           for doc_id in ids]
+                self.cached = (self.version, (ids, rows, dates, parents))
+            return self.cached[1]
+
+    def sparse_scores(self, ids: List[str], parents: List[Optional[str]],
+                      lem_question: str, options: Dict[str, Any]
+                      ) -> np.ndarray:
+        """Best field of the chunk plus best field of its node, a field
+        scoring its boost times the number of words of the question in it
+        """
+        question = words(lem_question)
+
+        def best_field(doc_id: Optional[str], fields: Dict[str, str]
+                       ) -> float:
+            terms = self.terms.get(doc_id or '', {})
+            return max((options[boost] * len(question & terms[field])
+                        for field, boost in fields.items()
+                        if field in terms), default=0.0)
+
+        node_scores: Dict[Optional[str], float] = {}
+        scores = np.zeros(len(ids))
+        with self.lock:
+            for idx, (doc_id, parent) in enumerate(zip(ids, parents)):
+                if parent not in node_scores:
+                    node_scores[parent] = best_field(parent,
+                                                     NODE_TEXT_FIELDS)
+                scores[idx] = (best_field(doc_id, CHUNK_TEXT_FIELDS)
+                               + node_scores[parent])
+        return scores
+
+    def dense_scores(self, rows: np.ndarray, question_embed: List[float],
+                     options: Dict[str, Any]) -> np.ndarray:
+        """Weighted cosines shifted to be positive, as in the dense script
+        of :func:`search_body`"""
+        question = normalize(np.asarray(question_embed, np.float32))
+        with self.lock:
+            matrix = self.matrix()
+
+        scores = np.zeros(len(rows))
+        for field, weight in DENSE_FIELDS.items():
+            scores += options[weight]
+            if field not in self.vector_fields or not len(matrix):
+                continue
+            # Chunks without embeddings (row -1) have null cosines
+            vectors = matrix[np.maximum(rows, 0),
+                             self.vector_fields.index(field)]
+            scores += options[weight] * np.where(
+                rows >= 0, normalize(vectors) @ question, 0)
+        return scores
+
+    def compact(self) -> None:
+        """Rewrite the log and the embeddings with the live documents only
+        (readers of the previous mapping keep their own copy)"""
+        live = sorted(self.rows, key=self.rows.get)
+        matrix = self.matrix()
+        new_rows = {doc_id: row for row, doc_id in enumerate(live)}
+
+        with open(self.vectors_path + '.tmp', 'wb') as file:
+            for doc_id in live:
+                file.write(np.asarray(matrix[self.rows[doc_id]]).tobytes())
+        with open(self.docs_path + '.tmp', 'w') as file:
+            for doc_id, source in self.docs.items():
+                file.write(json.dumps({
+                    'op': 'index', 'id': doc_id, 'source': source,
+                    'row': new_rows.get(doc_id),
+                    'vectors': self.vectors_of.get(doc_id, [])}) + '\n')
+
+        self.close()
+        os.replace(self.vectors_path + '.tmp', self.vectors_path)
+        os.replace(self.docs_path + '.tmp', self.docs_path)
+        self.docs, self.rows, self.vectors_of, self.terms = {}, {}, {}, {}
+        self.open()
+
+
+def create_store(kind: str = STORAGE_BACKEND) -> Store:
+    """Storage backend of the given kind (elasticsearch | local)"""
+    if kind == 'elasticsearch':
+        return ElasticStore()
+    if kind == 'local':
+        return LocalStore()
+    raise ValueError(f"Unknown storage backend {kind}, "
+                     "expected elasticsearch or local")
+
+
+def relation_name(source: Dict[str, Any]) -> Optional[str]:
+    relation = source.get('relation')
+    return relation.get('name') if isinstance(relation, dict) else relation
+
+
+def words(text: str) -> Set[str]:
+    return set(WORD.findall(text.lower()))
+
+
+def timestamp(date: Optional[str]) -> float:
+    """Timestamp of an iso date, chunks without a date are far in the past
+    (no date boost)"""
+    return datetime.fromisoformat(date).timestamp() if date else 0.0
+
+
+def json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not json serializable")
@@ -0,0 +1,138 @@
+"""
+Streaming ingestion of the datasets.
+
+A dataset can be a nested json (one RawEntry with its children) or a jsonl
+file with one entry per line (without its children) referencing its parent
+id, written in depth first order. The jsonl is read line by line so only the
+chunks of the current entry and of its ancestors are kept in memory.
+
+Convert a nested dataset with python -m indexer.stream datasets/gouv/all.json
+"""
+import json
+import os
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, cast
+
+from datatypes import Chunk, FlatEntry, Models, Node, RawEntry
+
+from .parallel import slim_parent
+
+
+def read_entries(path: str) -> Iterator[FlatEntry]:
+    """Entries of a dataset in depth first order, streamed if jsonl (a
+    nested json is loaded at once, convert it to stream it)"""
+    if path.endswith('.jsonl'):
+        with open(path, 'r') as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, 'r') as file:
+            raw_entry: RawEntry = json.load(file)
+        yield from flatten(raw_entry)
+
+
+def dataset_path(name: str, folder: str = 'datasets/gouv') -> str:
+    """The jsonl version of the dataset if it exists, else the json one"""
+    jsonl_path = os.path.join(folder, f'{name}.jsonl')
+    if os.path.exists(jsonl_path):
+        return jsonl_path
+    return os.path.join(folder, f'{name}.json')
+
+
+def flatten(raw_entry: RawEntry, parent: Optional[str] = None,
+            prefix: str = '0') -> Iterator[FlatEntry]:
+    """Entries of the tree in depth first order, ids are their position"""
+    entry = {k: v for k, v in raw_entry.items() if k != 'children'}
+    yield cast(FlatEntry, {**entry, 'id': prefix, 'parent': parent})
+
+    for idx, child in enumerate(raw_entry.get('children') or []):
+        yield from flatten(child, prefix, f'{prefix}.{idx}')
+
+
+def load_tree(path: str) -> RawEntry:
+    """The whole tree of a dataset, for what needs it at once (updates),
+    loaded in memory whatever its format"""
+    if path.endswith('.jsonl'):
+        return unflatten(read_entries(path))
+
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def unflatten(entries: Iterable[FlatEntry]) -> RawEntry:
+    """Rebuild the tree from its entries, see :func:`flatten`"""
+    nodes: Dict[str, RawEntry] = {}
+    root: Optional[RawEntry] = None
+    for entry in entries:
+        node = entry_only(entry)
+        node['children'] = []
+        nodes[entry['id']] = node
+        if entry['parent'] is None:
+            root = node
+        else:
+            children = nodes[entry['parent']]['children']
+            assert children is not None
+            children.append(node)
+
+    if root is None:
+        raise ValueError("No root entry in the dataset")
+    return root
+
+
+def entry_only(entry: FlatEntry) -> RawEntry:
+    """The entry without its position in the tree"""
+    return cast(RawEntry, {k: v for k, v in entry.items()
+                           if k not in ('id', 'parent')})
+
+
+def write_jsonl(raw_entry: RawEntry, path: str) -> int:
+    nb_entries = 0
+    with open(path, 'w') as file:
+        for entry in flatten(raw_entry):
+            file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            nb_entries += 1
+    return nb_entries
+
+
+def iter_entries_stream(db_name: str, entries: Iterable[FlatEntry],
+                        models: Models) -> Iterator[Tuple[Node, List[Chunk]]]:
+    """Same as :func:`~indexer.indexer.iter_entries` from entries in depth
+    first order, keeping only the chunks of the ancestors of the current
+    entry.
+
+    Raises:
+        ValueError: If an entry comes before its parent or after a sibling
+        of its parent
+    """
+    # Import here as indexer.indexer imports this module
+    from .indexer import build_chunks, build_node, clean_entry
+
+    ancestors: List[Tuple[str, List[Chunk]]] = []
+
+    for entry in entries:
+        while ancestors and ancestors[-1][0] != entry['parent']:
+            ancestors.pop()
+        if entry['parent'] is not None and not ancestors:
+            raise ValueError(f"Entry {entry['id']} does not follow its "
+                             f"parent {entry['parent']} (depth first order)")
+
+        parents = ancestors[-1][1] if ancestors else []
+        raw_entry = entry_only(entry)
+        links = clean_entry(raw_entry)
+        chunks = build_chunks(db_name, raw_entry, links, models, parents)
+
+        yield build_node(raw_entry, parents, models), chunks
+
+        # Only what parent_fields needs is kept for the children
+        ancestors.append((entry['id'],
+                          [slim_parent(chunk) for chunk in chunks]))
+
+
+if __name__ == '__main__':
+    for json_path in sys.argv[1:]:
+        with open(json_path, 'r') as json_file:
+            tree: RawEntry = json.load(json_file)
+        jsonl_path = os.path.splitext(json_path)[0] + '.jsonl'
+        print(f"{write_jsonl(tree, jsonl_path)} entries written to "
+              f"{jsonl_path}")
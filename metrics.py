@@ -0,0 +1,93 @@
+"""
+Timers and counters of the stages of the indexing and of the answering.
+
+They are exported with prometheus (see the /metrics endpoint of service.py)
+and, for a traced request, also collected in its :class:`Trace` which is
+appended as a json line to TRACE_LOG if set.
+"""
+import json
+import resource
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from config import TRACE_LOG
+
+STAGE_SECONDS = Histogram('qa_stage_seconds', "Duration of each stage",
+                          ['stage'])
+EVENTS = Counter('qa_events', "Number of events of each kind (supports "
+                 "processed, sentences re-embedded, fallbacks...)", ['event'])
+MODEL_LOAD_SECONDS = Gauge('qa_model_load_seconds',
+                           "Loading time of each model", ['role', 'lang'])
+MAX_RSS_BYTES = Gauge('qa_max_rss_bytes',
+                      "Peak resident memory of the process")
+# ru_maxrss is in kilobytes on linux
+MAX_RSS_BYTES.set_function(
+    lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+TRACE_LOG_LOCK = threading.Lock()
+
+
+class Trace:
+    """Stages durations and events counts of one request"""
+
+    def __init__(self, name: str) -> None:
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.start = time.time()
+        self.duration = 0.0
+        self.stages: List[Dict[str, Any]] = []
+        self.events: Dict[str, int] = {}
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'id': self.id, 'name': self.name, 'start': self.start,
+                'duration': self.duration, 'stages': self.stages,
+                'events': self.events}
+
+
+CURRENT_TRACE: ContextVar[Optional[Trace]] = ContextVar('trace',
+                                                        default=None)
+
+
+@contextmanager
+def trace(name: str, log_path: Optional[str] = TRACE_LOG
+          ) -> Iterator[Trace]:
+    """Collect the stages and events of the code run inside (in the same
+    thread or task, executors need a copy of the context)"""
+    current = Trace(name)
+    token = CURRENT_TRACE.set(current)
+    try:
+        yield current
+    finally:
+        CURRENT_TRACE.reset(token)
+        current.duration = time.time() - current.start
+        if log_path:
+            with TRACE_LOG_LOCK, open(log_path, 'a') as file:
+                file.write(json.dumps(current.as_dict()) + '\n')
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_SECONDS.labels(name).observe(duration)
+        current = CURRENT_TRACE.get()
+        if current is not None:
+            current.stages.append({'stage': name, 'seconds': duration})
+
+
+def count(event: str, amount: int = 1) -> None:
+    if not amount:
+        return
+    EVENTS.labels(event).inc(amount)
+    current = CURRENT_TRACE.get()
+    if current is not None:
+        current.events[event] = current.events.get(event, 0) + amount
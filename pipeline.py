@@ -3,16 +3,22 @@ This file is made to run the streamlit application.
 
 You need to call it with streamlit run pipeline.py
 """
-import json
 import logging
 from typing import Any, List, Tuple
 
 import streamlit as st
 
-from datatypes import EmbeddingMode, Indexes, Models, RawEntry, RetrieveMode
-from indexer.indexer import preprocess
-from qa.refinder import answer_question_by_chunks, answer_question_by_summary
-from qa.retriever import retrieve_docs
+from config import ANSWER_BUDGET_MS, RESCORE_WINDOW
+from datatypes import EmbeddingMode, Indexes, Models, RetrieveMode
+from embedders.registry import load_times
+from indexer.indexer import build_ann, build_sparse, preprocess, update_add
+from indexer.sidecar import remove_sidecars
+from indexer.stream import dataset_path, load_tree, read_entries
+from metrics import trace
+from qa.budget import Budget
+from qa.orchestrator import answer_question, retrieve_docs_async, run_in_loop
+from qa.refinder import SUMMARY_CACHE
+from qa.retriever import RETRIEVE_CACHE
 
 st.title('Gouv bot')
 logging.getLogger("transformers.tokenization_utils_base"
@@ -32,11 +38,20 @@ dataset: RetrieveMode = st.sidebar.selectbox(
 st.sidebar.subheader("Retrieving options")
 
 retrieve_mode: RetrieveMode = st.sidebar.selectbox(
-    label="Retrieve mode", options=['dense', 'hybrid', 'sparse'])
+    label="Retrieve mode",
+    options=['dense', 'hybrid', 'sparse', 'ann', 'bm25', 'rescore', 'rrf'])
+
+rescore_window: int = st.sidebar.slider(
+    label="Candidates of each leg (rescore and rrf modes)", min_value=10,
+    max_value=1000, value=RESCORE_WINDOW, step=10)
 
 retrieve_nb: int = st.sidebar.slider(
     label="Number of docs", min_value=1, max_value=100, value=10, step=1)
 
+budget_ms: int = st.sidebar.slider(
+    label="Latency budget in ms (0 for none)", min_value=0,
+    max_value=20000, value=int(ANSWER_BUDGET_MS or 0), step=100)
+
 boost_date: float = st.sidebar.slider(
     label="Date decay", min_value=0.0, max_value=10.0, value=0.1, step=0.1)
 
@@ -101,11 +116,12 @@ def ask_question(indexes: Indexes, models: Models, question: str
     Returns:
 
     """
-    return retrieve_docs(
+    return run_in_loop(indexes, retrieve_docs_async(
         f"{dataset}_{embedding_mode}", indexes, models, question,
         options={
             'retrieve_nb': retrieve_nb,
             'retrieve_mode': retrieve_mode,
+            'rescore_window': rescore_window,
             'boost_lem': boost_lem,
             'boost_page_lem': boost_page_lem,
             'boost_ner': boost_ner,
@@ -119,7 +135,7 @@ def ask_question(indexes: Indexes, models: Models, question: str
             'boost_parent_embedding': boost_parent_embedding,
             'boost_content_embedding': boost_content_embedding,
             'embedding_mode': embedding_mode,
-        })
+        }))
 
 
 @ st.cache(allow_output_mutation=True)
@@ -131,13 +147,29 @@ def preprocess_data() -> Tuple[Indexes, Models]:
             Indexes : for now just elasticsearch with all chunks processed
             Models : Embedder, Q&A and spacy processor
     """
-    with open(f'datasets/gouv/{dataset}.json', 'r') as file:
-        data: RawEntry = json.load(file)
-    indexes, models = preprocess(f"{dataset}_{embedding_mode}", data)
+    # Entries are indexed while the dataset is read
+    entries = read_entries(dataset_path(dataset))
+    # Answering models are loaded while the index is built
+    indexes, models = preprocess(f"{dataset}_{embedding_mode}", entries,
+                                 prewarm_roles=['answerer', 'summarizer'])
 
     return indexes, models
 
 
+def update_indexes(indexes: Indexes, models: Models):
+    """Update the index (elasticsearch) choosen in the sidebar with the
+    current dataset, only recomputing the entries which changed
+
+    Args:
+        indexes (Indexes): Indexes (for now just db : elasticsearch)
+        models (Models)
+    """
+    data = load_tree(dataset_path(dataset))
+    update_add(f"{dataset}_{embedding_mode}", data, indexes, models)
+    build_ann(f"{dataset}_{embedding_mode}", indexes)
+    build_sparse(f"{dataset}_{embedding_mode}", indexes)
+
+
 def clear_indexes(indexes: Indexes):
     """Remove the index (elasticsearch) choosen in the sidebar
     and compute a new one from scratch
@@ -145,8 +177,8 @@ def clear_indexes(indexes: Indexes):
     Args:
         indexes (Indexes): Indexes (for now just db : elasticsearch)
     """
-    indexes['db'].indices.delete(index=f"{dataset}_{embedding_mode}",
-                                 ignore=[400, 404])
+    indexes['db'].delete(f"{dataset}_{embedding_mode}")
+    remove_sidecars(f"{dataset}_{embedding_mode}")
     st.caching.clear_cache()
 
 
@@ -159,7 +191,8 @@ if st.button('ask'):
         indexes, models = preprocess_data()
     st.success('Database created sucessfully !')
 
-    with st.spinner('Fetching...'):
+    budget = Budget.from_ms(budget_ms)
+    with st.spinner('Fetching...'), trace('retrieve') as retrieve_trace:
         question_embed, supports, max_score, hits = ask_question(indexes,
                                                                  models,
                                                                  user_input)
@@ -170,6 +203,14 @@ if st.button('ask'):
         st.write(max_score)
         st.write("Hits")
         st.write(hits)
+        st.write("Retrieval cache")
+        st.write(RETRIEVE_CACHE.stats())
+        st.write("Summary cache")
+        st.write(SUMMARY_CACHE.stats())
+        st.write("Models loading times")
+        st.write(load_times(models))
+        st.write("Retrieval trace")
+        st.write(retrieve_trace.as_dict())
         st.write("Docs")
         st.write([
             {
@@ -180,15 +221,27 @@ if st.button('ask'):
             for sup in supports
         ])
 
-    with st.spinner('Answering...'):
-        answer = answer_question_by_chunks(question_embed, user_input,
-                                           supports, models)
+    # The summary is computed at the same time as the answer
+    with st.spinner('Answering and summarizing...'), \
+            trace('answer') as answer_trace:
+        answer, summary = run_in_loop(indexes, answer_question(
+            question_embed, user_input, supports, models,
+            indexes['sentences'], budget))
     st.success('Answer found')
     st.write(answer)
+    st.write(summary)
+    if budget.skipped:
+        st.warning(f"Skipped to meet the budget : {', '.join(budget.skipped)}")
 
-    with st.spinner('Summarizing...'):
-        answer = answer_question_by_summary(supports, models)
-    st.write(answer)
+    with st.beta_expander("See the answering traces"):
+        st.write(answer_trace.as_dict())
+
+if st.button('update database'):
+    with st.spinner('Processing...'):
+        indexes, models = preprocess_data()
+    with st.spinner('Updating...'):
+        update_indexes(indexes, models)
+    st.success('Done!')
 
 if st.button('clear database'):
     with st.spinner('Processing...'):
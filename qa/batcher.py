@@ -0,0 +1,80 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Any, Callable, List, Optional, Tuple
+
+from config import SERVICE_BATCH_WAIT_MS, SERVICE_MAX_BATCH
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent requests into calls of a batched function.
+
+    The first request of a batch waits at most wait_ms for other ones (up to
+    max_batch requests), then the batched function runs on the executor
+    with the list of all the items and must give back one result per item.
+    The next batch is collected while the previous one is computed.
+
+    It is used in :class:`~service.QAService`
+    """
+
+    def __init__(self, batch_fn: Callable[[List[Any]], List[Any]],
+                 executor: Optional[Executor] = None,
+                 max_batch: int = SERVICE_MAX_BATCH,
+                 wait_ms: float = SERVICE_BATCH_WAIT_MS) -> None:
+        self.batch_fn = batch_fn
+        self.executor = executor
+        self.max_batch = max_batch
+        self.wait = wait_ms / 1000
+        self.queue: Optional['asyncio.Queue[Tuple[Any, asyncio.Future]]'] = \
+            None
+        self.nb_batches = 0
+        self.nb_items = 0
+
+    async def submit(self, item: Any) -> Any:
+        if self.queue is None:
+            # Created lazily to belong to the running event loop
+            self.queue = asyncio.Queue()
+            asyncio.ensure_future(self.collect())
+
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def collect(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(),
+                                                        timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.nb_batches += 1
+            self.nb_items += len(batch)
+            asyncio.ensure_future(self.run(batch))
+
+    async def run(self, batch: List[Tuple[Any, asyncio.Future]]) -> None:
+        loop = asyncio.get_event_loop()
+        try:
+            results = await loop.run_in_executor(
+                self.executor, self.batch_fn, [item for item, _ in batch])
+        except Exception as error:  # noqa: B902
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        # Futures of the requests cancelled meanwhile (client gone, timeout)
+        # are already done
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def mean_batch_size(self) -> float:
+        return self.nb_items / self.nb_batches if self.nb_batches else 0.0
@@ -0,0 +1,73 @@
+"""
+Latency budget of a request : before a costly answering stage, the time it
+is expected to take (a moving average of its previous runs) is compared to
+the time left, and the stage is skipped (or shortened) when it would end
+after the deadline. The skipped stages are reported with the answer.
+
+It is used in :func:`~qa.refinder.answer_question_by_chunks`
+and :func:`~qa.refinder.answer_question_by_summary`
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from config import STAGE_COST_ESTIMATES, STAGE_COST_SMOOTHING
+from metrics import count
+
+ESTIMATES: Dict[str, float] = dict(STAGE_COST_ESTIMATES)
+ESTIMATES_LOCK = threading.Lock()
+
+
+def estimate(stage: str) -> float:
+    """Expected duration of the stage in seconds (0 if never run)"""
+    with ESTIMATES_LOCK:
+        return ESTIMATES.get(stage, 0.0)
+
+
+def observe(stage: str, seconds: float) -> None:
+    with ESTIMATES_LOCK:
+        previous = ESTIMATES.get(stage)
+        ESTIMATES[stage] = seconds if previous is None else (
+            (1 - STAGE_COST_SMOOTHING) * previous
+            + STAGE_COST_SMOOTHING * seconds)
+
+
+class Budget:
+    """Deadline of a request, from its creation (no deadline if seconds is
+    None, the stages durations are still measured) and the stages skipped
+    to meet it"""
+
+    def __init__(self, seconds: Optional[float] = None) -> None:
+        self.start = time.perf_counter()
+        self.deadline = None if seconds is None else self.start + seconds
+        self.skipped: List[str] = []
+
+    @classmethod
+    def from_ms(cls, milliseconds: Optional[float]) -> 'Budget':
+        return cls(None if not milliseconds else milliseconds / 1000)
+
+    def remaining(self) -> float:
+        if self.deadline is None:
+            return float('inf')
+        return self.deadline - time.perf_counter()
+
+    def allows(self, stage: str) -> bool:
+        """Whether the stage is expected to end before the deadline,
+        otherwise it is reported as skipped"""
+        if self.remaining() >= estimate(stage):
+            return True
+        self.skip(stage)
+        return False
+
+    def skip(self, stage: str) -> None:
+        if stage not in self.skipped:
+            self.skipped.append(stage)
+        count(f'skipped_{stage}')
+
+    @contextmanager
+    def measure(self, stage: str) -> Iterator[None]:
+        """Update the expected duration of the stage with the code inside"""
+        start = time.perf_counter()
+        yield
+        observe(stage, time.perf_counter() - start)
@@ -0,0 +1,88 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from config import RETRIEVE_CACHE_SIZE, RETRIEVE_CACHE_TTL
+from datatypes import Chunk, RetrieveOptions
+from utils import hash_text
+
+
+class ResultCache:
+    """
+    Bounded LRU cache with a time to live for computed results : the
+    retrievals (see :func:`retrieve_key`) and the summaries (see
+    :func:`summary_key`)
+
+    It is used in :func:`~qa.retriever.retrieve_docs` and
+    :func:`~qa.refinder.answer_question_by_summary`
+    """
+
+    def __init__(self, max_size: int = RETRIEVE_CACHE_SIZE,
+                 ttl: float = RETRIEVE_CACHE_TTL) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = \
+            OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        requests = self.hits + self.misses
+        return {'size': len(self.entries), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': self.hits / requests if requests else 0.0}
+
+
+def normalize_question(question: str) -> str:
+    return re.sub(r'\s+', ' ', question).strip().lower()
+
+
+def retrieve_key(db_name: str, question: str, options: RetrieveOptions,
+                 generation: int) -> Hashable:
+    """Results are reused for the same normalized question asked with the
+    same options on the same generation of the index (so any change of the
+    index invalidates them)"""
+    return (db_name, normalize_question(question),
+            tuple(sorted(options.items())), generation)
+
+
+def summary_key(supports: List[Chunk], max_length: int) -> Hashable:
+    """Summaries are reused for the same set of supports (chunks are hashed
+    on their content so any change of a support invalidates them)"""
+    hashes = sorted(chunk.get('chunk_hash') or hash_text(chunk['content'])
+                    for chunk in supports)
+    return (hash_text(" ".join(hashes)), max_length)
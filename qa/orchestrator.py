@@ -0,0 +1,121 @@
+"""
+Asynchronous answering of a question : the queries of the store are awaited
+with its async client (see :meth:`~indexer.storage.Store.search_async`)
+while the model stages run on the bounded MODEL_EXECUTOR, and the chunk QA
+and the summary of the supports run at the same time. The latency of a
+question is then close to the one of its slowest stage instead of the sum
+of all of them.
+
+It is used in :class:`~service.QAService` and in pipeline.py
+"""
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import (Any, Awaitable, Callable, Dict, List, Optional, Tuple,
+                    TypeVar, cast)
+
+from config import MODEL_WORKERS
+from datatypes import Answer, Chunk, Indexes, Models, RetrieveOptions
+from indexer.sidecar import SentenceStore
+from metrics import stage
+
+from .budget import Budget
+from .cache import ResultCache
+from .refinder import answer_question_by_chunks, answer_question_by_summary
+from .retriever import (RETRIEVE_CACHE, cache_lookup, embed_question,
+                        lemmatize_question, parent_ids, retrieve_index,
+                        search_embedding, set_parent_titles)
+
+MODEL_EXECUTOR = ThreadPoolExecutor(max_workers=MODEL_WORKERS)
+# Retrieve modes made of a single query of the store
+STORE_MODES = ('sparse', 'dense', 'hybrid')
+
+T = TypeVar('T')
+
+
+async def run_model(function: Callable[..., Any], *args: Any) -> Any:
+    """Run a blocking stage on MODEL_EXECUTOR"""
+    # Copy the context so the stages run in the thread are traced
+    context = contextvars.copy_context()
+    return await asyncio.get_event_loop().run_in_executor(
+        MODEL_EXECUTOR, context.run, function, *args)
+
+
+def run_in_loop(indexes: Indexes, coroutine: Awaitable[T]) -> T:
+    """Run the coroutine in a new event loop (from synchronous code like
+    the streamlit app), closing the async client of the store opened in it
+    """
+    async def run() -> T:
+        try:
+            return await coroutine
+        finally:
+            await indexes['db'].close_async()
+
+    return asyncio.run(run())
+
+
+async def retrieve_docs_async(db_name: str, indexes: Indexes, models: Models,
+                              question: str, options: RetrieveOptions,
+                              cache: Optional[ResultCache] = RETRIEVE_CACHE,
+                              question_embed: Optional[List[float]] = None,
+                              embed: Optional[Callable[
+                                  [str], Awaitable[List[float]]]] = None
+                              ) -> Tuple[List[float], List[Any], float, int]:
+    """Same as :func:`~qa.retriever.retrieve_docs`, the question is embedded
+    while it is lemmatized, and the single query of the sparse, dense and
+    hybrid modes is awaited when the store has an async client (the other
+    modes run on MODEL_EXECUTOR).
+    On a cache miss, the question is embedded with embed if given (like
+    batched with other requests) instead of on MODEL_EXECUTOR"""
+    key, cached = cache_lookup(cache, db_name, question, options)
+    if cached is not None:
+        return cached
+
+    if question_embed is None:
+        question_embed, lem_question = await asyncio.gather(
+            embed(question) if embed is not None
+            else run_model(embed_question, question, models),
+            run_model(lemmatize_question, question, models))
+    else:
+        lem_question = await run_model(lemmatize_question, question, models)
+    search_embed = search_embedding(indexes, question_embed)
+
+    store = indexes['db']
+    with stage(f"retrieve_{options['retrieve_mode']}"):
+        if store.supports_async and options['retrieve_mode'] in STORE_MODES:
+            supports, max_score, hits = await store.search_async(
+                db_name, lem_question, search_embed,
+                cast(Dict[str, Any], options))
+            node_ids = parent_ids(supports)
+            if node_ids:
+                set_parent_titles(supports, node_ids, await store.get_async(
+                    db_name, node_ids, fields=['parent_title']))
+        else:
+            supports, max_score, hits = await run_model(
+                retrieve_index, db_name, indexes, lem_question, search_embed,
+                options)
+
+    if cache is not None:
+        cache.put(key, (question_embed, list(supports), max_score, hits))
+
+    return question_embed, supports, max_score, hits
+
+
+async def answer_question(question_embed: List[float], question: str,
+                          supports: List[Chunk], models: Models,
+                          sentences: Optional[SentenceStore] = None,
+                          budget: Optional[Budget] = None,
+                          answer_batch: Optional[
+                              Callable[[List[Chunk]], List[Answer]]] = None
+                          ) -> Tuple[Answer, Answer]:
+    """Best span of the supports (see
+    :func:`~qa.refinder.answer_question_by_chunks`) and their summary (see
+    :func:`~qa.refinder.answer_question_by_summary`), computed at the same
+    time with the same budget"""
+    budget = budget or Budget()
+    answer, summary = await asyncio.gather(
+        run_model(lambda: answer_question_by_chunks(
+            question_embed, question, supports, models, sentences,
+            budget=budget, answer_batch=answer_batch)),
+        run_model(answer_question_by_summary, supports, models, budget))
+    return answer, summary
@@ -1,54 +1,206 @@
 import logging
 import re
+from contextlib import nullcontext
 from datetime import datetime
-from typing import Any, List, Tuple
+from typing import Any, Callable, List, Optional, Set, TypedDict
 
+import numpy as np
+
+from config import (ANSWER_BATCH_SIZE, SHORT_SUMMARY_MAX_LENGTH,
+                    SHORT_SUMMARY_SUPPORTS, SUMMARY_CACHE_SIZE,
+                    SUMMARY_CACHE_TTL, SUMMARY_MAX_LENGTH, SUMMARY_SUPPORTS)
 from datatypes import Answer, Chunk, Models
 from embedders.answerer import Answerer
-from utils import cosine_similarity, get_keylemmas
+from indexer.sidecar import SentenceStore
+from metrics import count, stage
+from utils import cosine_similarities, cosine_similarity, get_keylemmas
+
+from .budget import Budget
+from .cache import ResultCache, summary_key
 
 logging.getLogger("transformers.tokenization_utils_base"
                   ).setLevel(logging.ERROR)
 
+SUMMARY_CACHE = ResultCache(SUMMARY_CACHE_SIZE, SUMMARY_CACHE_TTL)
+
+
+class Span(TypedDict):
+    sentence: str
+    score: float
+    links: List[str]
+    lemmas: Set[str]
+    sentence_ids: List[int]
+
+
+def chunk_sentences(chunk: Chunk, nlp: Any) -> List[str]:
+    """Sentences of the chunk, from the boundaries stored at index time
+    (split with spacy for chunks indexed before they were stored)"""
+    if 'sentence_spans' in chunk:
+        return [chunk['content'][start:end]
+                for start, end in chunk['sentence_spans']]
+    return [s.text for s in nlp(chunk['content']).sents]
+
+
+def stored_lemmas(chunk: Chunk, field: str, text: str, nlp: Any
+                  ) -> Set[str]:
+    """Lemmas of the text stored at index time in the field of the chunk
+    (computed with spacy for chunks indexed before they were stored)"""
+    if field in chunk:
+        return set(chunk[field].split())  # type: ignore
+    return get_keylemmas(text, nlp)
+
+
+def sentences_lemmas(chunk: Chunk, sentences: List[str], nlp: Any
+                     ) -> List[Set[str]]:
+    """Lemmas of each sentence of the chunk, see :func:`stored_lemmas`"""
+    if 'lemma_sentences' in chunk:
+        return [set(lemmas.split()) for lemmas in chunk['lemma_sentences']]
+    return [get_keylemmas(sentence, nlp) for sentence in sentences]
+
 
-def get_best_span(chunk: Chunk, question: str, qa_model: Answerer, nlp: Any
-                  ) -> Tuple[str, float, List[str]]:
-    """Get the best full sentence answering the question within a context.
-    If possible add the next sentence as well
+def links_lemmas(chunk: Chunk, nlp: Any) -> List[Set[str]]:
+    """Lemmas of each link name of the chunk, see :func:`stored_lemmas`"""
+    if 'lemma_links' in chunk:
+        return [set(lemmas.split()) for lemmas in chunk['lemma_links']]
+    return [get_keylemmas(link['name'], nlp) for link in chunk['links']]
+
+
+def get_best_spans(chunks: List[Chunk], question: str, qa_model: Answerer,
+                   nlp: Any, qa_answers: Optional[List[Answer]] = None
+                   ) -> List[Span]:
+    """Get the best full sentence answering the question within each chunk.
+    If possible add the next sentence as well. All the chunks go through the
+    deep learning model in one batched call.
 
     Args:
-        context (str): Paragraph in which we want a sentence as answer
+        chunks (List[Chunk]): Paragraphs in which we want a sentence as answer
         question (str): A one line short question (should be interogative)
         qa_model (Answerer): The deep learning model
         nlp (Any): Spacy preprocessor for lemmatization, sentecizer, tokenizer
+        qa_answers (List[Answer], optional): Answers of the deep learning
+                    model if already computed (like batched with others)
+
+    Returns:
+        For each chunk the sentence, the QA score, the links related to the
+        question, the lemmas and the indexes of the sentences of the span
     """
-    qa_ans = qa_model.answer(question, chunk)
-    match = re.match(r'(^.+)\.', qa_ans['answer'])
-    chunk_sents: List[str] = [s.text for s in nlp(chunk['content']).sents]
-    clean_ans = match.groups()[0] if match else qa_ans['answer']
+    lem_question = get_keylemmas(question, nlp)
+    if qa_answers is None:
+        qa_answers = qa_model.answer_batch(question, chunks)
+
+    spans: List[Span] = []
+    for chunk, qa_ans in zip(chunks, qa_answers):
+        match = re.match(r'(^.+)\.', qa_ans['answer'])
+        chunk_sents = chunk_sentences(chunk, nlp)
+        chunk_sents_lemmas = sentences_lemmas(chunk, chunk_sents, nlp)
+        clean_ans = match.groups()[0] if match else qa_ans['answer']
+
+        # Get the full sentence from the elected span
+        ans_sent, idx = [(s, i) for i, s in enumerate(chunk_sents)
+                         if clean_ans in s][0]
+        lem_ans = set(chunk_sents_lemmas[idx])
+        sentence_ids = [idx]
+
+        # If possible add the sentence after the elected span as well
+        if idx + 1 < len(chunk_sents):
+            ans_sent += chunk_sents[idx+1]
+            lem_ans |= chunk_sents_lemmas[idx+1]
+            sentence_ids.append(idx+1)
+
+        links = []
+        for link, lem_link in zip(chunk['links'], links_lemmas(chunk, nlp)):
+            if lem_link.intersection(lem_question):
+                links.append(link['path'])
+        spans.append({'sentence': ans_sent, 'score': qa_ans['score'],
+                      'links': links, 'lemmas': lem_ans,
+                      'sentence_ids': sentence_ids})
+
+    return spans
+
 
-    # Get the full sentence from the elected span
-    ans_sent, idx = [(s, i) for i, s in enumerate(chunk_sents)
-                     if clean_ans in s][0]
+def embed_spans(spans: List[Span], chunks: List[Chunk], models: Models,
+                sentences: Optional[SentenceStore]) -> List[List[float]]:
+    """Embedding of each span, as the mean of the embeddings of its sentences
+    stored at index time (what the "sentence" embedding mode computes).
+    Spans of chunks missing from the store are embedded at once."""
+    ans_embeds: List[List[float]] = [None] * len(spans)  # type: ignore
+    missing: List[int] = []
+    for idx, (span, chunk) in enumerate(zip(spans, chunks)):
+        vectors = sentences.get(chunk['chunk_hash']) if sentences else None
+        if vectors is not None:
+            ans_embeds[idx] = np.mean(vectors[span['sentence_ids']],
+                                      axis=0).tolist()
+        else:
+            missing.append(idx)
 
-    # If possible add the sentence after the elected span as well
-    if idx + 1 < len(chunk_sents):
-        ans_sent += chunk_sents[idx+1]
+    count('sentences_reembedded', len(missing))
+    computed = models['embedder']['fr'].embed_batch(
+        [spans[idx]['sentence'] for idx in missing], "sentence")
+    for idx, ans_embed in zip(missing, computed):
+        ans_embeds[idx] = ans_embed
 
-    links = []
-    for link in chunk['links']:
-        if get_keylemmas(link['name'], nlp).intersection(
-                get_keylemmas(question, nlp)):
-            links.append(link['path'])
-    return ans_sent, qa_ans['score'], links
+    return ans_embeds
+
+
+def score_bounds(chunks: List[Chunk], question_embed: List[float],
+                 lem_question: Set[str], nlp: Any,
+                 sentences: Optional[SentenceStore]) -> List[float]:
+    """Upper bound of the combined score of each chunk, without running the
+    QA model : a QA score of 1, and the best keywords and cosine scores among
+    the spans the QA model can elect (a sentence with the next one). The
+    cosine is bounded by 1 for chunks missing from the sentences store."""
+    bounds: List[float] = []
+    for chunk in chunks:
+        sents = chunk_sentences(chunk, nlp)
+        sents_lemmas = sentences_lemmas(chunk, sents, nlp)
+        spans_lemmas = [lemmas | (sents_lemmas[idx+1]
+                                  if idx + 1 < len(sents_lemmas) else set())
+                        for idx, lemmas in enumerate(sents_lemmas)]
+        lem_title = stored_lemmas(chunk, 'lemma_title', chunk['title'], nlp)
+        lem_content = stored_lemmas(chunk, 'lemma_content', chunk['content'],
+                                    nlp)
+        score_keywords = (
+            max((len(lem_question.intersection(lemmas))
+                 for lemmas in spans_lemmas), default=0)
+            + len(lem_question.intersection(lem_content))
+            + len(lem_question.intersection(lem_title))
+        ) / max(len(lem_question), 1)
+
+        score_embed = 1.0
+        vectors = sentences.get(chunk['chunk_hash']) if sentences else None
+        if vectors is not None and len(vectors):
+            # Mean of each sentence with the next one (the last one alone)
+            spans = (vectors + np.concatenate([vectors[1:], vectors[-1:]])
+                     ) / 2
+            # Margin for the float32 rounding of the stored vectors
+            score_embed = float(cosine_similarities(
+                spans, question_embed).max()) + 1e-6
+
+        bounds.append(1.0 + score_keywords + score_embed)
+    return bounds
 
 
 def answer_question_by_chunks(question_embed: List[float], question: str,
-                              supports: List[Chunk], models: Models) -> Answer:
+                              supports: List[Chunk], models: Models,
+                              sentences: Optional[SentenceStore] = None,
+                              qa_answers: Optional[List[Answer]] = None,
+                              budget: Optional[Budget] = None,
+                              answer_batch: Optional[
+                                  Callable[[List[Chunk]], List[Answer]]
+                              ] = None) -> Answer:
     """
     Elect the best document among the supports.
     - First elect a chunk based on deep QA, keywords, and cosine
     - Then if span election is too low, get a span from keywords
+
+    Supports are answered by batches of ANSWER_BATCH_SIZE in retrieval score
+    order, until none of the remaining ones can beat the best combined score
+    (see :func:`score_bounds`) or the budget is spent. The sentence fallback
+    is skipped when it would end after the deadline.
+
+    Sentences embeddings are taken from the sentences store when given, and
+    the QA model is not run if its answers for the supports are given (or
+    through answer_batch, to batch them with other requests).
     """
 
     best_ans: Answer = {"content": '', "title": '', "score": 0.0,
@@ -58,55 +210,105 @@ def answer_question_by_chunks(question_embed: List[float], question: str,
     if not supports:
         return best_ans
 
+    budget = budget or Budget()
     best_score: float = 0.0
     best_chunk: Chunk = None  # type: ignore
     nlp = models['processor']['fr']
 
     lem_question = get_keylemmas(question, nlp)
 
-    # Docs one by one
-    for chunk in supports:
-        ans_sent, ans_score, links = get_best_span(
-            chunk=chunk, question=question, nlp=nlp,
-            qa_model=models['answerer']['fr'])
-
-        ans_embed = models['embedder']['fr'].embed(ans_sent, "sentence")
-        score_embed = cosine_similarity(question_embed, ans_embed)
-
-        lem_ans = get_keylemmas(ans_sent, nlp)
-        lem_title = get_keylemmas(chunk['title'], nlp)
-        lem_content = get_keylemmas(chunk['content'], nlp)
-
-        score_keywords = (len(lem_question.intersection(lem_ans)) +
-                          len(lem_question.intersection(lem_content))
-                          + len(lem_question.intersection(lem_title))
-                          ) / len(lem_question)
-
-        score = score_keywords + score_embed + ans_score
-
-        if score > best_score:
-            best_ans = {'score':  ans_score, 'answer': ans_sent,
-                        'content': chunk['content'],
-                        "title": chunk['title'],
-                        'date': chunk['first_seen_date'],
-                        'start': chunk['content'].index(ans_sent),
-                        'end': chunk['content'].index(ans_sent)+len(ans_sent),
-                        'elected': 'qa',
-                        'link': links}
-            best_chunk = chunk
-            best_score = score
-
-    if best_ans['score'] < 0.5:
+    order = sorted(range(len(supports)),
+                   key=lambda idx: -supports[idx].get('score', 0.0))
+    supports = [supports[idx] for idx in order]
+    if qa_answers is not None:
+        qa_answers = [qa_answers[idx] for idx in order]
+
+    bounds = score_bounds(supports, question_embed, lem_question, nlp,
+                          sentences)
+    # Best bound among the supports from each position to the end
+    remaining_bounds = np.maximum.accumulate(bounds[::-1])[::-1]
+
+    processed = 0
+    while processed < len(supports):
+        if processed and best_score >= remaining_bounds[processed]:
+            count('supports_pruned', len(supports) - processed)
+            break
+        if processed and not budget.allows('qa_batch'):
+            break
+
+        batch = supports[processed:processed+ANSWER_BATCH_SIZE]
+        batch_answers = None
+        if qa_answers is not None:
+            batch_answers = qa_answers[processed:processed+len(batch)]
+        processed += len(batch)
+        count('supports_processed', len(batch))
+
+        # Only the runs of the QA model tell the duration of a batch
+        with (budget.measure('qa_batch') if batch_answers is None
+              else nullcontext()), stage('chunk_qa'):
+            if batch_answers is None and answer_batch is not None:
+                batch_answers = answer_batch(batch)
+            spans = get_best_spans(chunks=batch, question=question, nlp=nlp,
+                                   qa_model=models['answerer']['fr'],
+                                   qa_answers=batch_answers)
+
+        with stage('embed_spans'):
+            ans_embeds = embed_spans(spans, batch, models, sentences)
+
+        for chunk, span, ans_embed in zip(batch, spans, ans_embeds):
+            ans_sent, ans_score, lem_ans = (span['sentence'], span['score'],
+                                            span['lemmas'])
+            score_embed = cosine_similarity(question_embed, ans_embed)
+
+            lem_title = stored_lemmas(chunk, 'lemma_title', chunk['title'],
+                                      nlp)
+            lem_content = stored_lemmas(chunk, 'lemma_content',
+                                        chunk['content'], nlp)
+
+            score_keywords = (len(lem_question.intersection(lem_ans)) +
+                              len(lem_question.intersection(lem_content))
+                              + len(lem_question.intersection(lem_title))
+                              ) / len(lem_question)
+
+            score = score_keywords + score_embed + ans_score
+
+            if score > best_score:
+                start = chunk['content'].index(ans_sent)
+                best_ans = {'score':  ans_score, 'answer': ans_sent,
+                            'content': chunk['content'],
+                            "title": chunk['title'],
+                            'date': chunk['first_seen_date'],
+                            'start': start, 'end': start+len(ans_sent),
+                            'elected': 'qa',
+                            'link': span['links']}
+                best_chunk = chunk
+                best_score = score
+
+    if (best_ans['score'] < 0.5 and best_chunk is not None
+            and budget.allows('sentence_fallback')):
+        count('sentence_fallback')
         best_ans: Answer = {"content": '', "title": '', "score": 0.0,
                             "start": 0, "end": 0, 'elected': 'n/a',
                             'date': datetime.now(), 'link': [''],
                             'answer': "No answer found, try to reformulate"}
 
-        for sent in [s.text for s in nlp(best_chunk['content']).sents]:
-            sent_score = cosine_similarity(
-                models['embedder']['fr'].embed(sent, "sentence"),
-                question_embed)
+        with budget.measure('sentence_fallback'), \
+                stage('sentence_fallback'):
+            sents = chunk_sentences(best_chunk, nlp)
+            links = [link['path'] for link, lem_link
+                     in zip(best_chunk['links'],
+                            links_lemmas(best_chunk, nlp))
+                     if lem_link.intersection(lem_question)]
+
+            sents_embeds = sentences.get(best_chunk['chunk_hash']
+                                         ) if sentences else None
+            if sents_embeds is None:
+                count('sentences_reembedded', len(sents))
+                sents_embeds = np.asarray(
+                    models['embedder']['fr'].embed_batch(sents, "sentence"))
+            sents_scores = cosine_similarities(sents_embeds, question_embed)
 
+        for sent, sent_score in zip(sents, sents_scores.tolist()):
             if sent_score > best_ans['score']:
                 start = best_chunk['content'].index(sent)
                 best_ans = {'score': sent_score, 'answer': sent,
@@ -115,11 +317,7 @@ def answer_question_by_chunks(question_embed: List[float], question: str,
                             'date': best_chunk['first_seen_date'],
                             'start': start, 'end': start+len(sent),
                             'elected': 'kw',
-                            'link': [
-                                li['path'] for li in best_chunk['links']
-                                if get_keylemmas(li['name'], nlp).intersection(
-                                    lem_question)
-                            ]}
+                            'link': links}
 
     return best_ans
     # # Concat all docs and find answer
@@ -129,7 +327,38 @@ def answer_question_by_chunks(question_embed: List[float], question: str,
     # return models['answerer']['fr'].answer(question, all_text)
 
 
-def answer_question_by_summary(supports: List[Chunk], models: Models
+def answer_question_by_summary(supports: List[Chunk], models: Models,
+                               budget: Optional[Budget] = None,
+                               cache: Optional[ResultCache] = SUMMARY_CACHE
                                ) -> Answer:
-    summary = models['summarizer']['fr'].summarize(supports)
-    return summary
+    """Summary of the supports (see
+    :meth:`~embedders.summarizer.Summarizer.summarize`), kept in the cache
+    for the same set of supports. When it would end after the deadline of
+    the budget, only the first SHORT_SUMMARY_SUPPORTS supports are
+    summarized in at most SHORT_SUMMARY_MAX_LENGTH tokens, or nothing if
+    even this shortened summary would not fit."""
+    budget = budget or Budget()
+    summarizer = models['summarizer']['fr']
+    for nb_supports, max_length, stage_name in (
+            (SUMMARY_SUPPORTS, SUMMARY_MAX_LENGTH, 'summarize'),
+            (SHORT_SUMMARY_SUPPORTS, SHORT_SUMMARY_MAX_LENGTH,
+             'summarize_short')):
+        key = summary_key(supports[:nb_supports], max_length)
+        cached = cache.get(key) if cache is not None else None
+        if cache is not None:
+            count('summary_cache_hit' if cached is not None
+                  else 'summary_cache_miss')
+        if cached is not None:
+            return dict(cached)  # type: ignore
+
+        if budget.allows(stage_name):
+            with budget.measure(stage_name), stage('summarize'):
+                summary = summarizer.summarize(supports, nb_supports,
+                                               max_length)
+            if cache is not None:
+                cache.put(key, summary)
+            return dict(summary)  # type: ignore
+
+    return {"content": '', "title": '', "score": 0.0, "start": 0, "end": 0,
+            'elected': 'n/a', 'date': datetime.now(), 'link': [''],
+            'answer': "No time left to summarize"}
@@ -1,91 +1,340 @@
-from datetime import datetime
-from typing import Any, List, Tuple, cast
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Hashable, List, Optional, Tuple, cast
 
+import numpy as np
+
+from config import RRF_K
 from datatypes import Answer, Indexes, Models, RetrieveOptions
+from indexer.ann import AnnIndex, date_decay, normalize
+from indexer.sidecar import read_generation
+from indexer.sparse import SparseIndex
+from indexer.storage import DENSE_FIELDS, Store, timestamp
+from metrics import count, stage
 
 from utils import get_keylemmas
 
+from .cache import ResultCache, retrieve_key
+
+RETRIEVE_CACHE = ResultCache()
+# Runs the sparse leg while the calling thread runs the dense one
+LEG_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# Chunk id, score and source (None when not fetched yet) of a leg result
+Candidate = Tuple[str, float, Optional[Dict[str, Any]]]
+
 
 def retrieve_docs(db_name: str, indexes: Indexes, models: Models,
-                  question: str, options: RetrieveOptions
+                  question: str, options: RetrieveOptions,
+                  cache: Optional[ResultCache] = RETRIEVE_CACHE,
+                  question_embed: Optional[List[float]] = None
                   ) -> Tuple[List[float], List[Any], float, int]:
+    """Retrieve the supports of the question, results are kept in the cache
+    until the index changes (pass cache=None to always query the index).
+    The question embedding is computed unless given.
+    See :func:`~qa.orchestrator.retrieve_docs_async` for the async version"""
+    key, cached = cache_lookup(cache, db_name, question, options)
+    if cached is not None:
+        return cached
 
-    question_embed = models['embedder']['fr'].embed(question, "all")
-    lem_question = " ".join(get_keylemmas(question, models['processor']['fr']))
-    supports, max_score, hits = retrieve_es(db_name, indexes['db'], question,
-                                            lem_question,
-                                            question_embed, options)
+    if question_embed is None:
+        question_embed = embed_question(question, models)
+    lem_question = lemmatize_question(question, models)
+    with stage(f"retrieve_{options['retrieve_mode']}"):
+        supports, max_score, hits = retrieve_index(
+            db_name, indexes, lem_question,
+            search_embedding(indexes, question_embed), options)
+
+    if cache is not None:
+        cache.put(key, (question_embed, list(supports), max_score, hits))
 
     return question_embed, supports, max_score, hits
 
 
-def retrieve_es(db_name: str, es: Any, question: str, lem_question: str,
-                question_embed: List[float], options: RetrieveOptions
-                ) -> Tuple[List[Any], float, int]:
-    query = {'multi_match': {
-        'query':  lem_question, 'fuzziness': "AUTO", "type": "best_fields",
-        # cross_fields, most_fields, best_fields
-        'fields': [
-            f"title^{options['boost_title']}",
-            f"content^{options['boost_content']}",
-            f"page_content^{options['boost_page']}",
-            f"lemma_content^{options['boost_lem']}",
-            f"lemma_page_content^{options['boost_page_lem']}",
-            f"parent_title^{options['boost_parent_title']}",
-            f"parent_content^{options['boost_parent_content']}"
-        ]}}
-
-    dense_script = {
-            "source": f"""
-            double content = {options['boost_content_embedding']} * cosineSimilarity(params.question_embed, 'content_embedding'); 
-            double title = {options['boost_title_embedding']} * cosineSimilarity(params.question_embed, 'title_embedding');
-            double parent = {options['boost_parent_embedding']} * cosineSimilarity(params.question_embed, 'parent_title_embedding');
-            double embed_score = content + title + parent + {options['boost_parent_embedding'] + options['boost_title_embedding'] + options['boost_content_embedding']};
-            double date_score =  {options['boost_date']} * decayDateGauss(params.origin, params.scale, params.offset, params.decay, doc['first_seen_date'].value);
-            return _score + embed_score + date_score;
-            """,  # noqa E501
-            "params": {
-                "origin": datetime.now(),
-                "scale": "30d",
-                "offset": "0",
-                "decay": 0.5,
-                "question_embed": question_embed,
-                }}
-
-    if options["retrieve_mode"] == "sparse":
-        es_query_body = {
-            "size": options['retrieve_nb'],
-            "min_score": "1.0",
-            "query":  query,
-        }
-
-    elif options["retrieve_mode"] == "dense":
-        es_query_body = {
-            "size": options['retrieve_nb'],
-            "min_score": "1.0",
-            "query": {"script_score": {"query": {"match_all": {}},
-                                       "script": dense_script}}
-        }
-
-    elif options["retrieve_mode"] == "hybrid":
-        es_query_body = {
-            "size": options['retrieve_nb'],
-            "min_score": "1.0",
-            "query": {"script_score": {"query": query, "script": dense_script}}
-        }
-
-    else:
-        raise RuntimeError(
-            "Retrieval mode can be only [sparse | dense | hybrid]")
-
-    res = es.search(index=db_name, body=es_query_body)
-    max_score = res['hits']['max_score']
-    hits = res['hits']['total']
+def cache_lookup(cache: Optional[ResultCache], db_name: str,
+                 question: str, options: RetrieveOptions
+                 ) -> Tuple[Hashable, Optional[Tuple[List[float], List[Any],
+                                                     float, int]]]:
+    """Key of the retrieval in the cache and its cached result if any"""
+    if cache is None:
+        return None, None
+
+    key = retrieve_key(db_name, question, options, read_generation(db_name))
+    cached = cache.get(key)
+    count('retrieve_cache_hit' if cached is not None
+          else 'retrieve_cache_miss')
+    if cached is None:
+        return key, None
+    question_embed, supports, max_score, hits = cached
+    return key, (question_embed, list(supports), max_score, hits)
+
+
+def embed_question(question: str, models: Models) -> List[float]:
+    with stage('embed_question'):
+        return models['embedder']['fr'].embed(question, "all")
+
+
+def lemmatize_question(question: str, models: Models) -> str:
+    with stage('lemmatize_question'):
+        return " ".join(get_keylemmas(question, models['processor']['fr']))
+
+
+def search_embedding(indexes: Indexes, question_embed: List[float]
+                     ) -> List[float]:
+    """The index holds projected embeddings, see indexer.compression"""
+    projection = indexes.get('projection')
+    return (projection(question_embed) if projection is not None
+            else question_embed)
+
+
+def retrieve_index(db_name: str, indexes: Indexes, lem_question: str,
+                   question_embed: List[float], options: RetrieveOptions
+                   ) -> Tuple[List[Any], float, int]:
+    """Sparse, dense or hybrid retrieval with the store (see
+    :meth:`~indexer.storage.Store.search`), dense with the ANN index or
+    sparse with the BM25 index"""
+    store = indexes['db']
+    if options["retrieve_mode"] == "ann":
+        return retrieve_ann(db_name, store, question_embed, options,
+                            indexes.get('ann'))
+    if options["retrieve_mode"] == "bm25":
+        return retrieve_bm25(db_name, store, lem_question, options,
+                             indexes.get('sparse'))
+    if options["retrieve_mode"] == "rescore":
+        return retrieve_rescore(db_name, indexes, lem_question,
+                                question_embed, options)
+    if options["retrieve_mode"] == "rrf":
+        return retrieve_rrf(db_name, indexes, lem_question, question_embed,
+                            options)
 
+    supports, max_score, hits = store.search(
+        db_name, lem_question, question_embed,
+        cast(Dict[str, Any], options))
+    add_parent_titles(db_name, store, supports)
+    return cast(List[Answer], supports), max_score, hits
+
+
+def retrieve_ann(db_name: str, store: Store, question_embed: List[float],
+                 options: RetrieveOptions, ann: Optional[AnnIndex]
+                 ) -> Tuple[List[Any], float, int]:
+    """Dense retrieval with the in process ANN index, only the documents of
+    the top chunks are fetched from the store.
+    Scores are the ones of the dense script_score query"""
+    if ann is None:
+        raise RuntimeError(f"There is no ANN index built for {db_name}")
+
+    weights = dense_weights(options)
+    top_chunks = ann.search(question_embed, weights, options['boost_date'],
+                            options['retrieve_nb'])
+    if not top_chunks:
+        return [], 0.0, 0
+
+    sources = store.get(db_name, [doc_id for doc_id, _ in top_chunks])
+
+    # match_all _score and shift of the cosines as in the dense script
+    shift = 1.0 + sum(weights)
     supports: List[Answer] = []
-    for doc in res['hits']['hits']:
-        supports.append(cast(Answer,
-                             {'score': doc['_score'], **doc["_source"]})
-                        )
+    for (_, score), source in zip(top_chunks, sources):
+        if source is not None:
+            supports.append(cast(Answer,
+                                 {'score': score + shift, **source}))
+
+    add_parent_titles(db_name, store, supports)
+    max_score = supports[0]['score'] if supports else 0.0
+    return supports, max_score, len(ann)
+
+
+def retrieve_bm25(db_name: str, store: Store, lem_question: str,
+                  options: RetrieveOptions, sparse: Optional[SparseIndex]
+                  ) -> Tuple[List[Any], float, int]:
+    """Sparse retrieval with the in process BM25 index of the lemma fields,
+    only the documents of the top chunks are fetched from the store"""
+    if sparse is None:
+        raise RuntimeError(f"There is no BM25 index built for {db_name}")
+
+    with stage('bm25_search'):
+        top_chunks = sparse.search(lem_question,
+                                   cast(Dict[str, Any], options),
+                                   options['retrieve_nb'])
+    if not top_chunks:
+        return [], 0.0, 0
+
+    sources = store.get(db_name, [doc_id for doc_id, _ in top_chunks])
+    supports: List[Answer] = [
+        cast(Answer, {'score': score, **source})
+        for (_, score), source in zip(top_chunks, sources)
+        if source is not None]
+
+    add_parent_titles(db_name, store, supports)
+    max_score = supports[0]['score'] if supports else 0.0
+    return supports, max_score, len(sparse)
+
+
+def retrieve_rescore(db_name: str, indexes: Indexes, lem_question: str,
+                     question_embed: List[float], options: RetrieveOptions
+                     ) -> Tuple[List[Any], float, int]:
+    """Two phase retrieval : the candidates of the sparse and dense legs
+    (see :func:`candidate_legs`) are rescored with the embeddings and date
+    part of the dense script added to their sparse score, as in the hybrid
+    mode (0 for the chunks only found by the dense leg).
+    The cost depends on the rescore window, not on the size of the index"""
+    sparse, dense = candidate_legs(db_name, indexes, lem_question,
+                                   question_embed, options)
+    sparse_scores = {doc_id: score for doc_id, score, _ in sparse}
+    sources = fetch_sources(db_name, indexes['db'], sparse + dense,
+                            [doc_id for doc_id, _, _ in sparse + dense])
+    if not sources:
+        return [], 0.0, 0
+
+    with stage('rescore'):
+        ids = list(sources)
+        scores = np.asarray([sparse_scores.get(doc_id, 0.0)
+                             for doc_id in ids]) + dense_script_scores(
+            [sources[doc_id] for doc_id in ids], question_embed, options)
+
+    supports: List[Answer] = [
+        cast(Answer, {'score': float(scores[idx]), **sources[ids[idx]]})
+        for idx in np.argsort(-scores, kind='stable')[
+            :options['retrieve_nb']]]
+    add_parent_titles(db_name, indexes['db'], supports)
+    return supports, supports[0]['score'], len(ids)
+
+
+def retrieve_rrf(db_name: str, indexes: Indexes, lem_question: str,
+                 question_embed: List[float], options: RetrieveOptions
+                 ) -> Tuple[List[Any], float, int]:
+    """Reciprocal rank fusion of the sparse and dense legs (see
+    :func:`candidate_legs`), the score of a chunk is the sum over the legs
+    of 1 / (RRF_K + its rank in the leg)"""
+    sparse, dense = candidate_legs(db_name, indexes, lem_question,
+                                   question_embed, options)
+    fused: Dict[str, float] = {}
+    for leg in (sparse, dense):
+        for rank, (doc_id, _, _) in enumerate(leg, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1 / (RRF_K + rank)
+
+    best = sorted(fused, key=lambda doc_id: -fused[doc_id])[
+        :options['retrieve_nb']]
+    sources = fetch_sources(db_name, indexes['db'], sparse + dense, best)
+    supports: List[Answer] = [
+        cast(Answer, {'score': fused[doc_id], **sources[doc_id]})
+        for doc_id in best if doc_id in sources]
+
+    add_parent_titles(db_name, indexes['db'], supports)
+    max_score = supports[0]['score'] if supports else 0.0
+    return supports, max_score, len(fused)
+
+
+def candidate_legs(db_name: str, indexes: Indexes, lem_question: str,
+                   question_embed: List[float], options: RetrieveOptions
+                   ) -> Tuple[List[Candidate], List[Candidate]]:
+    """Top rescore_window chunks of the sparse leg (BM25 index if built,
+    else the sparse query of the store) and of the dense leg (ANN index if
+    built, else the dense query of the store), run in parallel"""
+    window = options['rescore_window']
+    # A copy of the context so the stages of the leg are traced
+    sparse = LEG_EXECUTOR.submit(
+        contextvars.copy_context().run, sparse_leg, db_name, indexes,
+        lem_question, question_embed, options, window)
+    dense = dense_leg(db_name, indexes, lem_question, question_embed,
+                      options, window)
+    return sparse.result(), dense
+
+
+def sparse_leg(db_name: str, indexes: Indexes, lem_question: str,
+               question_embed: List[float], options: RetrieveOptions,
+               size: int) -> List[Candidate]:
+    with stage('sparse_leg'):
+        sparse = indexes.get('sparse')
+        if sparse is not None:
+            return [(doc_id, score, None) for doc_id, score in sparse.search(
+                lem_question, cast(Dict[str, Any], options), size)]
+        return store_leg(db_name, indexes['db'], lem_question,
+                         question_embed, options, 'sparse', size)
+
+
+def dense_leg(db_name: str, indexes: Indexes, lem_question: str,
+              question_embed: List[float], options: RetrieveOptions,
+              size: int) -> List[Candidate]:
+    with stage('dense_leg'):
+        ann = indexes.get('ann')
+        if ann is not None:
+            return [(doc_id, score, None) for doc_id, score in ann.search(
+                question_embed, dense_weights(options),
+                options['boost_date'], size)]
+        return store_leg(db_name, indexes['db'], lem_question,
+                         question_embed, options, 'dense', size)
+
+
+def store_leg(db_name: str, store: Store, lem_question: str,
+              question_embed: List[float], options: RetrieveOptions,
+              mode: str, size: int) -> List[Candidate]:
+    supports, _, _ = store.search(db_name, lem_question, question_embed, {
+        **options, 'retrieve_mode': mode, 'retrieve_nb': size})
+    return [(support['chunk_hash'], support['score'], support)
+            for support in supports]
+
+
+def fetch_sources(db_name: str, store: Store, candidates: List[Candidate],
+                  ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Sources of the chunks, the ones not given by the legs are fetched
+    from the store"""
+    sources = {doc_id: source for doc_id, _, source in candidates
+               if source is not None and doc_id in ids}
+    missing = [doc_id for doc_id in dict.fromkeys(ids)
+               if doc_id not in sources]
+    for doc_id, source in zip(missing, store.get(db_name, missing)):
+        if source is not None:
+            sources[doc_id] = source
+    return sources
+
+
+def dense_script_scores(sources: List[Dict[str, Any]],
+                        question_embed: List[float],
+                        options: RetrieveOptions) -> np.ndarray:
+    """Embeddings and date part of the dense script of
+    :func:`~indexer.storage.search_body` for the chunks"""
+    question = normalize(np.asarray(question_embed, np.float32))
+    scores = np.zeros(len(sources))
+    for field, weight in DENSE_FIELDS.items():
+        vectors = np.asarray([source[field] for source in sources],
+                             np.float32)
+        scores += options[weight] * (normalize(vectors) @ question + 1)
+
+    dates = np.asarray([timestamp(source.get('first_seen_date'))
+                        for source in sources])
+    return scores + options['boost_date'] * date_decay(dates)
+
+
+def dense_weights(options: RetrieveOptions) -> Tuple[float, ...]:
+    """Weights of the embedding fields of the ANN index"""
+    return (options['boost_content_embedding'],
+            options['boost_title_embedding'],
+            options['boost_parent_embedding'])
+
+
+def add_parent_titles(db_name: str, store: Store, supports: List[Any]
+                      ) -> None:
+    """Parent title of the supports, which is stored in their node"""
+    node_ids = parent_ids(supports)
+    if node_ids:
+        set_parent_titles(supports, node_ids, store.get(
+            db_name, node_ids, fields=['parent_title']))
+
+
+def parent_ids(supports: List[Any]) -> List[str]:
+    """Ids of the nodes of the supports"""
+    return list({support['relation']['parent']  # type: ignore
+                 for support in supports if 'relation' in support})
+
+
+def set_parent_titles(supports: List[Any], node_ids: List[str],
+                      nodes: List[Optional[Dict[str, Any]]]) -> None:
+    titles = {node_id: node.get('parent_title')
+              for node_id, node in zip(node_ids, nodes) if node is not None}
 
-    return supports, max_score, hits
+    for support in supports:
+        title = titles.get(support.get('relation', {})  # type: ignore
+                           .get('parent'))
+        if title is not None:
+            support['parent_title'] = title  # type: ignore
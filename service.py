@@ -0,0 +1,235 @@
+"""
+This file is made to run the question answering as a headless http service
+(to sit behind the botpress api).
+
+You need to call it with python service.py --db_name covid_all
+The index must have been built before (with the streamlit app for example),
+in the storage backend given with --backend (elasticsearch or local).
+
+Endpoints (POST, json body {"question": str, "options": RetrieveOptions}
+where options are optional and complete DEFAULT_OPTIONS) :
+- /retrieve : supports documents of the question
+- /answer : best span among the supports
+- /summarize : summary of the supports
+- /stats : batching and cache statistics (GET)
+- /metrics : stages durations and events counts, prometheus format (GET)
+
+With "budget_ms" in the body (ANSWER_BUDGET_MS by default) the answering
+stages which would end after this deadline are skipped or shortened, and
+listed under "skipped" (see qa/budget.py).
+
+With "trace": true in the body, the durations of the stages and the counts
+of events of the request are returned under "trace" (see metrics.py).
+
+Concurrent questions are batched together for the embedding and the QA
+models, see :class:`~qa.batcher.MicroBatcher`, and the queries of the store
+are awaited while the models run, see qa/orchestrator.py
+"""
+import argparse
+import asyncio
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, cast
+
+import tornado.ioloop
+import tornado.web
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from config import (ANSWER_BUDGET_MS, RESCORE_WINDOW, SERVICE_BATCH_WAIT_MS,
+                    SERVICE_MAX_BATCH, SERVICE_PORT, STORAGE_BACKEND)
+from datatypes import Answer, Chunk, Indexes, Models, RetrieveOptions
+from embedders.registry import load_times
+from indexer.indexer import create_indexes, create_models
+from indexer.storage import create_store
+from metrics import trace
+from qa.batcher import MicroBatcher
+from qa.budget import Budget
+from qa.orchestrator import retrieve_docs_async, run_model
+from qa.refinder import (SUMMARY_CACHE, answer_question_by_chunks,
+                        answer_question_by_summary)
+from qa.retriever import RETRIEVE_CACHE
+
+DEFAULT_OPTIONS: RetrieveOptions = {
+    'retrieve_nb': 10,
+    'retrieve_mode': 'dense',
+    'rescore_window': RESCORE_WINDOW,
+    'boost_lem': 1.0,
+    'boost_page_lem': 1.0,
+    'boost_ner': 1.0,
+    'boost_date': 0.1,
+    'boost_title': 1.0,
+    'boost_content': 1.0,
+    'boost_page': 1.0,
+    'boost_parent_title': 1.0,
+    'boost_parent_content': 1.0,
+    'boost_title_embedding': 1.0,
+    'boost_parent_embedding': 1.0,
+    'boost_content_embedding': 1.0,
+    'embedding_mode': 'all',
+}
+
+
+class QAService:
+    """Retrieve, answer and summarize with batching of concurrent questions
+    for the embedder and QA model"""
+
+    def __init__(self, db_name: str, indexes: Indexes, models: Models,
+                 max_batch: int = SERVICE_MAX_BATCH,
+                 wait_ms: float = SERVICE_BATCH_WAIT_MS) -> None:
+        self.db_name = db_name
+        self.indexes = indexes
+        self.models = models
+        # Answering threads (see qa.orchestrator.MODEL_EXECUTOR) wait for the
+        # QA batches, which must not queue behind them
+        self.batch_executor = ThreadPoolExecutor(max_workers=2)
+
+        self.embed_batcher = MicroBatcher(self.embed_questions,
+                                          self.batch_executor, max_batch,
+                                          wait_ms)
+        self.qa_batcher = MicroBatcher(self.answer_questions,
+                                       self.batch_executor, max_batch,
+                                       wait_ms)
+
+    def embed_questions(self, questions: List[str]) -> List[List[float]]:
+        return self.models['embedder']['fr'].embed_batch(questions, "all")
+
+    def answer_questions(self, requests: List[Tuple[str, List[Chunk]]]
+                         ) -> List[List[Answer]]:
+        """Run the QA model on the supports of all the questions at once"""
+        questions = [question for question, supports in requests
+                     for _ in supports]
+        chunks = [chunk for _, supports in requests for chunk in supports]
+        answers = self.models['answerer']['fr'].answer_pairs(questions,
+                                                             chunks)
+
+        results: List[List[Answer]] = []
+        for _, supports in requests:
+            results.append(answers[:len(supports)])
+            answers = answers[len(supports):]
+        return results
+
+    async def retrieve(self, question: str, options: RetrieveOptions
+                       ) -> Tuple[List[float], List[Any], float, int]:
+        # The question is only embedded on a miss of the retrieve cache
+        return await retrieve_docs_async(
+            self.db_name, self.indexes, self.models, question, options,
+            embed=self.embed_batcher.submit)
+
+    async def answer(self, question: str, options: RetrieveOptions,
+                     budget: Optional[Budget] = None) -> Answer:
+        question_embed, supports, _, _ = await self.retrieve(question,
+                                                             options)
+        loop = asyncio.get_event_loop()
+
+        def answer_batch(chunks: List[Chunk]) -> List[Answer]:
+            # Called from the executor, batched with the other requests
+            return asyncio.run_coroutine_threadsafe(
+                self.qa_batcher.submit((question, chunks)), loop).result()
+
+        return await run_model(lambda: answer_question_by_chunks(
+            question_embed, question, supports, self.models,
+            self.indexes['sentences'], budget=budget,
+            answer_batch=answer_batch))
+
+    async def summarize(self, question: str, options: RetrieveOptions,
+                        budget: Optional[Budget] = None) -> Answer:
+        _, supports, _, _ = await self.retrieve(question, options)
+        return await run_model(answer_question_by_summary, supports,
+                               self.models, budget)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'embed_mean_batch': self.embed_batcher.mean_batch_size(),
+                'qa_mean_batch': self.qa_batcher.mean_batch_size(),
+                'retrieve_cache': RETRIEVE_CACHE.stats(),
+                'summary_cache': SUMMARY_CACHE.stats(),
+                'models_load_times': load_times(
+                    cast(Dict[str, Any], self.models))}
+
+
+class QAHandler(tornado.web.RequestHandler):
+    def initialize(self, service: QAService, action: str) -> None:
+        self.service = service
+        self.action = action
+
+    async def post(self) -> None:
+        try:
+            body = json.loads(self.request.body or b'{}')
+            question = body['question']
+        except (ValueError, KeyError):
+            raise tornado.web.HTTPError(400, "Expected a json body with a "
+                                        "question")
+        options = cast(RetrieveOptions,
+                       {**DEFAULT_OPTIONS, **body.get('options', {})})
+        budget = Budget.from_ms(body.get('budget_ms', ANSWER_BUDGET_MS))
+
+        with trace(self.action) as request_trace:
+            if self.action == 'retrieve':
+                _, supports, max_score, hits = await self.service.retrieve(
+                    question, options)
+                result: Dict[str, Any] = {'supports': supports,
+                                          'max_score': max_score,
+                                          'hits': hits}
+            elif self.action == 'answer':
+                result = {'answer': await self.service.answer(
+                    question, options, budget), 'skipped': budget.skipped}
+            else:
+                result = {'answer': await self.service.summarize(
+                    question, options, budget), 'skipped': budget.skipped}
+
+        if body.get('trace'):
+            result['trace'] = request_trace.as_dict()
+
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(result, default=str))
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, service: QAService) -> None:
+        self.service = service
+
+    def get(self) -> None:
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(self.service.stats()))
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self) -> None:
+        self.set_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.write(generate_latest())
+
+
+def make_app(service: QAService) -> tornado.web.Application:
+    return tornado.web.Application([
+        (rf"/{action}", QAHandler, {'service': service, 'action': action})
+        for action in ('retrieve', 'answer', 'summarize')
+    ] + [(r"/stats", StatsHandler, {'service': service}),
+         (r"/metrics", MetricsHandler)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--db_name', default='covid_all')
+    parser.add_argument('--port', type=int, default=SERVICE_PORT)
+    parser.add_argument('--max_batch', type=int, default=SERVICE_MAX_BATCH)
+    parser.add_argument('--wait_ms', type=float,
+                        default=SERVICE_BATCH_WAIT_MS)
+    parser.add_argument('--backend', default=STORAGE_BACKEND,
+                        choices=['elasticsearch', 'local'])
+    args = parser.parse_args()
+
+    # create_indexes would create an empty index, that the streamlit app
+    # would then take as already built
+    if not create_store(args.backend).exists(args.db_name):
+        sys.exit(f"There is no index {args.db_name} in {args.backend}, "
+                 "build it first")
+
+    models = create_models(['fr'], prewarm_roles=['embedder', 'answerer'])
+
+    indexes, _ = create_indexes(args.db_name, models, args.backend)
+    service = QAService(args.db_name, indexes, models, args.max_batch,
+                        args.wait_ms)
+
+    make_app(service).listen(args.port)
+    print(f"Serving {args.db_name} on port {args.port}")
+    tornado.ioloop.IOLoop.current().start()
@@ -3,12 +3,12 @@ This file is made to run the streamlit application.
 
 You need to call it with streamlit run pipeline.py
 """
-import json
 import logging
 from typing import Tuple, List, Any
 
-from datatypes import Indexes, RawEntry, Models
+from datatypes import Indexes, Models
 from indexer.indexer import preprocess
+from indexer.stream import dataset_path, read_entries
 from qa.refinder import answer_question
 from qa.retriever import retrieve_docs
 
@@ -36,6 +36,7 @@ def ask_question(indexes: Indexes, models: Models, question: str
         f"gouv_{embedding_mode}", indexes, models, question,
         options={
             'retrieve_nb': 10,
+            'rescore_window': 100,
             'boost_lem': 1.0,
             'boost_ner': 1.0,
             'boost_date': 1.0,
@@ -58,10 +59,9 @@ def preprocess_data() -> Tuple[Indexes, Models]:
             Indexes : for now just elasticsearch with all chunks processed
             Models : Embedder, Q&A and spacy processor
     """
-    with open('datasets/gouv/DOCUMENTS.json', 'r') as file:
-        # with open('datasets/gouv/dummy.json', 'r') as file:
-        data: RawEntry = json.load(file)
-    indexes, models = preprocess(f"gouv_{embedding_mode}", data)
+    # dataset_path('dummy') for a smaller dataset
+    entries = read_entries(dataset_path('DOCUMENTS'))
+    indexes, models = preprocess(f"gouv_{embedding_mode}", entries)
 
     return indexes, models
 
@@ -72,8 +72,8 @@ def clear_indexes(indexes: Indexes):
     Args:
         indexes (Indexes): Indexes (for now just db : elasticsearch)
     """
-    for index in indexes['db'].indices.get('*'):
-        indexes['db'].indices.delete(index=index, ignore=[400, 404])
+    for index in indexes['db'].names():
+        indexes['db'].delete(index)
 
 
 indexes = None  # type: ignore
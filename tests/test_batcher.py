@@ -0,0 +1,32 @@
+import asyncio
+import threading
+import unittest
+from typing import List
+
+from qa.batcher import MicroBatcher
+
+
+class MicroBatcherTest(unittest.TestCase):
+    def test_cancelled_request_does_not_block_its_batch(self) -> None:
+        async def scenario() -> List[int]:
+            release = threading.Event()
+
+            def double(items: List[int]) -> List[int]:
+                release.wait(5)
+                return [item * 2 for item in items]
+
+            batcher = MicroBatcher(double, max_batch=8, wait_ms=20)
+            tasks = [asyncio.ensure_future(batcher.submit(item))
+                     for item in range(3)]
+            # Let the three requests be collected in a running batch
+            await asyncio.sleep(0.2)
+            tasks[1].cancel()
+            release.set()
+            return await asyncio.wait_for(
+                asyncio.gather(tasks[0], tasks[2]), 5)
+
+        self.assertEqual(asyncio.run(scenario()), [0, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+from typing import Any, Dict, List
+
+from embedders.config import SUMMARY_INPUT_TOKENS
+from embedders.summarizer import Summarizer
+
+
+class WordTokenizer:
+    """Tokens are words, framed by a start and an end token"""
+
+    def __init__(self) -> None:
+        self.vocab: Dict[str, int] = {}
+        self.words: List[str] = []
+
+    def __call__(self, text: str,
+                 add_special_tokens: bool = True) -> Dict[str, List[int]]:
+        ids = []
+        for word in text.split():
+            if word not in self.vocab:
+                self.vocab[word] = len(self.words) + 2
+                self.words.append(word)
+            ids.append(self.vocab[word])
+        return {'input_ids': [0] + ids + [1] if add_special_tokens else ids}
+
+    def num_special_tokens_to_add(self) -> int:
+        return 2
+
+    def decode(self, ids: List[int], **kwargs: Any) -> str:
+        return " ".join(self.words[idx - 2] for idx in ids if idx > 1)
+
+
+class WordPipeline:
+    """Summary made of the first words, fails like the model on an input
+    longer than its positions"""
+
+    def __init__(self) -> None:
+        self.tokenizer = WordTokenizer()
+        self.inputs: List[str] = []
+
+    def __call__(self, texts: List[str], min_length: int,
+                 max_length: int) -> List[Dict[str, str]]:
+        for text in texts:
+            if len(self.tokenizer(text)['input_ids']) > SUMMARY_INPUT_TOKENS:
+                raise IndexError("index out of range in self")
+        self.inputs.extend(texts)
+        return [{'summary_text': " ".join(text.split()[:max_length])}
+                for text in texts]
+
+
+class WordSummarizer(Summarizer):
+    def __init__(self) -> None:
+        self.summarizer = WordPipeline()
+
+
+def chunk(content: str, summary: str = "") -> Dict[str, Any]:
+    return {'content': content, 'summary': summary, 'title': "title"}
+
+
+class SummarizerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.summarizer = WordSummarizer()
+        self.long_text = " ".join(f"w{idx}" for idx in range(3000))
+
+    def assert_inputs_fit(self) -> None:
+        self.assertTrue(self.summarizer.summarizer.inputs)
+        for text in self.summarizer.summarizer.inputs:
+            self.assertLessEqual(self.summarizer.nb_tokens(text),
+                                 SUMMARY_INPUT_TOKENS)
+
+    def test_truncate_keeps_first_tokens(self) -> None:
+        text = self.summarizer.truncate(self.long_text)
+        self.assertEqual(self.summarizer.nb_tokens(text),
+                         SUMMARY_INPUT_TOKENS)
+        self.assertTrue(self.long_text.startswith(text))
+        self.assertEqual(self.summarizer.truncate("a b c"), "a b c")
+
+    def test_oversized_summaries_are_truncated(self) -> None:
+        supports = [chunk("content", self.long_text),
+                    chunk("content", self.long_text)]
+        answer = self.summarizer.summarize(supports)
+        self.assertTrue(answer['answer'])
+        self.assert_inputs_fit()
+
+    def test_oversized_content_is_truncated(self) -> None:
+        answer = self.summarizer.summarize([chunk(self.long_text)])
+        self.assertTrue(answer['answer'])
+        self.assert_inputs_fit()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -69,5 +69,31 @@ def cosine_similarity(a: List[float], b: List[float]) -> float:
         return 0
 
 
+def cosine_similarities(matrix: np.ndarray, vector: List[float]
+                        ) -> np.ndarray:
+    """Cosine similarity between each row of the matrix and the vector"""
+    vector = np.asarray(vector, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector)
+    return np.divide(matrix @ vector, norms, out=np.zeros(len(matrix)),
+                     where=norms > 0)
+
+
 def get_keylemmas(text: str, processor) -> Set[str]:
     return {w.lemma_ for w in processor(text) if w.lemma_ not in fr_stop}
+
+
+def pack_batches(lengths: List[int], budget: int) -> List[List[int]]:
+    """Group indexes of items sorted by length in batches whose padded size
+    (number of items * longest length) stays under the budget"""
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    for idx in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # Sorted by length, so the current item is the longest of the batch
+        if batch and (len(batch) + 1) * lengths[idx] > budget:
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+
+    if batch:
+        batches.append(batch)
+    return batches